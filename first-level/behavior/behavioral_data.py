@@ -1,18 +1,30 @@
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import torch
 from PIL import Image
 
-from ..utils.path import get_fmriprep_output_dir
-from ..utils.subject_exclusion import read_subject_exclusion
-from ..utils.types import ConfigDict
+from .detection_cache import load_detection_cache, save_detection_cache
+from .etime import load_event_table
+from .yolo_model import compute_sha256, get_yolo_model_id, load_yolo_model
+from ..utils.layout import RSA_CITY_LIST, get_subject_layout, get_subject_list
+from ..utils.parallel import get_available_cpu_count
+from ..utils.types import ConfigDict, DetectionCacheDict
 
-MAX_REWARD = 0.28
-YOLO_MODEL_NAME = "yolov5s"
+# Output column -> YOLOv5 (COCO) class name
+YOLO_TAG_CLASS_DICT = {
+    "person": "person",
+    "bicycle": "bicycle",
+    "traffic_light": "traffic light",
+}
 
+DEFAULT_YOLO_BATCH_SIZE = 32
+DEFAULT_IMAGE_DECODE_WORKERS = 8
 
-def _gather_subject_feedback_data(subject_id: str, yolo_model: any, config: ConfigDict):
+
+def _gather_subject_feedback_data(subject_id: str, config: ConfigDict):
     behavioral_data_dir = Path(config["execution"]["glm"]["behavioral_data_dir"])
     assert (
         behavioral_data_dir.exists()
@@ -21,26 +33,18 @@ def _gather_subject_feedback_data(subject_id: str, yolo_model: any, config: Conf
     output_dir = Path(config["execution"]["output_dir"])
     assert output_dir.exists(), f"Output directory is not found: <{output_dir}>"
 
-    try:
-        subject_behavior_dir = [
-            child
-            for child in behavioral_data_dir.iterdir()
-            if subject_id.split("-")[1] in child.stem
-        ][0]
-    except IndexError:
+    subject_layout = get_subject_layout(subject_id, config)
+    if subject_layout["behavior_dir"] is None:
         raise RuntimeError(f"Behavioral data directory for {subject_id} is not found.")
 
     print(subject_id)
 
     # Find run_id - run directory pairs
-    rsa_city_list = ["New_York", "Boston", "Los_Angeles", "London", "Paris"]
-    run_id_city_name_city_dir_pair_list = []  # list of (run_id, run_dir)
-    for city_name in rsa_city_list:
-        run_city_dir = [
-            child for child in subject_behavior_dir.iterdir() if city_name in child.stem
-        ][0]
-        run_id = f'run-0{run_city_dir.stem.split("_")[0]}'
-        run_id_city_name_city_dir_pair_list.append((run_id, city_name, run_city_dir))
+    run_id_city_name_city_dir_pair_list = [
+        (run_id, run_layout["city"], Path(run_layout["run_dir"]))
+        for run_id, run_layout in subject_layout["behavior_runs"].items()
+        if run_layout["city"] in RSA_CITY_LIST
+    ]
     run_id_city_name_city_dir_pair_list.sort(
         key=lambda pair: int(pair[0].split("-")[1])
     )
@@ -60,91 +64,171 @@ def _gather_subject_feedback_data(subject_id: str, yolo_model: any, config: Conf
 
     for run_id, city_name, run_city_dir in run_id_city_name_city_dir_pair_list:
         run_etime_path = Path(run_city_dir) / "log_etime.txt"
+        run_event_table = load_event_table(subject_id, run_id, run_etime_path, config)
+
+        feedback_mask = run_event_table["event_type"] == "feedback"
+        for trial_index, current_score, current_sim in zip(
+            run_event_table["trial"][feedback_mask].tolist(),
+            run_event_table["score"][feedback_mask].tolist(),
+            run_event_table["similarity"][feedback_mask].tolist(),
+        ):
+            subject_feedback_dict_list.append(
+                {
+                    "subject_id": subject_id,
+                    "city": city_name,
+                    "run": int(run_id.split("-")[-1]),
+                    "trial": trial_index,
+                    "feedback_score": current_score,
+                    "cosine_similarity": current_sim,
+                    # Object tags are filled by _tag_capture_images()
+                    "capture_image_path": str(
+                        run_city_dir / "capture" / f"trial_{trial_index}.png"
+                    ),
+                }
+            )
+
+    subject_feedback_df = pd.DataFrame.from_records(subject_feedback_dict_list)
+    return subject_feedback_df
+
+
+def _decode_capture_image(image_path: str):
+    try:
+        pil_image = Image.open(image_path)
+        pil_image.load()  # Decode here (in a worker thread), not in the model
+    except OSError:
+        raise RuntimeError(f"Cannot read capture image: <{image_path}>")
+
+    return pil_image
+
+
+def _detect_capture_images(
+    image_path_list: list[str], yolo_model: any, config: ConfigDict
+):
+    """Run YOLOv5 on capture images in fixed-size batches.
+
+    Returns per-image (# of detections) x 6 (x1, y1, x2, y2, confidence, class)
+    arrays. The next batch is decoded by a thread pool while the current batch is
+    running on the model.
+    """
+    behavior_config = config["execution"].get("behavior", {})
+    batch_size = behavior_config.get("yolo_batch_size", DEFAULT_YOLO_BATCH_SIZE)
+    decode_worker_count = behavior_config.get(
+        "image_decode_workers", DEFAULT_IMAGE_DECODE_WORKERS
+    )
+
+    detection_array_list = []
+    batch_start_list = list(range(0, len(image_path_list), batch_size))
 
-        trial_index = 1
+    with ThreadPoolExecutor(max_workers=decode_worker_count) as executor:
 
-        if not run_etime_path.exists():
-            raise RuntimeError(
-                f"Cannot find etime file for {subject_id} {run_id}: <{run_etime_path}>"
+        def _submit_batch(batch_start: int):
+            return [
+                executor.submit(_decode_capture_image, image_path)
+                for image_path in image_path_list[batch_start : batch_start + batch_size]
+            ]
+
+        next_future_list = _submit_batch(batch_start_list[0]) if batch_start_list else []
+
+        for i, batch_start in enumerate(batch_start_list):
+            pil_image_list = [future.result() for future in next_future_list]
+            if i + 1 < len(batch_start_list):
+                next_future_list = _submit_batch(batch_start_list[i + 1])
+
+            print(
+                f"YOLOv5 inference: {batch_start + len(pil_image_list)}/{len(image_path_list)} images"
             )
+            with torch.inference_mode():
+                results = yolo_model(pil_image_list)
 
-        try:
-            with open(run_etime_path, "r") as f:
-                run_etime_lines = f.readlines()
-        except IOError:
-            raise RuntimeError(
-                f"Cannot read etime file for {subject_id} {run_id}: <{run_etime_path}>"
+            # results.pred: per-image (# of detections) x 6 (xyxy, conf, class) tensors
+            detection_array_list.extend(
+                pred.cpu().numpy().astype(np.float32) for pred in results.pred
             )
 
-        for etime_line in run_etime_lines:
-            trial_line = etime_line.strip().split("\t")[
-                -1
-            ]  # Exclude timestamp information
-
-            if "trial_reward" in trial_line:
-                current_score = float(trial_line.split("/percent:")[-1])
-                current_sim = float(trial_line.split("/")[0].split(":")[-1])
-
-                if current_sim > MAX_REWARD:
-                    current_score = 100  # correcting score (percent) errors
-
-                # last event in a run -> perform YOLOv5 inference
-                trial_image_path = run_city_dir / "capture" / f"trial_{trial_index}.png"
-
-                pil_image = Image.open(trial_image_path)
-                results = yolo_model(pil_image)
-                categories = results.pandas().xyxy[0]["name"].tolist()
-
-                person_present = 1 if "person" in categories else 0
-                bicycle_present = 1 if "bicycle" in categories else 0
-                traffic_present = 1 if "traffic light" in categories else 0
-
-                subject_feedback_dict_list.append(
-                    {
-                        "subject_id": subject_id,
-                        "city": city_name,
-                        "run": int(run_id.split("-")[-1]),
-                        "trial": trial_index,
-                        "feedback_score": current_score,
-                        "cosine_similarity": current_sim,
-                        "person": person_present,
-                        "bicycle": bicycle_present,
-                        "traffic_light": traffic_present,
-                    }
-                )
-
-                trial_index += 1
+            for pil_image in pil_image_list:
+                pil_image.close()
 
-    subject_feedback_df = pd.DataFrame.from_records(subject_feedback_dict_list)
-    return subject_feedback_df
+    return detection_array_list
 
 
-def prepare_behavioral_data(config: ConfigDict):
-    fmriprep_output_dir = get_fmriprep_output_dir(config)
+def _get_yolo_class_name_list(yolo_model: any):
+    yolo_class_name_dict = yolo_model.names
+    if isinstance(yolo_class_name_dict, list):
+        return list(yolo_class_name_dict)
+    return [yolo_class_name_dict[i] for i in range(len(yolo_class_name_dict))]
 
-    # Check subject_exclusion.json present
-    try:
-        subject_exclusion_dict = read_subject_exclusion(config)
-    except RuntimeError as e:
-        print(e)
-        raise RuntimeError(
-            'subject_exclusion.json should be present. Please run both "glm.prepare_task_stim" and "glm.prepare_confound" tasks first.'
+
+def _tag_capture_images(image_path_list: list[str], config: ConfigDict):
+    """Tag capture images with YOLO_TAG_CLASS_DICT classes.
+
+    Detections are cached by image content (sha256) for the model name and weights
+    hash, so only new or changed images are run on the model (no cache for
+    torch.hub weights, which are not pinned). Returns a
+    (# of images) x (# of YOLO_TAG_CLASS_DICT) 0/1 array.
+    """
+    behavior_config = config["execution"].get("behavior", {})
+    decode_worker_count = behavior_config.get(
+        "image_decode_workers", DEFAULT_IMAGE_DECODE_WORKERS
+    )
+
+    with ThreadPoolExecutor(max_workers=decode_worker_count) as executor:
+        image_hash_list = list(executor.map(compute_sha256, image_path_list))
+
+    yolo_model_id = get_yolo_model_id(config)
+    detection_cache = (
+        load_detection_cache(yolo_model_id, config)
+        if yolo_model_id is not None
+        else DetectionCacheDict(class_name_list=None, detections={})
+    )
+
+    # Unique images not detected yet by this model
+    missing_image_path_dict = {}
+    for image_hash, image_path in zip(image_hash_list, image_path_list):
+        if image_hash not in detection_cache["detections"]:
+            missing_image_path_dict.setdefault(image_hash, image_path)
+
+    print(
+        f"Cached detections: {len(image_path_list) - len(missing_image_path_dict)}/{len(image_path_list)} images ({yolo_model_id or 'torch.hub, not cached'})"
+    )
+
+    if missing_image_path_dict:
+        # Set intra-op threads explicitly so that torch does not oversubscribe CPUs
+        # together with the image decoding threads
+        torch.set_num_threads(
+            behavior_config.get("torch_num_threads", get_available_cpu_count())
         )
 
-    subject_list = [
-        child.stem
-        for child in fmriprep_output_dir.iterdir()
-        if child.is_dir()
-        and "sub-" in child.stem
-        and child.stem not in subject_exclusion_dict.keys()
-    ]
+        # Prepare YOLOv5 model (only if there is anything to detect)
+        yolo_model = load_yolo_model(config)
 
-    if config["execution"]["participant_label"] is not None:
-        subject_list = [
-            child
-            for child in subject_list
-            if child[4:] in config["execution"]["participant_label"]
-        ]
+        detection_array_list = _detect_capture_images(
+            list(missing_image_path_dict.values()), yolo_model, config
+        )
+        detection_cache["detections"] |= dict(
+            zip(missing_image_path_dict.keys(), detection_array_list)
+        )
+        detection_cache["class_name_list"] = _get_yolo_class_name_list(yolo_model)
+
+        if yolo_model_id is not None:
+            save_detection_cache(yolo_model_id, detection_cache, config)
+
+    class_id_dict = {
+        name: i for i, name in enumerate(detection_cache["class_name_list"] or [])
+    }
+    tag_class_id_array = np.array(
+        [class_id_dict.get(name, -1) for name in YOLO_TAG_CLASS_DICT.values()]
+    )
+
+    tag_array = np.zeros((len(image_path_list), len(YOLO_TAG_CLASS_DICT)), dtype=np.int8)
+    for i, image_hash in enumerate(image_hash_list):
+        detected_class_id_array = detection_cache["detections"][image_hash][:, 5]
+        tag_array[i] = np.isin(tag_class_id_array, detected_class_id_array)
+
+    return tag_array
+
+
+def prepare_behavioral_data(config: ConfigDict):
+    subject_list = get_subject_list(config)
 
     print(f"Subjects to be processed: {subject_list}")
 
@@ -154,17 +238,22 @@ def prepare_behavioral_data(config: ConfigDict):
     subgroup = str(config["execution"]["bids_dir"]).split("/bids")[0].split("/")[-1]
     print(f"Subgroup: {subgroup}")
 
-    # Prepare YOLOv5 model
-    yolo_model = torch.hub.load("ultralytics/yolov5", YOLO_MODEL_NAME)
-
     for subject_id in subject_list:
-        df = _gather_subject_feedback_data(subject_id, yolo_model, config)
+        df = _gather_subject_feedback_data(subject_id, config)
         all_subject_feedback_df_list.append(df)
 
     subject_feedback_df: pd.DataFrame = pd.concat(
         all_subject_feedback_df_list, ignore_index=True
     )
 
+    tag_array = _tag_capture_images(
+        subject_feedback_df["capture_image_path"].tolist(), config
+    )
+    for i, tag_column in enumerate(YOLO_TAG_CLASS_DICT.keys()):
+        subject_feedback_df[tag_column] = tag_array[:, i]
+
+    subject_feedback_df = subject_feedback_df.drop(columns=["capture_image_path"])
+
     subject_feedback_df.to_csv(
         behavioral_data_dir_path / f"group_{subgroup}_behavior_feedback.csv",
         index=False,
@@ -0,0 +1,94 @@
+import os
+from pathlib import Path
+
+import numpy as np
+
+from ..utils.types import ConfigDict, DetectionCacheDict
+
+
+def _get_detection_cache_path(model_id: str, config: ConfigDict):
+    return (
+        Path(config["execution"]["output_dir"])
+        / "cache"
+        / "yolo"
+        / f"{model_id}_detections.npz"
+    )
+
+
+def load_detection_cache(model_id: str, config: ConfigDict):
+    """Load cached detections of `model_id`.
+
+    Returns a DetectionCacheDict: class names of the model and image sha256 ->
+    (# of detections) x 6 (x1, y1, x2, y2, confidence, class) float32 array.
+    """
+    detection_cache_path = _get_detection_cache_path(model_id, config)
+    if not detection_cache_path.exists():
+        return DetectionCacheDict(class_name_list=None, detections={})
+
+    try:
+        with np.load(detection_cache_path) as detection_cache:
+            image_hash_array = detection_cache["image_hash"]
+            detection_offset_array = detection_cache["detection_offset"]
+            detection_array = np.column_stack(
+                [
+                    detection_cache["box"],
+                    detection_cache["confidence"],
+                    detection_cache["class_id"].astype(np.float32),
+                ]
+            )
+            class_name_list = detection_cache["class_name"].tolist()
+    except (IOError, ValueError, KeyError):
+        print(f"Cannot read detection cache. Ignoring it: <{detection_cache_path}>")
+        return DetectionCacheDict(class_name_list=None, detections={})
+
+    detection_dict = {
+        image_hash: detection_array[start:end]
+        for image_hash, start, end in zip(
+            image_hash_array.tolist(),
+            detection_offset_array[:-1].tolist(),
+            detection_offset_array[1:].tolist(),
+        )
+    }
+
+    return DetectionCacheDict(class_name_list=class_name_list, detections=detection_dict)
+
+
+def save_detection_cache(
+    model_id: str, detection_cache: DetectionCacheDict, config: ConfigDict
+):
+    # Columnar layout: detections of all images are concatenated, and
+    # detection_offset[i]:detection_offset[i + 1] indexes those of image_hash[i]
+    image_hash_list = sorted(detection_cache["detections"].keys())
+    detection_array_list = [
+        detection_cache["detections"][image_hash] for image_hash in image_hash_list
+    ]
+
+    detection_offset_array = np.zeros(len(image_hash_list) + 1, dtype=np.int64)
+    np.cumsum(
+        [len(detection_array) for detection_array in detection_array_list],
+        out=detection_offset_array[1:],
+    )
+    detection_array = (
+        np.concatenate(detection_array_list).astype(np.float32)
+        if detection_array_list
+        else np.zeros((0, 6), dtype=np.float32)
+    )
+
+    detection_cache_path = _get_detection_cache_path(model_id, config)
+    try:
+        os.makedirs(detection_cache_path.parent, exist_ok=True)
+        tmp_detection_cache_path = detection_cache_path.with_suffix(
+            f".{os.getpid()}.npz"
+        )
+        np.savez_compressed(
+            tmp_detection_cache_path,
+            image_hash=np.array(image_hash_list, dtype="U64"),
+            detection_offset=detection_offset_array,
+            box=detection_array[:, :4],
+            confidence=detection_array[:, 4],
+            class_id=detection_array[:, 5].astype(np.int16),
+            class_name=np.array(detection_cache["class_name_list"]),
+        )
+        os.replace(tmp_detection_cache_path, detection_cache_path)
+    except OSError:
+        raise RuntimeError(f"Cannot write detection cache: <{detection_cache_path}>")
@@ -0,0 +1,183 @@
+import os
+import re
+from pathlib import Path
+
+import numpy as np
+
+from ..utils.types import ConfigDict, EventTableDict
+
+MAX_REWARD = 0.28
+
+# "YYYY-mm-dd HH:MM:SS.ffffff<TAB>message"
+ETIME_LINE_PATTERN = re.compile(r"(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d{1,6})\t(.*)")
+
+# Event durations (s) except the exploration event
+EVENT_DURATION_DICT = {
+    "capture": 0.1,
+    "capture_failed": 0.1,
+    "preview": 2.0,
+    "voice": 3.0,
+    "caption": 3.0,
+    "feedback": 2.0,
+}
+
+
+def parse_etime(etime_path: Path):
+    """Parse a log_etime.txt file into a columnar event table.
+
+    Onsets are seconds from the first line of the run. `score` (feedback score in
+    percent, corrected to 100 above MAX_REWARD) and `similarity` are NaN for
+    non-feedback events.
+    """
+    try:
+        with open(etime_path, "r") as f:
+            etime_text = f.read()
+    except IOError:
+        raise RuntimeError(f"Cannot read etime: <{etime_path}>")
+
+    etime_line_list = []
+    for line_number, line in enumerate(etime_text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        etime_line_match = ETIME_LINE_PATTERN.fullmatch(line)
+        if etime_line_match is None:
+            raise RuntimeError(
+                f"Cannot parse line {line_number} of etime ({line!r}): <{etime_path}>"
+            )
+        etime_line_list.append(etime_line_match.groups())
+
+    if not etime_line_list:
+        raise RuntimeError(f"No event is found in etime: <{etime_path}>")
+
+    timestamp_array = np.array(
+        [timestamp for timestamp, _ in etime_line_list], dtype="datetime64[us]"
+    )
+    timestamp_list = (
+        (timestamp_array - timestamp_array[0]).astype(np.int64) / 1e6
+    ).tolist()
+
+    onset_list, duration_list, event_type_list = [], [], []
+    trial_list, score_list, similarity_list = [], [], []
+
+    def _append_event(onset, duration, event_type, trial, score=np.nan, sim=np.nan):
+        onset_list.append(onset)
+        duration_list.append(duration)
+        event_type_list.append(event_type)
+        trial_list.append(trial)
+        score_list.append(score)
+        similarity_list.append(sim)
+
+    trial_index = 1
+    exploration_onset = 0.0
+
+    for timestamp, (_, message) in zip(timestamp_list, etime_line_list):
+        # exploration onset
+        if f"trial_{trial_index}" in message:
+            exploration_onset = timestamp
+
+        # exploration duration, capture onset
+        elif "capture" in message:
+            _append_event(
+                exploration_onset,
+                round(timestamp - exploration_onset, 3),
+                "exploration",
+                trial_index,
+            )
+            event_type = "capture_failed" if "capture_failed" in message else "capture"
+            _append_event(
+                timestamp, EVENT_DURATION_DICT[event_type], event_type, trial_index
+            )
+
+        elif "trial_preview" in message:
+            _append_event(timestamp, EVENT_DURATION_DICT["preview"], "preview", trial_index)
+
+        elif "trial_voice" in message:
+            _append_event(timestamp, EVENT_DURATION_DICT["voice"], "voice", trial_index)
+
+        elif "trial_caption" in message:
+            _append_event(timestamp, EVENT_DURATION_DICT["caption"], "caption", trial_index)
+
+        elif "trial_reward" in message:
+            trial_score = float(message.split("/percent:")[-1])
+            trial_sim = float(message.split("/")[0].split(":")[-1])
+            if trial_sim > MAX_REWARD:
+                trial_score = 100.0  # correcting score (percent) errors
+
+            _append_event(
+                timestamp,
+                EVENT_DURATION_DICT["feedback"],
+                "feedback",
+                trial_index,
+                trial_score,
+                trial_sim,
+            )
+            trial_index += 1
+
+    return EventTableDict(
+        onset=np.array(onset_list, dtype=np.float64),
+        duration=np.array(duration_list, dtype=np.float64),
+        event_type=np.array(event_type_list, dtype="U14"),
+        trial=np.array(trial_list, dtype=np.int16),
+        score=np.array(score_list, dtype=np.float64),
+        similarity=np.array(similarity_list, dtype=np.float64),
+    )
+
+
+def load_event_table(
+    subject_id: str, run_id: str, etime_path: Path, config: ConfigDict
+):
+    """Load the event table of a run, parsing log_etime.txt only if it changed.
+
+    Tables are cached in (output_dir)/cache/etime as .npz files keyed by the
+    mtime and size of the etime file.
+    """
+    etime_path = Path(etime_path)
+    if not etime_path.exists():
+        raise RuntimeError(
+            f"Cannot find etime file for {subject_id} {run_id}: <{etime_path}>"
+        )
+
+    etime_stat = etime_path.stat()
+    event_table_cache_path = (
+        Path(config["execution"]["output_dir"])
+        / "cache"
+        / "etime"
+        / f"{subject_id}_{run_id}_task-photographer_events.npz"
+    )
+
+    if event_table_cache_path.exists():
+        try:
+            with np.load(event_table_cache_path) as cached_event_table:
+                if (
+                    int(cached_event_table["source_mtime_ns"]) == etime_stat.st_mtime_ns
+                    and int(cached_event_table["source_size"]) == etime_stat.st_size
+                ):
+                    return EventTableDict(
+                        {
+                            column: cached_event_table[column]
+                            for column in EventTableDict.__annotations__
+                        }
+                    )
+        except (IOError, ValueError, KeyError):
+            pass  # Re-parse a corrupted cache
+
+    event_table = parse_etime(etime_path)
+
+    try:
+        os.makedirs(event_table_cache_path.parent, exist_ok=True)
+        tmp_event_table_cache_path = event_table_cache_path.with_suffix(
+            f".{os.getpid()}.npz"
+        )
+        np.savez(
+            tmp_event_table_cache_path,
+            source_mtime_ns=etime_stat.st_mtime_ns,
+            source_size=etime_stat.st_size,
+            **event_table,
+        )
+        os.replace(tmp_event_table_cache_path, event_table_cache_path)
+    except OSError:
+        raise RuntimeError(
+            f"Cannot write event table cache: <{event_table_cache_path}>"
+        )
+
+    return event_table
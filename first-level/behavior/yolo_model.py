@@ -0,0 +1,192 @@
+import hashlib
+import os
+import sys
+from pathlib import Path
+
+import torch
+
+from ..utils.types import ConfigDict
+
+YOLO_MODEL_NAME = "yolov5s"
+YOLO_HUB_REPO = "ultralytics/yolov5"
+
+# YOLOv5 code the pickled model depends on (its revision is part of the cache key)
+YOLO_REPO_CODE_PATTERN_LIST = [
+    "hubconf.py",
+    "models/**/*.py",
+    "models/**/*.yaml",
+    "utils/**/*.py",
+]
+
+# (weights path, st_mtime_ns, st_size) -> sha256 already computed in this process
+_weights_hash_cache: dict[tuple[str, int, int], str] = {}
+
+
+def compute_sha256(file_path: Path):
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def get_yolo_repo_hash(yolo_repo_dir: Path):
+    """sha256 of the YOLOv5 code revision (hubconf.py, models/, and utils/ files)."""
+    code_path_list = sorted(
+        {
+            code_path
+            for pattern in YOLO_REPO_CODE_PATTERN_LIST
+            for code_path in yolo_repo_dir.glob(pattern)
+        }
+    )
+
+    sha256 = hashlib.sha256()
+    try:
+        for code_path in code_path_list:
+            sha256.update(code_path.relative_to(yolo_repo_dir).as_posix().encode())
+            sha256.update(compute_sha256(code_path).encode())
+    except IOError:
+        raise RuntimeError(f"Cannot read YOLOv5 code: <{yolo_repo_dir}>")
+    return sha256.hexdigest()
+
+
+def _get_sha256_path(path: Path):
+    return path.with_name(f"{path.name}.sha256")
+
+
+def _is_model_cache_verified(model_cache_path: Path):
+    # The sha256 sidecar is written with the cache, and checked before unpickling it
+    try:
+        expected_hash = _get_sha256_path(model_cache_path).read_text().strip()
+        return expected_hash == compute_sha256(model_cache_path)
+    except IOError:
+        return False
+
+
+def get_yolo_weights_hash(config: ConfigDict):
+    """Return the verified sha256 of the configured YOLOv5 weights.
+
+    Returns None if no local weights are configured (torch.hub download).
+    """
+    behavior_config = config["execution"].get("behavior", {})
+    if behavior_config.get("yolo_weights_path") is None:
+        return None
+
+    weights_path = Path(behavior_config["yolo_weights_path"])
+    if not weights_path.exists():
+        raise RuntimeError(f"Cannot find YOLOv5 weights: <{weights_path}>")
+
+    weights_stat = weights_path.stat()
+    weights_key = (str(weights_path), weights_stat.st_mtime_ns, weights_stat.st_size)
+
+    if weights_key not in _weights_hash_cache:
+        try:
+            _weights_hash_cache[weights_key] = compute_sha256(weights_path)
+        except IOError:
+            raise RuntimeError(f"Cannot read YOLOv5 weights: <{weights_path}>")
+
+    weights_hash = _weights_hash_cache[weights_key]
+
+    expected_weights_hash = behavior_config.get("yolo_weights_sha256")
+    if expected_weights_hash is not None and weights_hash != expected_weights_hash.lower():
+        raise RuntimeError(
+            f"YOLOv5 weights integrity check failed (sha256 {weights_hash} != {expected_weights_hash}): <{weights_path}>"
+        )
+
+    return weights_hash
+
+
+def get_yolo_model_id(config: ConfigDict):
+    """Model name + weights hash, identifying detection results of this model.
+
+    Returns None without pinned weights: torch.hub weights may change between
+    runs, so their detections cannot be cached.
+    """
+    weights_hash = get_yolo_weights_hash(config)
+    if weights_hash is None:
+        return None
+
+    weights_path = Path(config["execution"]["behavior"]["yolo_weights_path"])
+    return f"{weights_path.stem}-{weights_hash[:16]}"
+
+
+def load_yolo_model(config: ConfigDict):
+    """Load the YOLOv5 detector from the local model registry.
+
+    With `behavior.yolo_repo_dir` and `behavior.yolo_weights_path` configured, the
+    model is built once from the pinned code and weights (no network access) and
+    serialized to (output_dir)/cache/yolo with its sha256, which later runs
+    verify and load directly.
+    Otherwise, fall back to downloading from torch.hub.
+    """
+    behavior_config = config["execution"].get("behavior", {})
+    yolo_repo_dir = behavior_config.get("yolo_repo_dir")
+
+    if yolo_repo_dir is None or behavior_config.get("yolo_weights_path") is None:
+        print(
+            "behavior.yolo_repo_dir/yolo_weights_path are not configured. Loading YOLOv5 from torch.hub..."
+        )
+        return torch.hub.load(YOLO_HUB_REPO, YOLO_MODEL_NAME)
+
+    yolo_repo_dir = Path(yolo_repo_dir)
+    if not (yolo_repo_dir / "hubconf.py").exists():
+        raise RuntimeError(f"Cannot find hubconf.py of YOLOv5 code: <{yolo_repo_dir}>")
+
+    weights_path = Path(behavior_config["yolo_weights_path"])
+    get_yolo_weights_hash(config)  # integrity check
+
+    # Pickled YOLOv5 modules refer to `models.*` of the YOLOv5 code
+    if str(yolo_repo_dir) not in sys.path:
+        sys.path.insert(0, str(yolo_repo_dir))
+
+    # The serialized module depends on the YOLOv5 code and torch versions as well
+    model_cache_path = (
+        Path(config["execution"]["output_dir"])
+        / "cache"
+        / "yolo"
+        / f"{get_yolo_model_id(config)}_code-{get_yolo_repo_hash(yolo_repo_dir)[:16]}_torch-{torch.__version__}.pt"
+    )
+
+    if model_cache_path.exists() and not _is_model_cache_verified(model_cache_path):
+        print(
+            f"YOLOv5 model cache failed the integrity check. Rebuilding: <{model_cache_path}>"
+        )
+    elif model_cache_path.exists():
+        try:
+            yolo_model = torch.load(
+                model_cache_path, map_location="cpu", weights_only=False
+            )
+            yolo_model.eval()
+            print(f"YOLOv5 model loaded: <{model_cache_path}>")
+            return yolo_model
+        except Exception as e:
+            print(e)
+            print(f"Cannot load cached YOLOv5 model. Rebuilding: <{model_cache_path}>")
+
+    try:
+        yolo_model = torch.hub.load(
+            str(yolo_repo_dir), "custom", path=str(weights_path), source="local"
+        )
+    except Exception as e:
+        print(e)
+        raise RuntimeError(
+            f"Cannot build YOLOv5 model from <{yolo_repo_dir}> and <{weights_path}>"
+        )
+
+    try:
+        os.makedirs(model_cache_path.parent, exist_ok=True)
+        tmp_model_cache_path = model_cache_path.with_suffix(f".{os.getpid()}.pt")
+        torch.save(yolo_model, tmp_model_cache_path)
+
+        # The sidecar goes first, so a cache never lands without its sha256
+        model_cache_hash_path = _get_sha256_path(model_cache_path)
+        tmp_model_cache_hash_path = model_cache_hash_path.with_suffix(
+            f".{os.getpid()}.sha256"
+        )
+        tmp_model_cache_hash_path.write_text(compute_sha256(tmp_model_cache_path))
+        os.replace(tmp_model_cache_hash_path, model_cache_hash_path)
+        os.replace(tmp_model_cache_path, model_cache_path)
+    except OSError:
+        raise RuntimeError(f"Cannot write YOLOv5 model cache: <{model_cache_path}>")
+
+    return yolo_model
@@ -20,12 +20,40 @@ def main():
     def _path_abs(path):
         return Path(path).absolute()
 
+    def _parse_memory_budget(memory_budget_input: str, parser: ArgumentParser):
+        from ..utils.memory import parse_memory_size
+
+        try:
+            memory_budget = parse_memory_size(memory_budget_input)
+        except ValueError:
+            raise parser.error(
+                f"Memory budget should be given as a size (e.g., 16GB): <{memory_budget_input}>"
+            )
+
+        if memory_budget <= 0:
+            raise parser.error(f"Memory budget should be positive: <{memory_budget_input}>")
+
+        return memory_budget
+
     def _drop_sub(sub_input: str):
         return sub_input[4:] if sub_input.startswith("sub-") else sub_input
 
+    def _parse_shard(shard_input: str, parser: ArgumentParser):
+        try:
+            shard_index, shard_count = (int(v) for v in shard_input.split("/"))
+        except ValueError:
+            raise parser.error(f"Shard should be given as i/N: <{shard_input}>")
+
+        if shard_count < 1 or not (1 <= shard_index <= shard_count):
+            raise parser.error(f"Shard index should be in 1..N: <{shard_input}>")
+
+        return (shard_index, shard_count)
+
     parser = ArgumentParser(description="Photographer Data First-level Analysis")
 
     PathExists = partial(_path_exists, parser=parser)
+    Shard = partial(_parse_shard, parser=parser)
+    MemoryBudget = partial(_parse_memory_budget, parser=parser)
 
     # Required arguments
     parser.add_argument(
@@ -52,6 +80,12 @@ def main():
         type=_drop_sub,
         help="A single participant label or a space-separated participant labels.",
     )
+    g_bids.add_argument(
+        "--shard",
+        action="store",
+        type=Shard,
+        help="Process only the i-th of N cost-balanced subject shards (e.g., 2/8). Run \"shard.merge_shards\" after all shards finished.",
+    )
 
     g_step = parser.add_argument_group("First-level analysis-related arguments")
     g_step.add_argument(
@@ -71,10 +105,13 @@ def main():
             "rsa.prepare_feedback_neural_data",
             "rsa.prepare_feedback_model_rdm",
             "rsa.run_feedback_rsa",
+            "rsa.run_roi_rsa",
             # For statistical analyses
             "stat.run_univariate_ttest",
             "stat.run_feedback_rsa_ttest",
             "stat.extract_feedback_rsa_cluster_mask",
+            # For multi-node (sharded) execution
+            "shard.merge_shards",
         ],
         action="store",
         required=True,
@@ -88,6 +125,35 @@ def main():
         help=f"A config file (toml) path. If not specified, we will try to find {DEFAULT_CONFIG_FILE_NAME} in (bids_dir)/code.",
     )
 
+    g_step.add_argument(
+        "--models-only",
+        "--models_only",
+        action="store_true",
+        help="(rsa.run_feedback_rsa) Compare the models to cached neural RDMs of the previous run, without the searchlight.",
+    )
+
+    g_step.add_argument(
+        "--memory-budget",
+        "--memory_budget",
+        action="store",
+        type=MemoryBudget,
+        help="Memory to fit in (e.g., 16GB). The searchlight (rsa.run_feedback_rsa) plans tile sizes and workers, and stat.* t-tests plan 3dClustSim jobs from measured footprints.",
+    )
+    g_step.add_argument(
+        "--searchlight-stride",
+        "--searchlight_stride",
+        action="store",
+        type=int,
+        help="(rsa.run_feedback_rsa) Exploratory maps from searchlight centers on every N-th voxel along each axis (N^3 fewer spheres); other voxels take the values of the nearest center.",
+    )
+    g_step.add_argument(
+        "--searchlight-refine-threshold",
+        "--searchlight_refine_threshold",
+        action="store",
+        type=float,
+        help="(rsa.run_feedback_rsa with --searchlight-stride) Recompute full-resolution spheres where the absolute Fisher z of any coarse plain (model) RSA map reaches this value.",
+    )
+
     arg_opt = parser.parse_args()
 
     # Validate arguments
@@ -102,6 +168,34 @@ def main():
     if arg_opt.output_dir != arg_opt.bids_dir / "derivatives" / "first-level":
         parser.error("Output directory should be (bids_dir)/derivatives/first-level.")
 
+    if arg_opt.shard is not None:
+        from ..utils.shard import SHARDABLE_TASK_LIST
+
+        if arg_opt.task not in SHARDABLE_TASK_LIST:
+            parser.error(
+                f"--shard is only available for subject-level tasks: {SHARDABLE_TASK_LIST}"
+            )
+
+    if arg_opt.models_only and arg_opt.task != "rsa.run_feedback_rsa":
+        parser.error("--models-only is only available for rsa.run_feedback_rsa")
+
+    if arg_opt.searchlight_stride is not None:
+        if arg_opt.task != "rsa.run_feedback_rsa":
+            parser.error("--searchlight-stride is only available for rsa.run_feedback_rsa")
+        if arg_opt.searchlight_stride < 1:
+            parser.error(
+                f"Searchlight stride should be a positive integer: <{arg_opt.searchlight_stride}>"
+            )
+        if arg_opt.models_only:
+            parser.error(
+                "--searchlight-stride cannot be used with --models-only (neural RDMs are cached at full resolution)"
+            )
+
+    if arg_opt.searchlight_refine_threshold is not None and (
+        arg_opt.searchlight_stride is None or arg_opt.searchlight_stride == 1
+    ):
+        parser.error("--searchlight-refine-threshold requires --searchlight-stride > 1")
+
     # Read the config toml file
     with open(config_file_path, "r") as f:
         config_toml_data = toml.load(f)
@@ -131,9 +225,11 @@ def main():
     from ..rsa.feedback_model_rdm import prepare_feedback_model_rdm
     from ..rsa.feedback_neural_data import prepare_feedback_neural_data
     from ..rsa.feedback_rsa import run_feedback_rsa
+    from ..rsa.roi_rsa import run_roi_rsa
     from ..stat.feedback_rsa_cluster_mask import extract_feedback_rsa_cluster_mask
     from ..stat.feedback_rsa_ttest import run_feedback_rsa_ttest
     from ..stat.univariate_ttest import run_univariate_ttest
+    from ..utils.shard import merge_shards
 
     task = config["execution"]["task"]
 
@@ -168,6 +264,9 @@ def main():
     elif task == "rsa.run_feedback_rsa":
         run_feedback_rsa(config)
 
+    elif task == "rsa.run_roi_rsa":
+        run_roi_rsa(config)
+
     # For statistical analyses
     elif task == "stat.run_univariate_ttest":
         run_univariate_ttest(config)
@@ -178,5 +277,9 @@ def main():
     elif task == "stat.extract_feedback_rsa_cluster_mask":
         extract_feedback_rsa_cluster_mask(config)
 
+    # For multi-node (sharded) execution
+    elif task == "shard.merge_shards":
+        merge_shards(config)
+
     else:
         parser.error(f"Cannot find modules for the input task name: {task}")
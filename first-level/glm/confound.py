@@ -1,55 +1,75 @@
 import os
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
-from numpy import format_float_positional
 
-from ..utils.path import get_fmriprep_output_dir
-from ..utils.subject_exclusion import delete_marked_subjects, mark_subject_exclusion
+from ..utils.layout import get_subject_layout, get_subject_list
+from ..utils.parallel import pmap
+from ..utils.subject_exclusion import SubjectExclusionLedger, delete_marked_subjects
 from ..utils.types import ConfigDict
 
 
-def _subject_confound(subject_id: str, fmriprep_output_dir: Path, config: ConfigDict):
+def _subject_confound(subject_id: str, config: ConfigDict):
     output_dir = Path(config["execution"]["output_dir"])
     assert output_dir.exists(), f"Output directory is not found: <{output_dir}>"
 
-    subject_fmriprep_func_dir = fmriprep_output_dir / subject_id / "func"
-    assert (
-        subject_fmriprep_func_dir.exists()
-    ), f"fMRIPrep output - func directory is not found: <{subject_fmriprep_func_dir}>"
-
     subject_confounds_file_path_list = [
-        child
-        for child in subject_fmriprep_func_dir.iterdir()
-        if child.name.endswith("confounds_timeseries.tsv")
+        Path(run_file_dict["confounds"])
+        for run_file_dict in get_subject_layout(subject_id, config)[
+            "fmriprep_runs"
+        ].values()
+        if "confounds" in run_file_dict
     ]
 
+    # (subject_id, reason) pairs to be marked in subject_exclusion.json
+    subject_exclusion_list = []
+
     if len(subject_confounds_file_path_list) != 5:
         # Incomplete run, this subject needs to be excluded
         print(f"Incomplete run!: {subject_id}")
-        mark_subject_exclusion(
-            subject_id, f"Incomplte runs ({len(subject_confounds_file_path_list)})"
+        subject_exclusion_list.append(
+            (subject_id, f"Incomplte runs ({len(subject_confounds_file_path_list)})")
         )
-        return
+        return subject_exclusion_list
 
     marked_exclusion = False
 
+    confound_column_list = config["execution"]["glm"]["confound_list"]
+
     for run_confounds_file_path in subject_confounds_file_path_list:
         run_id = run_confounds_file_path.name.split("_")[2]
         print(subject_id, run_id)
 
-        # Read confounds_timeseries.tsv
-        run_confounds_df = pd.read_csv(run_confounds_file_path, sep="\t")
+        # Read only the confound and outlier columns of confounds_timeseries.tsv
+        run_confounds_df = pd.read_csv(
+            run_confounds_file_path,
+            sep="\t",
+            usecols=lambda column: column in confound_column_list
+            or "outlier" in column,
+            dtype=np.float32,
+        )
+
+        missing_confound_column_list = [
+            column
+            for column in confound_column_list
+            if column not in run_confounds_df.columns
+        ]
+        if missing_confound_column_list:
+            raise RuntimeError(
+                f"Confound columns {missing_confound_column_list} are not found: <{run_confounds_file_path}>"
+            )
 
         # Check spike outlier columns first
         run_outliers_columns = [col for col in run_confounds_df if "outlier" in col]
-        run_outlier_list = (
-            run_confounds_df[run_outliers_columns]
-            .apply(lambda row: row.max(), axis=1)
-            .tolist()
-        )
-        run_outlier_volume_count = sum(run_outlier_list)
-        run_outlier_volume_ratio = run_outlier_volume_count / len(run_outlier_list)
+        if run_outliers_columns:
+            run_outlier_array = run_confounds_df[run_outliers_columns].to_numpy().max(
+                axis=1
+            )
+        else:
+            run_outlier_array = np.zeros(len(run_confounds_df), dtype=np.float32)
+        run_outlier_volume_count = run_outlier_array.sum()
+        run_outlier_volume_ratio = run_outlier_volume_count / len(run_outlier_array)
 
         if (
             run_outlier_volume_ratio
@@ -59,10 +79,11 @@ def _subject_confound(subject_id: str, fmriprep_output_dir: Path, config: Config
                 f'Outlier censored run! (threshold = {int(config["execution"]["glm"]["run_outlier_ratio_threshold"] * 100)}%): '
                 + f"{subject_id}, {run_id}, {round(run_outlier_volume_ratio * 100, 3)}%"
             )
-            mark_subject_exclusion(
-                subject_id,
-                f"Outlier censored run ({run_id}, {round(run_outlier_volume_ratio * 100, 3)}%)",
-                config,
+            subject_exclusion_list.append(
+                (
+                    subject_id,
+                    f"Outlier censored run ({run_id}, {round(run_outlier_volume_ratio * 100, 3)}%)",
+                )
             )
             marked_exclusion = True
 
@@ -79,24 +100,22 @@ def _subject_confound(subject_id: str, fmriprep_output_dir: Path, config: Config
                 f"Cannot create regressors directory: <{run_regressors_dir}>"
             )
 
-        # Extract confound regressors
-        for confound_column in config["execution"]["glm"]["confound_list"]:
-            confound_list = run_confounds_df[confound_column].tolist()
+        # Extract confound regressors (volume x confound)
+        run_confound_array = run_confounds_df[confound_column_list].to_numpy()
 
-            # if the confound is derivative (or framewise displacement), replace NaN (at the first volume) to zero.
-            if "derivative" in confound_column:
-                confound_list[0] = 0.0
-
-            if "framewise" in confound_column:
-                confound_list[0] = 0.0
+        # if the confound is derivative (or framewise displacement), replace NaN (at the first volume) to zero.
+        for confound_index, confound_column in enumerate(confound_column_list):
+            if "derivative" in confound_column or "framewise" in confound_column:
+                run_confound_array[0, confound_index] = 0.0
 
+        for confound_index, confound_column in enumerate(confound_column_list):
             try:
-                with open(
+                np.savetxt(
                     run_regressors_dir
                     / f"{subject_id}_task-photographer_{run_id}_confound_{confound_column}.1D",
-                    "w",
-                ) as f:
-                    f.writelines("\n".join(map(format_float_positional, confound_list)))
+                    run_confound_array[:, confound_index],
+                    fmt="%.9g",  # float32 round-trip precision
+                )
             except OSError:
                 raise RuntimeError(
                     f"Cannot write confound_{confound_column}.1D for {subject_id}, {run_id}."
@@ -104,51 +123,42 @@ def _subject_confound(subject_id: str, fmriprep_output_dir: Path, config: Config
 
         # Save outlier regressor
         try:
-            with open(
+            np.savetxt(
                 run_regressors_dir
                 / f"{subject_id}_task-photographer_{run_id}_confound_outlier.1D",
-                "w",
-            ) as f:
-                f.writelines(
-                    "\n".join(map(lambda v: "1" if v == 1 else "0", run_outlier_list))
-                )
+                (run_outlier_array == 1).astype(np.int8),
+                fmt="%d",
+            )
         except OSError:
             raise RuntimeError(
                 f"Cannot write confound_outlier.1D for {subject_id}, {run_id}."
             )
 
+    return subject_exclusion_list
 
-def prepare_confound(config: ConfigDict):
-    fmriprep_output_dir = get_fmriprep_output_dir(config)
 
+def prepare_confound(config: ConfigDict):
     # List all appropriate subjects/participants without faulty participants after fMRIPrep
-    subject_list = [
-        child.stem
-        for child in fmriprep_output_dir.iterdir()
-        if child.is_dir()
-        and "sub-" in child.stem
-        and child.stem not in config["execution"]["glm"]["fmriprep_faulty_subject_list"]
-    ]
-
-    if config["execution"]["participant_label"] is not None:
-        subject_list = [
-            child
-            for child in subject_list
-            if child[4:] in config["execution"]["participant_label"]
-        ]
+    subject_list = get_subject_list(config, use_subject_exclusion=False)
 
     if not subject_list:
         raise RuntimeError(
             "No participant is selected. Please check --participant-label or BIDS root directory."
         )
 
+    exclusion_ledger = SubjectExclusionLedger(config)
+
     # Exclude faulty fMRIPrep subject(s) first
     for subject_id in config["execution"]["glm"]["fmriprep_faulty_subject_list"]:
-        mark_subject_exclusion(subject_id, "fMRIPrep faulty subject", config)
+        exclusion_ledger.mark(subject_id, "fMRIPrep faulty subject")
 
-    # Iterate through all appropriate subjects
-    for subject_id in subject_list:
-        _subject_confound(subject_id, fmriprep_output_dir, config)
+    # Process all appropriate subjects in parallel
+    subject_exclusion_list_list = pmap(
+        _subject_confound, subject_list, config, pm_pbar=True
+    )
+    for subject_exclusion_list in subject_exclusion_list_list:
+        exclusion_ledger.extend(subject_exclusion_list)
 
-    # Delete excluded subjects
+    # Write all exclusion marks at once, then delete excluded subjects
+    exclusion_ledger.flush()
     delete_marked_subjects(config)
@@ -7,8 +7,9 @@ from pathlib import Path
 
 from nipype.interfaces import afni
 
+from ..utils.layout import get_fmriprep_run_file, get_subject_list
 from ..utils.path import get_fmriprep_output_dir
-from ..utils.subject_exclusion import read_subject_exclusion
+from ..utils.shard import mark_shard_complete, select_shard_subjects
 from ..utils.types import ConfigDict
 
 """
@@ -25,28 +26,20 @@ def _subject_run_trial_wise_glm(
     assert output_dir.exists(), f"Output directory is not found: <{output_dir}>"
 
     subject_fmriprep_func_dir = fmriprep_output_dir / subject_id / "func"
-    assert (
-        subject_fmriprep_func_dir.exists()
-    ), f"fMRIPrep output - func directory is not found: <{subject_fmriprep_func_dir}>"
-
-    run_fmriprep_bold_path = (
-        subject_fmriprep_func_dir
-        / f"{subject_id}_task-photographer_{run_id}_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz"
-    )
-    run_fmriprep_brainmask_path = (
-        subject_fmriprep_func_dir
-        / f"{subject_id}_task-photographer_{run_id}_space-MNI152NLin2009cAsym_desc-brain_mask.nii.gz"
-    )
 
     # Check presence of bold and brainmask data
-    if not run_fmriprep_bold_path.exists():
+    run_fmriprep_bold_path = get_fmriprep_run_file(subject_id, run_id, "bold", config)
+    if run_fmriprep_bold_path is None:
         raise RuntimeError(
-            f"fMRIPrep preprocessed BOLD data is not found: <{run_fmriprep_bold_path}>"
+            f"fMRIPrep preprocessed BOLD data is not found: {subject_id} {run_id} in <{subject_fmriprep_func_dir}>"
         )
 
-    if not run_fmriprep_brainmask_path.exists():
+    run_fmriprep_brainmask_path = get_fmriprep_run_file(
+        subject_id, run_id, "brainmask", config
+    )
+    if run_fmriprep_brainmask_path is None:
         raise RuntimeError(
-            f"fMRIPrep preprocessed brainmask is not found: <{run_fmriprep_brainmask_path}>"
+            f"fMRIPrep preprocessed brainmask is not found: {subject_id} {run_id} in <{subject_fmriprep_func_dir}>"
         )
 
     print(subject_id, run_id)
@@ -251,29 +244,9 @@ def _subject_run_trial_wise_glm(
 def run_trial_wise_glm(config: ConfigDict):
     fmriprep_output_dir = get_fmriprep_output_dir(config)
 
-    # Check subject_exclusion.json present
-    try:
-        subject_exclusion_dict = read_subject_exclusion(config)
-    except RuntimeError as e:
-        print(e)
-        raise RuntimeError(
-            'subject_exclusion.json should be present. Please run both "glm.prepare_task_stim" and "glm.prepare_confound" tasks first.'
-        )
+    subject_list = get_subject_list(config)
 
-    subject_list = [
-        child.stem
-        for child in fmriprep_output_dir.iterdir()
-        if child.is_dir()
-        and "sub-" in child.stem
-        and child.stem not in subject_exclusion_dict.keys()
-    ]
-
-    if config["execution"]["participant_label"] is not None:
-        subject_list = [
-            child
-            for child in subject_list
-            if child[4:] in config["execution"]["participant_label"]
-        ]
+    subject_list = select_shard_subjects(subject_list, config)
 
     print(f"Subjects to be processed: {subject_list}")
 
@@ -281,3 +254,5 @@ def run_trial_wise_glm(config: ConfigDict):
         for run_id in ["run-01", "run-02", "run-03", "run-04", "run-05"]:
             _subject_run_trial_wise_glm(subject_id, run_id, fmriprep_output_dir, config)
             time.sleep(2)
+
+    mark_shard_complete(subject_list, config)
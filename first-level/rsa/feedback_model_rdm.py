@@ -1,49 +1,74 @@
-import gc
 import os
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
-from scipy.spatial.distance import pdist
+from numpy.lib.stride_tricks import sliding_window_view
+
+from .model_registry import (
+    CROSS_RUN_ID,
+    N_HISTORY_TRIALS,
+    RUN_ID_LIST,
+    get_model_rdm_spec_list,
+    is_cross_run_rsa,
+)
+from .rdm import get_rdm_pair_index
+from ..utils.layout import get_subject_list
+from ..utils.types import ConfigDict, ModelRDMSpecDict
+
+FEEDBACK_MODEL_RDM_FILE_NAME = "feedback_model_rdm.npz"
+FEEDBACK_CROSS_RUN_MODEL_RDM_FILE_NAME = "feedback_cross_run_model_rdm.npz"
+
+N_TRIALS_PER_RUN = 8
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def _get_feedback_model_rdm_path(config: ConfigDict, cross_run: bool = False):
+    return (
+        Path(config["execution"]["output_dir"])
+        / "rsa_model_rdm"
+        / (
+            FEEDBACK_CROSS_RUN_MODEL_RDM_FILE_NAME
+            if cross_run
+            else FEEDBACK_MODEL_RDM_FILE_NAME
+        )
+    )
 
-from ..utils.path import get_fmriprep_output_dir
-from ..utils.subject_exclusion import read_subject_exclusion
-from ..utils.types import ConfigDict
 
+def _load_exploration_info_df(subgroup: str, config: ConfigDict):
+    exploration_info_path = config["execution"]["rsa"].get("exploration_info_path")
+    if exploration_info_path is None:
+        return None
 
-def _rdm_save_as_numpy(
-    output_dir: Path,
-    prefix: str,
-    subject_id: str,
-    run_id: str,
-    data_name: str,
-    rdm_vector: np.ndarray,
-):
     try:
-        os.makedirs(output_dir / prefix, exist_ok=True)
-    except OSError:
+        exploration_info_df = pd.read_csv(exploration_info_path)
+    except IOError:
         raise RuntimeError(
-            f"Cannot create {prefix} directory in {output_dir} for {subject_id}"
+            f"Exploration info data file cannot be loaded: <{exploration_info_path}>"
         )
 
-    try:
-        numpy_path = (
-            output_dir
-            / prefix
-            / f"{subject_id}_{run_id}_task-photographer_{data_name}_vector.npy"
-        )
-        np.save(numpy_path, rdm_vector)
-    except IOError:
-        raise RuntimeError(
-            f"Cannot save {prefix}/{data_name} in numpy array <{numpy_path}>"
+    # Subgroup IDs are "2022" (Discovery) and "2023" (Validation)
+    if "subgroup" in exploration_info_df.columns:
+        exploration_info_df = exploration_info_df[
+            exploration_info_df["subgroup"].astype(str) == subgroup
+        ]
+
+    exploration_info_df = exploration_info_df.assign(
+        run=exploration_info_df["run_id"].str.split("-").str[-1].astype(int)
+    )
+    if "trial" not in exploration_info_df.columns:
+        # Rows are in the trial order within each run
+        exploration_info_df = exploration_info_df.assign(
+            trial=exploration_info_df.groupby(["subject_id", "run"]).cumcount() + 1
         )
 
+    return exploration_info_df.drop(columns=["run_id"])
 
-def _compute_individual_run_feedback_model_rdm(
-    subject_id: str, run_id: str, config: ConfigDict
-):
-    output_dir = Path(config["execution"]["output_dir"])
 
+def _load_behavior_feedback_df(
+    feature_list: list[str], subject_list: list[str], config: ConfigDict
+):
     behavioral_data_dir_path = Path(config["execution"]["glm"]["behavioral_data_dir"])
     subgroup = str(config["execution"]["bids_dir"]).split("/bids")[0].split("/")[-1]
 
@@ -57,176 +82,342 @@ def _compute_individual_run_feedback_model_rdm(
             f"Behavior - Feedback data file cannot be loaded: <{behavior_feedback_df_path}>. Please run 'behavior.prepare_behavioral_data' command"
         )
 
-    run_id_int = int(run_id.split("-")[-1][-1])
+    # Features not in the feedback data (e.g., exploration_time) come from the
+    # exploration info data of the same trials
+    exploration_feature_list = [
+        feature
+        for feature in feature_list
+        if feature not in behavior_feedback_df.columns
+    ]
+    exploration_info_df = (
+        _load_exploration_info_df(subgroup, config)
+        if exploration_feature_list
+        else None
+    )
+    if exploration_info_df is not None:
+        behavior_feedback_df = behavior_feedback_df.merge(
+            exploration_info_df[
+                ["subject_id", "run", "trial"]
+                + [
+                    feature
+                    for feature in exploration_feature_list
+                    if feature in exploration_info_df.columns
+                ]
+            ],
+            on=["subject_id", "run", "trial"],
+            how="left",
+        )
 
-    subject_run_feedback_data_df = behavior_feedback_df[
-        (behavior_feedback_df["subject_id"] == subject_id)
-        & (behavior_feedback_df["run"] == run_id_int)
+        # Trials without exploration info (e.g., a missing run or subgroup)
+        # would give NaN model RDMs
+        merged_feature_list = [
+            feature
+            for feature in exploration_feature_list
+            if feature in behavior_feedback_df.columns
+        ]
+        subject_feedback_df = behavior_feedback_df[
+            behavior_feedback_df["subject_id"].isin(subject_list)
+        ]
+        missing_info_df = subject_feedback_df[
+            subject_feedback_df[merged_feature_list].isna().any(axis=1)
+        ]
+        if len(missing_info_df) > 0:
+            missing_subject_run_list = sorted(
+                {
+                    f"{subject_id} run-0{run}"
+                    for subject_id, run in zip(
+                        missing_info_df["subject_id"], missing_info_df["run"]
+                    )
+                }
+            )
+            raise RuntimeError(
+                f"Exploration info features {merged_feature_list} are missing for {missing_subject_run_list}: <{config['execution']['rsa']['exploration_info_path']}>"
+            )
+
+    missing_feature_list = [
+        feature
+        for feature in feature_list
+        if feature not in behavior_feedback_df.columns
     ]
+    if missing_feature_list:
+        raise RuntimeError(
+            f"Model RDM features are not found in <{behavior_feedback_df_path}> or rsa.exploration_info_path: {missing_feature_list}"
+        )
 
-    all_trial_feedback_score_list = subject_run_feedback_data_df[
-        "feedback_score"
-    ].to_numpy()
+    return behavior_feedback_df[["subject_id", "run", "trial"] + feature_list]
 
-    n_trials_to_use = 6  # up to 2-back trials
 
-    run_current_trial_list = [
-        [elem] for elem in all_trial_feedback_score_list[-n_trials_to_use:]
-    ]
-    assert len(run_current_trial_list) == n_trials_to_use
+def _build_feature_array(
+    behavior_feedback_df: pd.DataFrame,
+    subject_list: list[str],
+    feature_list: list[str],
+):
+    # (subject_id, run) -> (# of features) x (# of trials) in trial order
+    subject_run_feature_dict = {
+        subject_run: subject_run_df[feature_list].to_numpy(dtype=np.float64).T
+        for subject_run, subject_run_df in behavior_feedback_df[
+            behavior_feedback_df["subject_id"].isin(subject_list)
+        ]
+        .sort_values("trial", kind="stable")
+        .groupby(["subject_id", "run"], sort=False)
+    }
 
-    run_one_back_trial_list = [
-        [elem] for elem in all_trial_feedback_score_list[-n_trials_to_use - 1 : -1]
+    subject_run_list = [
+        (subject_id, run_id) for subject_id in subject_list for run_id in RUN_ID_LIST
     ]
+    feature_array = np.zeros(
+        (len(subject_run_list), len(feature_list), N_TRIALS_PER_RUN)
+    )
 
-    run_two_back_trial_list = [
-        [elem] for elem in all_trial_feedback_score_list[-n_trials_to_use - 2 : -2]
-    ]
+    for i, (subject_id, run_id) in enumerate(subject_run_list):
+        run_feature_array = subject_run_feature_dict.get(
+            (subject_id, int(run_id.split("-")[-1]))
+        )
+        if run_feature_array is None or run_feature_array.shape[1] != N_TRIALS_PER_RUN:
+            raise RuntimeError(
+                f"Behavior feedback data of {N_TRIALS_PER_RUN} trials are not found for {subject_id} {run_id}."
+            )
+        feature_array[i] = run_feature_array
 
-    run_recent_2_trial_list = [
-        [
-            all_trial_feedback_score_list[idx - 1],
-            all_trial_feedback_score_list[idx],
-        ]
-        for idx in range(2, 8)
-    ]
+    return subject_run_list, feature_array
 
-    run_recent_3_trial_list = [
-        [
-            all_trial_feedback_score_list[idx - 2],
-            all_trial_feedback_score_list[idx - 1],
-            all_trial_feedback_score_list[idx],
-        ]
-        for idx in range(2, 8)
-    ]
 
-    run_previous_2_trial_list = [
-        [
-            all_trial_feedback_score_list[idx - 2],
-            all_trial_feedback_score_list[idx - 1],
-        ]
-        for idx in range(2, 8)
-    ]
+def haversine_distance(
+    lat_1: np.ndarray, lon_1: np.ndarray, lat_2: np.ndarray, lon_2: np.ndarray
+):
+    # Great-circle distance (km) between coordinates (degrees), element-wise
+    # REF: https://www.movable-type.co.uk/scripts/latlong.html
+    lat_1, lon_1, lat_2, lon_2 = map(np.radians, (lat_1, lon_1, lat_2, lon_2))
+
+    a = np.sin((lat_2 - lat_1) / 2) ** 2 + np.cos(lat_1) * np.cos(lat_2) * (
+        np.sin((lon_2 - lon_1) / 2) ** 2
+    )
+    return EARTH_RADIUS_KM * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
 
-    # Compute feedback model rdm vectors
-    feedback_current_trial_rdm_vector = pdist(np.array(run_current_trial_list))
-    assert feedback_current_trial_rdm_vector.shape == (15,)  # 6 * (6 - 1) / 2 = 15
 
-    feedback_one_back_trial_rdm_vector = pdist(np.array(run_one_back_trial_list))
-    feedback_two_back_trial_rdm_vector = pdist(np.array(run_two_back_trial_list))
+def compute_model_rdm_array(
+    feature_array: np.ndarray,
+    feature_list: list[str],
+    model_rdm_spec_list: list[ModelRDMSpecDict],
+    n_runs: int = 1,
+):
+    """Compute RDM vectors of all model specs and all runs at once.
+
+    `feature_array` is (# of runs) x (# of features) x (# of trials). Returns a
+    (# of runs) x (# of models) x (# of condition pairs) array, in the pair order
+    of scipy.spatial.distance.pdist. With `n_runs` > 1, conditions of every
+    `n_runs` consecutive runs (e.g., all runs of a subject) are stacked into one
+    RDM of their between-run pairs (see rsa.rdm.get_rdm_pair_index).
+    """
+    # (# of runs) x (# of features) x (# of conditions) x (N_HISTORY_TRIALS + 1)
+    # The last window position is the current trial
+    trial_window_array = sliding_window_view(
+        feature_array, N_HISTORY_TRIALS + 1, axis=2
+    )
+    n_rows, n_features, n_conditions, n_window = trial_window_array.shape
+    if n_runs > 1:
+        # (# of run groups) x (# of features) x (n_runs x # of conditions) x window
+        trial_window_array = (
+            trial_window_array.reshape(
+                n_rows // n_runs, n_runs, n_features, n_conditions, n_window
+            )
+            .transpose(0, 2, 1, 3, 4)
+            .reshape(n_rows // n_runs, n_features, n_runs * n_conditions, n_window)
+        )
+    pair_index_1, pair_index_2 = get_rdm_pair_index(n_runs, n_conditions)
 
-    feedback_recent_2_trial_rdm_vector = pdist(np.array(run_recent_2_trial_list))
-    assert feedback_recent_2_trial_rdm_vector.shape == (15,)
-    feedback_recent_3_trial_rdm_vector = pdist(np.array(run_recent_3_trial_list))
-    feedback_previous_2_trial_rdm_vector = pdist(np.array(run_previous_2_trial_list))
+    # Zero-out features/window positions not used by each model, so that all
+    # models share one difference computation
+    model_mask = np.zeros(
+        (len(model_rdm_spec_list), len(feature_list), N_HISTORY_TRIALS + 1)
+    )
+    for i, spec in enumerate(model_rdm_spec_list):
+        model_mask[
+            i,
+            np.array([feature_list.index(feature) for feature in spec["feature"]])[
+                :, np.newaxis
+            ],
+            [N_HISTORY_TRIALS - lag for lag in spec["lags"]],
+        ] = 1.0
+
+    # (# of runs) x (# of models) x (# of features) x (# of pairs) x (N_HISTORY_TRIALS + 1)
+    pair_diff_array = (
+        trial_window_array[:, np.newaxis, :, pair_index_1, :]
+        - trial_window_array[:, np.newaxis, :, pair_index_2, :]
+    ) * model_mask[np.newaxis, :, :, np.newaxis, :]
+
+    model_rdm_array = np.zeros(
+        (trial_window_array.shape[0], len(model_rdm_spec_list), len(pair_index_1))
+    )
+    metric_array = np.array([spec["metric"] for spec in model_rdm_spec_list])
+
+    for metric in np.unique(metric_array):
+        metric_mask = metric_array == metric
+        metric_pair_diff_array = pair_diff_array[:, metric_mask]
+
+        if metric in ["euclidean", "sqeuclidean"]:
+            metric_rdm_array = np.einsum(
+                "rmfpk,rmfpk->rmp", metric_pair_diff_array, metric_pair_diff_array
+            )
+            if metric == "euclidean":
+                metric_rdm_array = np.sqrt(metric_rdm_array)
+        elif metric == "cityblock":
+            metric_rdm_array = np.abs(metric_pair_diff_array).sum(axis=(2, 4))
+        elif metric == "chebyshev":
+            metric_rdm_array = np.abs(metric_pair_diff_array).max(axis=(2, 4))
+        elif metric == "haversine":
+            # (# of runs) x (# of models) x [latitude, longitude] x (# of conditions)
+            coord_array = np.stack(
+                [
+                    trial_window_array[..., N_HISTORY_TRIALS - spec["lags"][0]][
+                        :, [feature_list.index(feature) for feature in spec["feature"]]
+                    ]
+                    for spec, is_metric in zip(model_rdm_spec_list, metric_mask)
+                    if is_metric
+                ],
+                axis=1,
+            )
+            metric_rdm_array = haversine_distance(
+                coord_array[:, :, 0, pair_index_1],
+                coord_array[:, :, 1, pair_index_1],
+                coord_array[:, :, 0, pair_index_2],
+                coord_array[:, :, 1, pair_index_2],
+            )
+
+        model_rdm_array[:, metric_mask] = metric_rdm_array
+
+    return model_rdm_array
+
+
+def _save_feedback_model_rdm(
+    subject_run_list: list[tuple[str, str]],
+    model_name_list: list[str],
+    feedback_model_rdm_array: np.ndarray,
+    config: ConfigDict,
+    cross_run: bool = False,
+):
+    feedback_model_rdm_path = _get_feedback_model_rdm_path(config, cross_run)
+
+    subject_id_array = np.array([pair[0] for pair in subject_run_list])
+    run_id_array = np.array([pair[1] for pair in subject_run_list])
+
+    # Keep model RDMs of other subjects (e.g., from a --participant-label run)
+    if feedback_model_rdm_path.exists():
+        try:
+            with np.load(feedback_model_rdm_path) as previous_model_rdm:
+                if previous_model_rdm["model_name"].tolist() == model_name_list:
+                    keep_mask = ~np.isin(
+                        previous_model_rdm["subject_id"], subject_id_array
+                    )
+                    subject_id_array = np.concatenate(
+                        [previous_model_rdm["subject_id"][keep_mask], subject_id_array]
+                    )
+                    run_id_array = np.concatenate(
+                        [previous_model_rdm["run_id"][keep_mask], run_id_array]
+                    )
+                    feedback_model_rdm_array = np.concatenate(
+                        [previous_model_rdm["rdm"][keep_mask], feedback_model_rdm_array]
+                    )
+        except (IOError, ValueError, KeyError):
+            pass  # Overwrite a corrupted file
 
-    # create RSA model RDM result directory
     try:
-        subject_model_rdm_dir = output_dir / subject_id / "rsa_model_rdm"
-        os.makedirs(subject_model_rdm_dir, exist_ok=True)
+        os.makedirs(feedback_model_rdm_path.parent, exist_ok=True)
+        tmp_feedback_model_rdm_path = feedback_model_rdm_path.with_suffix(
+            f".{os.getpid()}.npz"
+        )
+        np.savez(
+            tmp_feedback_model_rdm_path,
+            subject_id=subject_id_array,
+            run_id=run_id_array,
+            model_name=np.array(model_name_list),
+            rdm=feedback_model_rdm_array,
+        )
+        os.replace(tmp_feedback_model_rdm_path, feedback_model_rdm_path)
     except OSError:
         raise RuntimeError(
-            f"Cannot create rsa_model_rdm directory: <{subject_model_rdm_dir}>"
+            f"Cannot save feedback model RDMs: <{feedback_model_rdm_path}>"
         )
 
-    # save RDM/mask vectors into numpy arrays
-    _rdm_save_as_numpy(
-        subject_model_rdm_dir,
-        "feedback_model",
-        subject_id,
-        run_id,
-        "current_trial",
-        feedback_current_trial_rdm_vector,
-    )
-    _rdm_save_as_numpy(
-        subject_model_rdm_dir,
-        "feedback_model",
-        subject_id,
-        run_id,
-        "one_back_trial",
-        feedback_one_back_trial_rdm_vector,
-    )
-    _rdm_save_as_numpy(
-        subject_model_rdm_dir,
-        "feedback_model",
-        subject_id,
-        run_id,
-        "two_back_trial",
-        feedback_two_back_trial_rdm_vector,
-    )
 
-    _rdm_save_as_numpy(
-        subject_model_rdm_dir,
-        "feedback_model",
-        subject_id,
-        run_id,
-        "recent_2_trial",
-        feedback_recent_2_trial_rdm_vector,
-    )
-    _rdm_save_as_numpy(
-        subject_model_rdm_dir,
-        "feedback_model",
-        subject_id,
-        run_id,
-        "recent_3_trial",
-        feedback_recent_3_trial_rdm_vector,
-    )
-    _rdm_save_as_numpy(
-        subject_model_rdm_dir,
-        "feedback_model",
-        subject_id,
-        run_id,
-        "previous_2_trial",
-        feedback_previous_2_trial_rdm_vector,
+def load_feedback_model_rdm(subject_id: str, run_id: str, config: ConfigDict):
+    """Load feedback model RDM vectors of a run (or CROSS_RUN_ID for all runs).
+
+    Returns a model name -> RDM vector (# of condition pairs) dict.
+    """
+    feedback_model_rdm_path = _get_feedback_model_rdm_path(
+        config, run_id == CROSS_RUN_ID
     )
 
+    try:
+        with np.load(feedback_model_rdm_path) as feedback_model_rdm:
+            row_index_array = np.flatnonzero(
+                (feedback_model_rdm["subject_id"] == subject_id)
+                & (feedback_model_rdm["run_id"] == run_id)
+            )
+            if len(row_index_array) == 0:
+                raise RuntimeError(
+                    f"Feedback model RDMs for {subject_id} {run_id} are not found: <{feedback_model_rdm_path}>"
+                )
+
+            return dict(
+                zip(
+                    feedback_model_rdm["model_name"].tolist(),
+                    feedback_model_rdm["rdm"][row_index_array[0]],
+                )
+            )
+    except (IOError, ValueError, KeyError):
+        raise RuntimeError(
+            f"Cannot load feedback model RDMs: <{feedback_model_rdm_path}>"
+        )
 
-def _extract_subject_feedback_model_rdm(subject_id: str, config):
-    gc.collect()
 
-    behavioral_data_dir = Path(config["execution"]["glm"]["behavioral_data_dir"])
-    assert (
-        behavioral_data_dir.exists()
-    ), f"Behavioral data directory is not found: <{behavioral_data_dir}>"
+def prepare_feedback_model_rdm(config):
+    subject_list = get_subject_list(config)
+
+    print(f"Subjects to be processed: {subject_list}")
 
     output_dir = Path(config["execution"]["output_dir"])
     assert output_dir.exists(), f"Output directory is not found: <{output_dir}>"
 
-    print(subject_id)
-    run_id_list = ["run-01", "run-02", "run-03", "run-04", "run-05"]
-
-    for run_id in run_id_list:
-        _compute_individual_run_feedback_model_rdm(subject_id, run_id, config)
-
+    model_rdm_spec_list = get_model_rdm_spec_list(config)
+    model_name_list = [spec["name"] for spec in model_rdm_spec_list]
+    feature_list = sorted(
+        {feature for spec in model_rdm_spec_list for feature in spec["feature"]}
+    )
 
-def prepare_feedback_model_rdm(config):
-    fmriprep_output_dir = get_fmriprep_output_dir(config)
+    behavior_feedback_df = _load_behavior_feedback_df(
+        feature_list, subject_list, config
+    )
 
-    # Check subject_exclusion.json present
-    try:
-        subject_exclusion_dict = read_subject_exclusion(config)
-    except RuntimeError as e:
-        print(e)
-        raise RuntimeError(
-            'subject_exclusion.json should be present. Please run both "glm.prepare_task_stim" and "glm.prepare_confound" tasks first.'
-        )
+    subject_run_list, feature_array = _build_feature_array(
+        behavior_feedback_df, subject_list, feature_list
+    )
+    feedback_model_rdm_array = compute_model_rdm_array(
+        feature_array, feature_list, model_rdm_spec_list
+    )
 
-    subject_list = [
-        child.stem
-        for child in fmriprep_output_dir.iterdir()
-        if child.is_dir()
-        and "sub-" in child.stem
-        and child.stem not in subject_exclusion_dict.keys()
-    ]
+    _save_feedback_model_rdm(
+        subject_run_list, model_name_list, feedback_model_rdm_array, config
+    )
 
-    if config["execution"]["participant_label"] is not None:
-        subject_list = [
-            child
-            for child in subject_list
-            if child[4:] in config["execution"]["participant_label"]
-        ]
+    print(
+        f"Saved {len(model_name_list)} model RDMs of {len(subject_run_list)} runs: <{_get_feedback_model_rdm_path(config)}>"
+    )
 
-    print(f"Subjects to be processed: {subject_list}")
+    if is_cross_run_rsa(config):
+        # One RDM of all runs per subject
+        feedback_cross_run_model_rdm_array = compute_model_rdm_array(
+            feature_array, feature_list, model_rdm_spec_list, len(RUN_ID_LIST)
+        )
+        _save_feedback_model_rdm(
+            [(subject_id, CROSS_RUN_ID) for subject_id in subject_list],
+            model_name_list,
+            feedback_cross_run_model_rdm_array,
+            config,
+            cross_run=True,
+        )
 
-    for subject_id in subject_list:
-        _extract_subject_feedback_model_rdm(subject_id, config)
+        print(
+            f"Saved {len(model_name_list)} cross-run model RDMs of {len(subject_list)} subjects: <{_get_feedback_model_rdm_path(config, cross_run=True)}>"
+        )
@@ -3,19 +3,40 @@ import os
 import shutil
 import subprocess
 import time
+from collections.abc import Callable
 from pathlib import Path
 
 import numpy as np
 from nipype.interfaces import afni
 
+from .model_registry import RUN_ID_LIST
+from ..utils.layout import get_subject_list
 from ..utils.nifti import load_nifti
-from ..utils.path import get_fmriprep_output_dir
-from ..utils.subject_exclusion import read_subject_exclusion
+from ..utils.shard import mark_shard_complete, select_shard_subjects
 from ..utils.types import ConfigDict
+from ..utils.write_behind import write_behind
+
+
+def _commit_feedback_beta_array(
+    beta_array: np.memmap, tmp_beta_npy_path: Path, beta_npy_path: Path
+):
+    # Flush the complete array and move it into place (on a write-behind thread), so
+    # a failed run never leaves a partial array newer than the neural RDM cache
+    try:
+        beta_array.flush()
+        os.replace(tmp_beta_npy_path, beta_npy_path)
+    except OSError:
+        raise RuntimeError(
+            f"Cannot save feedback beta array into a .npy file: <{beta_npy_path}>"
+        )
 
 
 def _collect_individual_run_feedback_neural_data(
-    subject_id: str, run_id: str, subject_rsa_neural_data_dir: Path, config: ConfigDict
+    subject_id: str,
+    run_id: str,
+    subject_rsa_neural_data_dir: Path,
+    config: ConfigDict,
+    submit_write: Callable,
 ):
     output_dir = Path(config["execution"]["output_dir"])
 
@@ -80,9 +101,16 @@ def _collect_individual_run_feedback_neural_data(
 
     # Select and concatenate trial-wise feedback event beta maps
     trial_list = ["trial3", "trial4", "trial5", "trial6", "trial7", "trial8"]
+    subject_rsa_feedback_beta_npy = (
+        subject_rsa_neural_data_dir
+        / f"{subject_id}_{run_id}_task-photographer_trial_feedback_norm_beta_array.npy"
+    )
+    tmp_subject_rsa_feedback_beta_npy = subject_rsa_feedback_beta_npy.with_suffix(
+        f".{os.getpid()}.npy"
+    )
     rsa_trial_feedback_beta_concat_array = None
 
-    for trial_index in trial_list:
+    for trial_number, trial_index in enumerate(trial_list):
         subbrick_identifier = f"[{trial_index}_feedback#0_Coef]"
         trial_rsa_feedback_beta_map_name = (
             f"{subject_id}_task-photographer_{run_id}_{trial_index}_feedback_beta.nii"
@@ -99,38 +127,45 @@ def _collect_individual_run_feedback_neural_data(
         trial_rsa_feedback_beta_image = load_nifti(
             subject_rsa_neural_data_dir / trial_rsa_feedback_beta_map_name
         )
-        trial_rsa_feedback_beta_array = trial_rsa_feedback_beta_image.data[
-            :, :, :, np.newaxis
-        ]
 
-        if rsa_trial_feedback_beta_concat_array is None:
-            rsa_trial_feedback_beta_concat_array = trial_rsa_feedback_beta_array
-        else:
-            rsa_trial_feedback_beta_concat_array = np.concatenate(
-                (rsa_trial_feedback_beta_concat_array, trial_rsa_feedback_beta_array),
-                axis=3,
+        # Each beta map is written into the memory-mapped .npy file, so only one
+        # map is held in memory regardless of the volume size
+        try:
+            if rsa_trial_feedback_beta_concat_array is None:
+                rsa_trial_feedback_beta_concat_array = np.lib.format.open_memmap(
+                    tmp_subject_rsa_feedback_beta_npy,
+                    mode="w+",
+                    dtype=trial_rsa_feedback_beta_image.data.dtype,
+                    shape=(*trial_rsa_feedback_beta_image.data.shape[:3], len(trial_list)),
+                )
+            rsa_trial_feedback_beta_concat_array[:, :, :, trial_number] = (
+                trial_rsa_feedback_beta_image.data.reshape(
+                    rsa_trial_feedback_beta_concat_array.shape[:3]
+                )
+            )
+        except (IOError, ValueError):
+            raise RuntimeError(
+                f"Cannot save feedback beta array into a .npy file: <{subject_rsa_feedback_beta_npy}>"
             )
 
-    # Save the concatenated beta map array into a .npy file
-    try:
-        subject_rsa_feedback_beta_npy = (
-            subject_rsa_neural_data_dir
-            / f"{subject_id}_{run_id}_task-photographer_trial_feedback_norm_beta_array.npy"
-        )
-        np.save(subject_rsa_feedback_beta_npy, rsa_trial_feedback_beta_concat_array)
-    except IOError:
-        raise RuntimeError(
-            f"Cannot save feedback beta array into a .npy file: <{subject_rsa_feedback_beta_npy}>"
-        )
+    submit_write(
+        _commit_feedback_beta_array,
+        rsa_trial_feedback_beta_concat_array,
+        tmp_subject_rsa_feedback_beta_npy,
+        subject_rsa_feedback_beta_npy,
+    )
+    del rsa_trial_feedback_beta_concat_array
 
 
-def _extract_subject_feedback_neural_data(subject_id: str, config: ConfigDict):
+def _extract_subject_feedback_neural_data(
+    subject_id: str, config: ConfigDict, submit_write: Callable
+):
     gc.collect()
 
     output_dir = Path(config["execution"]["output_dir"])
     assert output_dir.exists(), f"Output directory is not found: <{output_dir}>"
 
-    run_id_list = ["run-01", "run-02", "run-03", "run-04", "run-05"]
+    run_id_list = RUN_ID_LIST
 
     subject_glm_trial_dir_list = [
         output_dir / subject_id / run_id / "glm_trial_wise" for run_id in run_id_list
@@ -155,41 +190,23 @@ def _extract_subject_feedback_neural_data(subject_id: str, config: ConfigDict):
         print(subject_id, run_id)
 
         _collect_individual_run_feedback_neural_data(
-            subject_id, run_id, subject_rsa_neural_data_dir, config
+            subject_id, run_id, subject_rsa_neural_data_dir, config, submit_write
         )
 
     print(f"RSA neural data finished: {subject_id}")
 
 
 def prepare_feedback_neural_data(config: ConfigDict):
-    fmriprep_output_dir = get_fmriprep_output_dir(config)
+    subject_list = get_subject_list(config)
 
-    # Check subject_exclusion.json present
-    try:
-        subject_exclusion_dict = read_subject_exclusion(config)
-    except RuntimeError as e:
-        print(e)
-        raise RuntimeError(
-            'subject_exclusion.json should be present. Please run both "glm.prepare_task_stim" and "glm.prepare_confound" tasks first.'
-        )
-
-    subject_list = [
-        child.stem
-        for child in fmriprep_output_dir.iterdir()
-        if child.is_dir()
-        and "sub-" in child.stem
-        and child.stem not in subject_exclusion_dict.keys()
-    ]
-
-    if config["execution"]["participant_label"] is not None:
-        subject_list = [
-            child
-            for child in subject_list
-            if child[4:] in config["execution"]["participant_label"]
-        ]
+    subject_list = select_shard_subjects(subject_list, config)
 
     print(f"Subjects to be processed: {subject_list}")
 
-    for subject_id in subject_list:
-        _extract_subject_feedback_neural_data(subject_id, config)
-        time.sleep(2)
+    # Beta arrays are committed behind (flushed before the shard is marked complete)
+    with write_behind() as submit_write:
+        for subject_id in subject_list:
+            _extract_subject_feedback_neural_data(subject_id, config, submit_write)
+            time.sleep(2)
+
+    mark_shard_complete(subject_list, config)
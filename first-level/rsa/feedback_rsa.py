@@ -3,102 +3,419 @@ import os
 import shutil
 import subprocess
 import time
+from collections.abc import Callable, Iterator
+from contextlib import closing
+from functools import partial
 from pathlib import Path
 
 import numpy as np
-from nipype.interfaces import afni
-from rsatoolbox.rdm import compare_rho_a
-from scipy.spatial.distance import pdist
 
+from .feedback_model_rdm import load_feedback_model_rdm
+from .model_registry import (
+    CROSS_RUN_ID,
+    RUN_ID_LIST,
+    get_model_rdm_name_list,
+    get_neural_rdm_distance,
+    get_partial_rsa_spec,
+    get_rdm_comparator,
+    get_regression_rsa_model_name_list,
+    get_rsa_map_name_list,
+    get_rsa_run_id_list,
+    get_searchlight_radius_list,
+)
+from .neural_rdm_cache import load_neural_rdm_cache, save_neural_rdm_cache
+from .rdm import (
+    compare_rdm,
+    compute_residual_projection,
+    fit_rdm_regression,
+    get_rdm_pair_index,
+    residualize_rdm,
+)
+from .searchlight_rdm import (
+    DEFAULT_SPHERE_CHUNK_SIZE,
+    DEFAULT_TILE_DEPTH,
+    MIN_SPHERE_CHUNK_SIZE,
+    build_searchlight_index,
+    compute_searchlight_rdm,
+    fill_from_nearest_center,
+    get_searchlight_tile_list,
+    get_strided_center_mask,
+)
+from ..utils.layout import get_subject_list
 from ..utils.nifti import NiftiImage, load_nifti, save_nifti
-from ..utils.parallel import pmap
-from ..utils.path import get_fmriprep_output_dir
-from ..utils.searchlight import Searchlight
-from ..utils.subject_exclusion import read_subject_exclusion
-from ..utils.types import ConfigDict
+from ..utils.memory import (
+    WORKER_OVERHEAD_BYTES,
+    format_memory_size,
+    get_memory_budget,
+    get_resident_memory,
+    measure_peak_memory,
+    plan_worker_count,
+)
+from ..utils.parallel import get_available_cpu_count, pmap
+from ..utils.prefetch import prefetch, read_into_page_cache
+from ..utils.shard import mark_shard_complete, select_shard_subjects
+from ..utils.types import ConfigDict, PartialRSASpecDict
+from ..utils.write_behind import write_behind
 
 """
 Feedback model RSA
 - feedback model RDMs constructed from raw feedback scores (0 - 100 range)
 - neural data from trial-wise GLM (GLM2)
 - MNI152 GM mask (threshold = 0.3; 3 mm)
-- rsatoolbox compare_rho_a
-- run-wise
+- rho-a (as rsatoolbox compare_rho_a) or another comparator (rsa.rdm_comparator)
+- run-wise, or cross-run (all 30 trials, between-run pairs only; rsa.cross_run)
+- correlation (or cosine/Euclidean) distance (rsa.neural_rdm_distance)
+- optional partial/semipartial RSA against covariate model RDMs ([rsa.partial_rsa])
+- optional multiple-regression RSA (standardized beta maps; [rsa.regression_rsa])
+- one or more searchlight radii (rsa.searchlight_radius), computed in one pass
+- searchlight in z-slab tiles (rsa.searchlight_tile_depth) over parallel workers
+- neural RDMs are cached, so --models-only reruns skip the searchlight
+- exploratory strided maps (--searchlight-stride; nearest-center fill, optional refinement)
 """
 
 
-def _load_rdm_from_numpy(
-    data_dir: Path, prefix: str, subject_id: str, run_id: str, data_name: str
+def _load_beta_slab(beta_path_list: list[Path], slab_range: tuple[int, int]):
+    # (x, y, slab z, # of runs x # of conditions) contiguous copy of the memory-mapped betas
+    beta_slab_list = []
+    for beta_path in beta_path_list:
+        try:
+            beta_slab_list.append(
+                np.load(beta_path, mmap_mode="r")[:, :, slice(*slab_range)]
+            )
+        except (IOError, ValueError):
+            raise RuntimeError(
+                f"Cannot load trial_feedback_norm_beta_array.npy: <{beta_path}>"
+            )
+    return np.concatenate(beta_slab_list, axis=3)
+
+
+def _compute_tile_neural_rdm_array(
+    tile: tuple[tuple[int, int], tuple[int, int]],
+    beta_path_list: list[Path],
+    center_mask_array: np.ndarray,
+    searchlight_radius_list: list[int],
+    n_runs: int,
+    neural_rdm_distance: str,
+    chunk_size: int = DEFAULT_SPHERE_CHUNK_SIZE,
 ):
-    try:
-        numpy_path = (
-            data_dir
-            / prefix
-            / f"{subject_id}_{run_id}_task-photographer_{data_name}_vector.npy"
+    """Neural RDMs of the spheres of one z-slab tile (see get_searchlight_tile_list).
+
+    Only the slab of the tile is read, so the memory of a worker is bounded by
+    the tile depth. Returns (center voxel indices in the volume, neural RDMs)
+    of each radius.
+    """
+    (z_start, z_end), slab_range = tile
+    beta_slab_array = _load_beta_slab(beta_path_list, slab_range)
+
+    # Centers of this tile only; the halo is read for the spheres
+    center_mask_slab_array = np.zeros(beta_slab_array.shape[:3], dtype=bool)
+    center_mask_slab_array[:, :, z_start - slab_range[0] : z_end - slab_range[0]] = (
+        center_mask_array[:, :, z_start:z_end]
+    )
+
+    (
+        center_voxel_index_array,
+        sphere_voxel_index_array,
+        sphere_voxel_mask_array,
+        shell_offset_array,
+        center_radius_mask_array,
+    ) = build_searchlight_index(
+        center_mask_slab_array,
+        np.all(beta_slab_array != 0, axis=3),
+        searchlight_radius_list,
+    )
+    center_voxel_index_array[:, 2] += slab_range[0]
+
+    # (# of spheres) x (# of condition pairs) of each radius
+    neural_rdm_array_list = compute_searchlight_rdm(
+        beta_slab_array.reshape(-1, beta_slab_array.shape[3]),
+        sphere_voxel_index_array,
+        sphere_voxel_mask_array,
+        shell_offset_array,
+        n_runs,
+        neural_rdm_distance,
+        chunk_size,
+    )
+
+    center_neural_rdm_list = []
+    for center_mask, neural_rdm_array in zip(
+        center_radius_mask_array.T, neural_rdm_array_list
+    ):
+        # filter neural RDM spheres whose RDM vector does not contain only one type of value
+        center_mask = center_mask & ~np.all(
+            neural_rdm_array == neural_rdm_array[:, :1], axis=1
+        )
+        center_neural_rdm_list.append(
+            (center_voxel_index_array[center_mask], neural_rdm_array[center_mask])
         )
-        return np.load(numpy_path)
-    except IOError:
-        raise RuntimeError(f"Cannot load numpy array: <{numpy_path}>")
 
+    return center_neural_rdm_list
 
-def _create_neural_rdm_vector(sphere: tuple[np.ndarray, tuple[int, int, int]]):
-    neural_vector, center_voxel_index = sphere
-    neural_rdm_vector = pdist(neural_vector.T, "correlation")
-    neural_rdm_vector = np.nan_to_num(
-        neural_rdm_vector, nan=1.0
-    )  # correlation distances can be nan!
-    return (center_voxel_index, neural_rdm_vector)
 
+def _get_beta_slab_size(beta_path_list: list[Path], slab_depth: int):
+    """Bytes of a beta slab of `slab_depth` z slices (see _load_beta_slab)."""
+    beta_array_list = [np.load(beta_path, mmap_mode="r") for beta_path in beta_path_list]
+    return sum(
+        beta_array.shape[0]
+        * beta_array.shape[1]
+        * slab_depth
+        * beta_array.shape[3]
+        * beta_array.itemsize
+        for beta_array in beta_array_list
+    )
 
-def _generate_neural_rdm_sphere_list(
-    sphere_list: list[tuple[np.ndarray, tuple[int, int, int]]],
+
+def _plan_searchlight_tile(
+    beta_path_list: list[Path],
+    center_mask_array: np.ndarray,
+    searchlight_radius_list: list[int],
+    n_runs: int,
+    neural_rdm_distance: str,
+    tile_depth: int,
+    memory_budget: int,
 ):
-    neural_rdm_sphere_list = pmap(
-        _create_neural_rdm_vector, sphere_list, pm_pbar=True, pm_chunksize=500
+    """Fit searchlight tiles into the memory budget.
+
+    The footprint of a probe tile (the z slice with the most centers) is
+    measured once per chunk size, and the footprint of a tile is its beta slab
+    plus the probe's footprint per center times its # of centers. The memory of
+    this process (and of the neural RDMs it gathers from the tiles) is taken
+    from the budget first. Tiles (then sphere chunks) are halved until the
+    largest tile fits, and as many workers as fit are used. Returns the tile
+    depth, the chunk size, and the # of workers.
+    """
+    halo = max(searchlight_radius_list)
+    n_conditions = sum(
+        np.load(beta_path, mmap_mode="r").shape[3] for beta_path in beta_path_list
+    )
+    n_pairs = len(get_rdm_pair_index(n_runs, n_conditions // n_runs)[0])
+
+    # Neural RDMs of all tiles, and their concatenation (float64)
+    result_size = (
+        2
+        * int(center_mask_array.sum())
+        * len(searchlight_radius_list)
+        * n_pairs
+        * np.dtype(np.float64).itemsize
+    )
+    parent_footprint = get_resident_memory() + result_size
+    worker_budget = max(memory_budget - parent_footprint, 0)
+    print(
+        f"Searchlight parent footprint: {format_memory_size(parent_footprint)} (of which neural RDMs {format_memory_size(result_size)})"
     )
 
-    # filter neural RDM spheres whose RDM vector does not contain only one type of value
-    # sphere[1] -> neural RDM vector, sphere[1][0] -> first element of neural RDM vector
-    filtered_neural_rdm_sphere_list = list(
-        filter(
-            lambda sphere: not np.all((sphere[1] == sphere[1][0])),
-            neural_rdm_sphere_list,
+    probe_tile = max(
+        get_searchlight_tile_list(center_mask_array, halo, 1),
+        key=lambda tile: center_mask_array[:, :, slice(*tile[0])].sum(),
+    )
+    (probe_z_start, probe_z_end), probe_slab_range = probe_tile
+    n_probe_centers = int(center_mask_array[:, :, probe_z_start:probe_z_end].sum())
+    probe_slab_size = _get_beta_slab_size(
+        beta_path_list, probe_slab_range[1] - probe_slab_range[0]
+    )
+
+    chunk_size = DEFAULT_SPHERE_CHUNK_SIZE
+    probe_chunk_size = None
+    while True:
+        if probe_chunk_size != chunk_size:
+            _, probe_footprint = measure_peak_memory(
+                _compute_tile_neural_rdm_array,
+                probe_tile,
+                beta_path_list,
+                center_mask_array,
+                searchlight_radius_list,
+                n_runs,
+                neural_rdm_distance,
+                chunk_size,
+            )
+            probe_chunk_size = chunk_size
+            center_footprint = max(probe_footprint - probe_slab_size, 0) / max(
+                n_probe_centers, 1
+            )
+
+        tile_list = get_searchlight_tile_list(center_mask_array, halo, tile_depth)
+        tile_footprint = max(
+            int(
+                _get_beta_slab_size(beta_path_list, slab_end - slab_start)
+                + center_footprint * center_mask_array[:, :, z_start:z_end].sum()
+            )
+            for (z_start, z_end), (slab_start, slab_end) in tile_list
+        )
+        print(
+            f"Searchlight tile footprint: {format_memory_size(tile_footprint)} (tile depth = {tile_depth}, chunk size = {chunk_size})"
         )
+
+        if tile_footprint + WORKER_OVERHEAD_BYTES <= worker_budget:
+            break
+        # Smaller tiles do not help if a bare worker does not fit
+        if worker_budget > WORKER_OVERHEAD_BYTES and tile_depth > 1:
+            tile_depth = max(tile_depth // 2, 1)
+        elif worker_budget > WORKER_OVERHEAD_BYTES and chunk_size > MIN_SPHERE_CHUNK_SIZE:
+            chunk_size = max(chunk_size // 2, MIN_SPHERE_CHUNK_SIZE)
+        else:
+            print(
+                f"Warning: a searchlight tile does not fit in the memory budget ({format_memory_size(memory_budget)}). Running serially."
+            )
+            break
+
+    n_workers = plan_worker_count(
+        tile_footprint, worker_budget, min(get_available_cpu_count(), len(tile_list))
     )
+    return tile_depth, chunk_size, n_workers
 
-    return filtered_neural_rdm_sphere_list
 
+def _compute_neural_rdm_array(
+    beta_path_list: list[Path],
+    center_mask_array: np.ndarray,
+    searchlight_radius_list: list[int],
+    n_runs: int,
+    neural_rdm_distance: str,
+    tile_depth: int,
+    memory_budget: int | None = None,
+):
+    """Neural RDMs of all searchlight spheres centered in `center_mask_array`.
+
+    Betas ((x, y, z, # of conditions) arrays of `beta_path_list`; conditions are
+    concatenated run by run) are processed in z-slab tiles in parallel. With a
+    memory budget (--memory-budget), the tile depth, the sphere chunk size, and
+    the # of workers are planned from the measured footprint of a tile. Returns
+    (center voxel indices, neural RDMs) of each radius.
+    """
+    chunk_size = DEFAULT_SPHERE_CHUNK_SIZE
+    n_workers = None
+    if memory_budget is not None and center_mask_array.any():
+        tile_depth, chunk_size, n_workers = _plan_searchlight_tile(
+            beta_path_list,
+            center_mask_array,
+            searchlight_radius_list,
+            n_runs,
+            neural_rdm_distance,
+            tile_depth,
+            memory_budget,
+        )
+
+    tile_list = get_searchlight_tile_list(
+        center_mask_array, max(searchlight_radius_list), tile_depth
+    )
+    print(
+        f"Computing neural searchlight RDMs: radius = {searchlight_radius_list}, # of tiles = {len(tile_list)} (tile depth = {tile_depth}, # of workers = {n_workers or get_available_cpu_count()})"
+    )
 
-def _sphere_level_correlation(
-    neural_rdm_sphere: tuple[tuple[int, int, int], np.ndarray],
-    model_rdm_vector: np.ndarray,
+    tile_result_dict = dict(
+        zip(
+            tile_list,
+            pmap(
+                _compute_tile_neural_rdm_array,
+                tile_list,
+                beta_path_list,
+                center_mask_array,
+                searchlight_radius_list,
+                n_runs,
+                neural_rdm_distance,
+                chunk_size,
+                n_workers=n_workers,
+                # Workers are not forked from this process, which runs prefetch and
+                # write-behind threads (a fork could copy a lock held by them)
+                start_method="forkserver",
+            ),
+        )
+    )
+
+    center_neural_rdm_list = []
+    for radius_index, searchlight_radius in enumerate(searchlight_radius_list):
+        tile_center_neural_rdm_list = [
+            tile_result_dict[tile][radius_index] for tile in tile_list
+        ]
+        center_neural_rdm_list.append(
+            (
+                np.concatenate([center for center, _ in tile_center_neural_rdm_list]),
+                np.concatenate([rdm for _, rdm in tile_center_neural_rdm_list]),
+            )
+        )
+        print(
+            f"# of spheres (radius = {searchlight_radius}): {len(center_neural_rdm_list[-1][0])}"
+        )
+
+    return center_neural_rdm_list
+
+
+def _scatter_sphere_value_array(
+    sphere_value_array: np.ndarray, center_voxel_index_array: np.ndarray, dim
 ):
-    center_voxel_index, neural_rdm_vector = neural_rdm_sphere
-    raw_corr_coef = compare_rho_a(neural_rdm_vector, model_rdm_vector)[0][0]
-    zscored_corr_coef = np.arctanh(raw_corr_coef)
+    # (# of spheres) x (# of maps) values -> (# of maps) x (brain map dim)
+    brain_map_array = np.zeros((sphere_value_array.shape[1], *dim))
+    brain_map_array[(slice(None), *center_voxel_index_array.T)] = sphere_value_array.T
+    return brain_map_array
+
 
-    return (center_voxel_index, zscored_corr_coef)
+def _compute_neural_model_correlation(
+    neural_rdm_array: np.ndarray, model_rdm_array: np.ndarray, rdm_comparator: str
+):
+    # (# of spheres) x (# of models) Fisher z-transformed rho-a (or another comparator)
+    return np.arctanh(compare_rdm(neural_rdm_array, model_rdm_array, rdm_comparator))
 
 
-def _compute_neural_model_correlation_map(
-    neural_rdm_sphere_list: list[tuple[tuple[int, int, int], np.ndarray]],
-    model_rdm_vector: np.ndarray,
-    dim,
+def _compute_neural_model_partial_correlation(
+    neural_rdm_array: np.ndarray,
+    model_rdm_array: np.ndarray,
+    covariate_rdm_array: np.ndarray,
+    mode: str,
+    rdm_comparator: str,
 ):
-    rsa_output_brain_map = np.zeros(dim)
-
-    rsa_output_correlation_list = pmap(
-        _sphere_level_correlation,
-        neural_rdm_sphere_list,
-        model_rdm_vector,
-        pm_pbar=True,
-        pm_chunksize=300,
+    # One projection per run is shared by all spheres and models
+    projection_array = compute_residual_projection(covariate_rdm_array)
+    residual_model_rdm_array = residualize_rdm(model_rdm_array, projection_array)
+    if mode == "partial":
+        neural_rdm_array = residualize_rdm(neural_rdm_array, projection_array)
+
+    return _compute_neural_model_correlation(
+        neural_rdm_array, residual_model_rdm_array, rdm_comparator
     )
 
-    for center_voxel_index, model_correlation_coef in rsa_output_correlation_list:
-        rsa_output_brain_map[center_voxel_index] = model_correlation_coef
 
-    return rsa_output_brain_map
+def _compute_rsa_sphere_value_array(
+    neural_rdm_array: np.ndarray,
+    model_rdm_array: np.ndarray,
+    model_rdm_dict: dict[str, np.ndarray],
+    partial_rsa_spec: PartialRSASpecDict | None,
+    regression_model_name_list: list[str] | None,
+    rdm_comparator: str,
+):
+    """(# of spheres) x (# of RSA maps) values in the order of get_rsa_map_name_list."""
+    # All models are compared to all spheres at once
+    rsa_sphere_value_array_list = [
+        _compute_neural_model_correlation(
+            neural_rdm_array, model_rdm_array, rdm_comparator
+        )
+    ]
+
+    if partial_rsa_spec is not None:
+        print(
+            f"Computing {partial_rsa_spec['mode']} RSA maps: covariates = {partial_rsa_spec['covariate']}"
+        )
+        rsa_sphere_value_array_list.append(
+            _compute_neural_model_partial_correlation(
+                neural_rdm_array,
+                np.stack([model_rdm_dict[name] for name in partial_rsa_spec["model"]]),
+                np.stack(
+                    [model_rdm_dict[name] for name in partial_rsa_spec["covariate"]]
+                ),
+                partial_rsa_spec["mode"],
+                rdm_comparator,
+            )
+        )
+
+    if regression_model_name_list is not None:
+        # All spheres share the design, so betas of all spheres are one product
+        print(f"Computing regression RSA beta maps: models = {regression_model_name_list}")
+        rsa_sphere_value_array_list.append(
+            fit_rdm_regression(
+                neural_rdm_array,
+                np.stack([model_rdm_dict[name] for name in regression_model_name_list]),
+            )
+        )
+
+    return np.hstack(rsa_sphere_value_array_list)
 
 
 def _save_and_blur_nifti_rsa_map(
@@ -111,35 +428,133 @@ def _save_and_blur_nifti_rsa_map(
     searchlight_radius: int,
     blur_kernel_width: int,
 ):
-    save_nifti(
-        brain_map,
-        template_nifti,
-        result_dir,
-        f"{subject_id}_{run_id}_task-photographer_{map_name}_rsa_correlation_map_rad{searchlight_radius}",
-    )
+    rsa_map_name = f"{subject_id}_{run_id}_task-photographer_{map_name}_rsa_correlation_map_rad{searchlight_radius}"
+
+    # This runs on a write-behind thread: AFNI programs get an explicit working
+    # directory, as the process-wide one moves on with the next subject (and
+    # nipype interfaces would change it)
+    save_nifti(brain_map, template_nifti, result_dir, rsa_map_name)
 
     # Modify qform/sform header to 4 (MNI space)
     try:
         subprocess.run(
-            f"nifti_tool -mod_hdr -overwrite -infiles {subject_id}_{run_id}_task-photographer_{map_name}_rsa_correlation_map_rad{searchlight_radius}.nii -mod_field qform_code 4 -mod_field sform_code 4",
+            f"nifti_tool -mod_hdr -overwrite -infiles {rsa_map_name}.nii -mod_field qform_code 4 -mod_field sform_code 4",
             shell=True,
+            cwd=result_dir,
         )
     except Exception as e:
         print(e)
         raise RuntimeError("Modification of the nifti header failed.")
 
-    merge = afni.Merge()
-    merge.inputs.in_files = [
-        f"{subject_id}_{run_id}_task-photographer_{map_name}_rsa_correlation_map_rad{searchlight_radius}.nii"
+    # Same as afni.Merge(blurfwhm=blur_kernel_width, doall=True)
+    try:
+        subprocess.run(
+            f"3dmerge -1blur_fwhm {blur_kernel_width} -doall -prefix {rsa_map_name}_blur{blur_kernel_width}.nii -overwrite {rsa_map_name}.nii",
+            shell=True,
+            check=True,
+            cwd=result_dir,
+        )
+    except Exception as e:
+        print(e)
+        raise RuntimeError(
+            f"Blurring of the RSA map failed: <{result_dir / rsa_map_name}.nii>"
+        )
+
+    print(f"Saved {map_name} RSA map (radius = {searchlight_radius}).")
+
+
+def _load_rsa_run_input(subject_run_id: tuple[str, str], config: ConfigDict):
+    """Read the inputs of one RSA run (on the prefetch I/O thread).
+
+    Feedback betas are read into the OS page cache, where the searchlight tile
+    workers find them. With --models-only, the cached neural RDMs are read into
+    memory instead, unless two runs of them do not fit in the memory budget
+    (then they stay memory-mapped). Returns the beta paths, the cached neural
+    RDMs (None without --models-only), and the model RDMs as a dictionary and
+    as a (# of models) x (# of condition pairs) array.
+    """
+    subject_id, rsa_run_id = subject_run_id
+    output_dir = Path(config["execution"]["output_dir"])
+    run_id_list = RUN_ID_LIST if rsa_run_id == CROSS_RUN_ID else [rsa_run_id]
+
+    # Check data paths
+    rsa_feedback_neural_data_path_list = [
+        output_dir
+        / subject_id
+        / "rsa_neural_data"
+        / "feedback_beta"
+        / f"{subject_id}_{run_id}_task-photographer_trial_feedback_norm_beta_array.npy"
+        for run_id in run_id_list
     ]
-    merge.inputs.blurfwhm = blur_kernel_width
-    merge.inputs.doall = True
-    merge.inputs.out_file = f"{subject_id}_{run_id}_task-photographer_{map_name}_rsa_correlation_map_rad{searchlight_radius}_blur{blur_kernel_width}.nii"
-    merge.inputs.args = "-overwrite"
-    merge.run()
+    for rsa_feedback_neural_data_path in rsa_feedback_neural_data_path_list:
+        if not rsa_feedback_neural_data_path.exists():
+            raise RuntimeError(
+                f'Feedback neural data numpy array not found: <{rsa_feedback_neural_data_path}>. Please run "rsa.prepare_feedback_neural_data" task first'
+            )
+
+    if config["execution"].get("models_only", False):
+        # Neural RDMs do not depend on the models
+        neural_rdm_distance = get_neural_rdm_distance(config)
+        mni_152_gm_mask_path = output_dir / "mask" / "mni_152_gm_mask_3mm.nii"
+        center_neural_rdm_list = [
+            load_neural_rdm_cache(
+                subject_id,
+                rsa_run_id,
+                neural_rdm_distance,
+                searchlight_radius,
+                [*rsa_feedback_neural_data_path_list, mni_152_gm_mask_path],
+                config,
+            )
+            for searchlight_radius in get_searchlight_radius_list(config)
+        ]
+
+        memory_budget = get_memory_budget(config)
+        neural_rdm_size = sum(rdm.nbytes for _, rdm in center_neural_rdm_list)
+        if memory_budget is None or 2 * neural_rdm_size <= memory_budget:
+            center_neural_rdm_list = [
+                (center_voxel_index_array, np.array(rsa_feedback_neural_rdm_array))
+                for (
+                    center_voxel_index_array,
+                    rsa_feedback_neural_rdm_array,
+                ) in center_neural_rdm_list
+            ]
+    else:
+        center_neural_rdm_list = None
+        for rsa_feedback_neural_data_path in rsa_feedback_neural_data_path_list:
+            read_into_page_cache(rsa_feedback_neural_data_path)
+
+    # Load model data
+    try:
+        rsa_feedback_model_rdm_dict = load_feedback_model_rdm(
+            subject_id, rsa_run_id, config
+        )
+        # (# of models) x (# of condition pairs)
+        rsa_feedback_model_rdm_array = np.stack(
+            [
+                rsa_feedback_model_rdm_dict[rsa_model_name]
+                for rsa_model_name in get_model_rdm_name_list(config)
+            ]
+        )
+    except (RuntimeError, KeyError) as e:
+        print(e)
+        raise RuntimeError(
+            f'Cannot load feedback model RDMs for {subject_id} {rsa_run_id}. Please run "rsa.prepare_feedback_model_rdm" task first.'
+        )
 
+    return (
+        rsa_feedback_neural_data_path_list,
+        center_neural_rdm_list,
+        rsa_feedback_model_rdm_dict,
+        rsa_feedback_model_rdm_array,
+    )
 
-def _perform_individual_rsa(subject_id: str, config: ConfigDict):
+
+def _perform_individual_rsa(
+    subject_id: str,
+    config: ConfigDict,
+    rsa_run_input_iter: Iterator,
+    submit_write: Callable,
+):
     gc.collect()
 
     print(subject_id)
@@ -147,10 +562,6 @@ def _perform_individual_rsa(subject_id: str, config: ConfigDict):
     output_dir = Path(config["execution"]["output_dir"])
     assert output_dir.exists(), f"Output directory is not found: <{output_dir}>"
 
-    rsa_model_rdm_dir = output_dir / subject_id / "rsa_model_rdm"
-    if not rsa_model_rdm_dir.exists():
-        raise RuntimeError(f"Model RDM directory not found: <{rsa_model_rdm_dir}>")
-
     rsa_neural_data_dir = output_dir / subject_id / "rsa_neural_data"
     if not rsa_neural_data_dir.exists():
         raise RuntimeError(f"Neural data directory not found: <{rsa_neural_data_dir}>")
@@ -193,75 +604,88 @@ def _perform_individual_rsa(subject_id: str, config: ConfigDict):
 
     os.chdir(rsa_result_dir)
 
-    rsa_feedback_model_name_list = [
-        "current_trial",
-        "one_back_trial",
-        "two_back_trial",
-        "recent_2_trial",
-        "recent_3_trial",
-        "previous_2_trial",
-    ]
-    run_id_list = ["run-01", "run-02", "run-03", "run-04", "run-05"]
-
-    for run_id in run_id_list:
-        # Check data paths
-        rsa_feedback_neural_data_path = (
-            rsa_neural_data_dir
-            / "feedback_beta"
-            / f"{subject_id}_{run_id}_task-photographer_trial_feedback_norm_beta_array.npy"
-        )
-        if not rsa_feedback_neural_data_path.exists():
-            raise RuntimeError(
-                f'Feedback neural data numpy array not found: <{rsa_feedback_neural_data_path}>. Please run "rsa.prepare_feedback_neural_data" task first'
-            )
+    rsa_partial_spec = get_partial_rsa_spec(config)
+    rsa_regression_model_name_list = get_regression_rsa_model_name_list(config)
+    rsa_map_name_list = get_rsa_map_name_list(config)
+    n_plain_rsa_maps = len(get_model_rdm_name_list(config))  # first in rsa_map_name_list
+    neural_rdm_distance = get_neural_rdm_distance(config)
+    rdm_comparator = get_rdm_comparator(config)
+    searchlight_radius_list = get_searchlight_radius_list(config)
+    searchlight_stride = config["execution"].get("searchlight_stride") or 1
+    searchlight_refine_threshold = config["execution"].get(
+        "searchlight_refine_threshold"
+    )
+    searchlight_tile_depth = (
+        config["execution"]["rsa"].get("searchlight_tile_depth") or DEFAULT_TILE_DEPTH
+    )
 
-        # Load neural/model data
-        try:
-            rsa_trial_feedback_norm_beta_array = np.load(rsa_feedback_neural_data_path)
-        except IOError:
-            raise RuntimeError(
-                f"Cannot load trial_feedback_norm_beta_array.npy: <{rsa_feedback_neural_data_path}>"
-            )
+    # Every mask voxel is a center, or every `stride` voxels (--searchlight-stride)
+    searchlight_center_mask_array = get_strided_center_mask(
+        mni_152_gm_mask_image.data, searchlight_stride
+    )
 
-        rsa_feedback_model_vector_list = []
-        try:
-            for rsa_model_name in rsa_feedback_model_name_list:
-                rsa_model_array = _load_rdm_from_numpy(
-                    rsa_model_rdm_dir,
-                    "feedback_model",
-                    subject_id,
-                    run_id,
-                    rsa_model_name,
-                )
-                rsa_feedback_model_vector_list.append(rsa_model_array)
-        except RuntimeError as e:
-            print(e)
-            raise RuntimeError(
-                f'Cannot load feedback model RDM: {rsa_model_name} for {subject_id}. Please run "rsa.prepare_feedback_model_rdm" task first.'
+    # Each run, or all runs at once in the cross-run mode
+    for rsa_run_id in get_rsa_run_id_list(config):
+        run_id_list = RUN_ID_LIST if rsa_run_id == CROSS_RUN_ID else [rsa_run_id]
+
+        # Inputs of this run, read ahead while the previous run was computed
+        prefetched_subject_run_id, (
+            rsa_feedback_neural_data_path_list,
+            center_neural_rdm_list,
+            rsa_feedback_model_rdm_dict,
+            rsa_feedback_model_rdm_array,
+        ) = next(rsa_run_input_iter)
+        assert prefetched_subject_run_id == (
+            subject_id,
+            rsa_run_id,
+        ), f"Prefetched RSA inputs out of order: {prefetched_subject_run_id}"
+
+        if center_neural_rdm_list is not None:
+            print(
+                f"Loaded cached neural RDMs: shape = {[rdm.shape for _, rdm in center_neural_rdm_list]}"
             )
-
-        # compute neural searchlight sphere list
-        searchlight_radius = (
-            config["execution"]["rsa"]["searchlight_radius"]
-            if config["execution"]["rsa"]["searchlight_radius"]
-            else 3
-        )
-        searchlight = Searchlight(searchlight_radius)
-        rsa_feedback_neural_searchlight_sphere_list = [
-            inform
-            for inform in searchlight.analysis(
-                data=rsa_trial_feedback_norm_beta_array, mask=mni_152_gm_mask_image.data
+        else:
+            # compute neural RDMs of all searchlight spheres of all radii, tile by tile
+            center_neural_rdm_list = _compute_neural_rdm_array(
+                rsa_feedback_neural_data_path_list,
+                searchlight_center_mask_array,
+                searchlight_radius_list,
+                len(run_id_list),
+                neural_rdm_distance,
+                searchlight_tile_depth,
+                get_memory_budget(config),
+            )
+            print(
+                f"Computed neural RDMs: shape = {[rdm.shape for _, rdm in center_neural_rdm_list]}"
             )
-        ]
-        print(f"Computed neural searchlight sphere list: radius = {searchlight_radius}")
 
-        # compute neural RDM sphere list
-        rsa_feedback_neural_rdm_sphere_list = _generate_neural_rdm_sphere_list(
-            rsa_feedback_neural_searchlight_sphere_list
-        )
-        print(
-            f"Computed neural RDM sphere list: shape = {rsa_feedback_neural_rdm_sphere_list[0][1].shape}"
-        )
+            # Persist full-resolution neural RDMs for --models-only reruns (written
+            # behind), and compare the same float32 neural RDMs to the models
+            if searchlight_stride == 1:
+                center_neural_rdm_list = [
+                    (
+                        center_voxel_index_array,
+                        rsa_feedback_neural_rdm_array.astype(np.float32),
+                    )
+                    for (
+                        center_voxel_index_array,
+                        rsa_feedback_neural_rdm_array,
+                    ) in center_neural_rdm_list
+                ]
+                for searchlight_radius, (
+                    center_voxel_index_array,
+                    rsa_feedback_neural_rdm_array,
+                ) in zip(searchlight_radius_list, center_neural_rdm_list):
+                    submit_write(
+                        save_neural_rdm_cache,
+                        center_voxel_index_array,
+                        rsa_feedback_neural_rdm_array,
+                        subject_id,
+                        rsa_run_id,
+                        neural_rdm_distance,
+                        searchlight_radius,
+                        config,
+                    )
 
         # perform actual RSA
         blur_kernel_width = (
@@ -269,59 +693,116 @@ def _perform_individual_rsa(subject_id: str, config: ConfigDict):
             if config["execution"]["rsa"]["rsa_blur_kernel_width"]
             else 6
         )
-        for rsa_feedback_model_name, rsa_feedback_model_vector in zip(
-            rsa_feedback_model_name_list, rsa_feedback_model_vector_list
-        ):
-            print(f"Computing {rsa_feedback_model_name} RSA map")
-            rsa_brain_map = _compute_neural_model_correlation_map(
-                rsa_feedback_neural_rdm_sphere_list,
-                rsa_feedback_model_vector,
+        for searchlight_radius, (
+            center_voxel_index_array,
+            rsa_feedback_neural_rdm_array,
+        ) in zip(searchlight_radius_list, center_neural_rdm_list):
+            print(f"Computing RSA maps (radius = {searchlight_radius})")
+            rsa_brain_map_array = _scatter_sphere_value_array(
+                _compute_rsa_sphere_value_array(
+                    rsa_feedback_neural_rdm_array,
+                    rsa_feedback_model_rdm_array,
+                    rsa_feedback_model_rdm_dict,
+                    rsa_partial_spec,
+                    rsa_regression_model_name_list,
+                    rdm_comparator,
+                ),
+                center_voxel_index_array,
                 mni_152_gm_mask_image.dim,
             )
 
-            _save_and_blur_nifti_rsa_map(
-                rsa_brain_map,
-                mni_152_gm_mask_image,
-                rsa_result_dir,
-                subject_id,
-                run_id,
-                f"{rsa_feedback_model_name}",
-                searchlight_radius,
-                blur_kernel_width,
-            )
+            if searchlight_stride > 1:
+                rsa_brain_map_array = fill_from_nearest_center(
+                    rsa_brain_map_array,
+                    center_voxel_index_array,
+                    mni_152_gm_mask_image.data,
+                )
 
-            print(f"Saved {rsa_feedback_model_name} RSA map.")
+            if searchlight_stride > 1 and searchlight_refine_threshold is not None:
+                # Full-resolution spheres where any coarse plain RSA map (Fisher z)
+                # reaches the threshold in either direction; partial and regression
+                # beta maps are on other scales, so they do not trigger refinement
+                refine_center_mask_array = mni_152_gm_mask_image.data.astype(
+                    bool
+                ) & np.any(
+                    np.abs(rsa_brain_map_array[:n_plain_rsa_maps])
+                    >= searchlight_refine_threshold,
+                    axis=0,
+                )
+                refine_center_mask_array[tuple(center_voxel_index_array.T)] = False
+                print(
+                    f"Refining RSA maps: threshold = {searchlight_refine_threshold}, # of voxels = {refine_center_mask_array.sum()}"
+                )
+                if refine_center_mask_array.any():
+                    refine_center_voxel_index_array, refine_neural_rdm_array = (
+                        _compute_neural_rdm_array(
+                            rsa_feedback_neural_data_path_list,
+                            refine_center_mask_array,
+                            [searchlight_radius],
+                            len(run_id_list),
+                            neural_rdm_distance,
+                            searchlight_tile_depth,
+                            get_memory_budget(config),
+                        )[0]
+                    )
+
+                    rsa_brain_map_array[:, refine_center_mask_array] = 0
+                    rsa_brain_map_array[
+                        (slice(None), *refine_center_voxel_index_array.T)
+                    ] = _compute_rsa_sphere_value_array(
+                        refine_neural_rdm_array,
+                        rsa_feedback_model_rdm_array,
+                        rsa_feedback_model_rdm_dict,
+                        rsa_partial_spec,
+                        rsa_regression_model_name_list,
+                        rdm_comparator,
+                    ).T
+
+            for rsa_map_name, rsa_brain_map in zip(
+                rsa_map_name_list, rsa_brain_map_array
+            ):
+                # Exploratory (strided) maps are not picked up by stat.* tasks
+                if searchlight_stride > 1:
+                    rsa_map_name = f"{rsa_map_name}_stride{searchlight_stride}"
+
+                # Saved and blurred behind, while the next maps are computed
+                submit_write(
+                    _save_and_blur_nifti_rsa_map,
+                    rsa_brain_map,
+                    mni_152_gm_mask_image,
+                    rsa_result_dir,
+                    subject_id,
+                    rsa_run_id,
+                    rsa_map_name,
+                    searchlight_radius,
+                    blur_kernel_width,
+                )
 
 
 def run_feedback_rsa(config: ConfigDict):
-    fmriprep_output_dir = get_fmriprep_output_dir(config)
+    subject_list = get_subject_list(config)
 
-    # Check subject_exclusion.json present
-    try:
-        subject_exclusion_dict = read_subject_exclusion(config)
-    except RuntimeError as e:
-        print(e)
-        raise RuntimeError(
-            'subject_exclusion.json should be present. Please run both "glm.prepare_task_stim" and "glm.prepare_confound" tasks first.'
-        )
-
-    subject_list = [
-        child.stem
-        for child in fmriprep_output_dir.iterdir()
-        if child.is_dir()
-        and "sub-" in child.stem
-        and child.stem not in subject_exclusion_dict.keys()
-    ]
-
-    if config["execution"]["participant_label"] is not None:
-        subject_list = [
-            child
-            for child in subject_list
-            if child[4:] in config["execution"]["participant_label"]
-        ]
+    subject_list = select_shard_subjects(subject_list, config)
 
     print(f"Subjects to be processed: {subject_list}")
 
-    for subject_id in subject_list:
-        _perform_individual_rsa(subject_id, config)
-        time.sleep(2)
+    # Inputs of the next run (or the next subject's first run) are read while a
+    # run is computed, and outputs are written behind (flushed before the shard
+    # is marked complete)
+    with closing(
+        prefetch(
+            partial(_load_rsa_run_input, config=config),
+            [
+                (subject_id, rsa_run_id)
+                for subject_id in subject_list
+                for rsa_run_id in get_rsa_run_id_list(config)
+            ],
+        )
+    ) as rsa_run_input_iter, write_behind() as submit_write:
+        for subject_id in subject_list:
+            _perform_individual_rsa(
+                subject_id, config, rsa_run_input_iter, submit_write
+            )
+            time.sleep(2)
+
+    mark_shard_complete(subject_list, config)
@@ -0,0 +1,276 @@
+from .rdm import RDM_COMPARATOR_DICT, RDM_DISTANCE_KERNEL_DICT
+from ..utils.types import ConfigDict, ModelRDMSpecDict, PartialRSASpecDict
+
+N_HISTORY_TRIALS = 2  # up to 2-back trials -> trial 3 to 8 are used (6 conditions)
+
+RUN_ID_LIST = ["run-01", "run-02", "run-03", "run-04", "run-05"]
+
+CROSS_RUN_ID = "cross-run"  # Run ID of RDMs/RSA maps over all runs (rsa.cross_run)
+
+DEFAULT_SEARCHLIGHT_RADIUS = 3  # voxels
+
+# pdist-equivalent distances of run-wise (or cross-run) patterns
+NEURAL_RDM_DISTANCE_LIST = [*RDM_DISTANCE_KERNEL_DICT]
+
+RDM_COMPARATOR_LIST = [*RDM_COMPARATOR_DICT]  # rho_a (default), pearson, tau_a, cosine
+
+MODEL_RDM_METRIC_LIST = [
+    "euclidean",
+    "sqeuclidean",
+    "cityblock",
+    "chebyshev",
+    "haversine",  # great-circle distance (km) between [latitude, longitude] features
+]
+
+PARTIAL_RSA_MODE_LIST = [
+    "partial",  # covariates are regressed out of both neural and model RDMs
+    "semipartial",  # covariates are regressed out of model RDMs only
+]
+
+# Used if no [[rsa.model_rdm]] is specified in the config file
+DEFAULT_MODEL_RDM_SPEC_LIST = [
+    {"name": "current_trial", "feature": "feedback_score", "lags": [0]},
+    {"name": "one_back_trial", "feature": "feedback_score", "lags": [1]},
+    {"name": "two_back_trial", "feature": "feedback_score", "lags": [2]},
+    {"name": "recent_2_trial", "feature": "feedback_score", "window": 2},
+    {"name": "recent_3_trial", "feature": "feedback_score", "window": 3},
+    {"name": "previous_2_trial", "feature": "feedback_score", "lags": [1, 2]},
+]
+
+# Added to the defaults if `rsa.exploration_info_path` is specified
+DEFAULT_EXPLORATION_MODEL_RDM_SPEC_LIST = [
+    {"name": "exploration_time", "feature": "exploration_time", "lags": [0]},
+    {"name": "exploration_distance", "feature": "exploration_distance", "lags": [0]},
+    {
+        "name": "capture_distance",
+        "feature": ["capture_lat", "capture_lon"],
+        "lags": [0],
+        "metric": "haversine",
+    },
+]
+
+
+def _parse_model_rdm_spec(model_rdm_spec: dict):
+    name = model_rdm_spec.get("name")
+    if not isinstance(name, str) or not name:
+        raise RuntimeError(f"Model RDM spec without a name: {model_rdm_spec}")
+
+    if "lags" in model_rdm_spec and "window" in model_rdm_spec:
+        raise RuntimeError(
+            f'Model RDM spec "{name}" should have either "lags" or "window", not both.'
+        )
+
+    if "window" in model_rdm_spec:
+        lag_list = list(range(int(model_rdm_spec["window"])))
+    else:
+        lag_list = [int(lag) for lag in model_rdm_spec.get("lags", [0])]
+
+    if not lag_list or any(
+        lag < 0 or lag > N_HISTORY_TRIALS for lag in lag_list
+    ):
+        raise RuntimeError(
+            f'Lags of model RDM spec "{name}" should be within 0 - {N_HISTORY_TRIALS}: {lag_list}'
+        )
+
+    metric = model_rdm_spec.get("metric", "euclidean")
+    if metric not in MODEL_RDM_METRIC_LIST:
+        raise RuntimeError(
+            f'Unsupported metric of model RDM spec "{name}": {metric} (supported: {MODEL_RDM_METRIC_LIST})'
+        )
+
+    feature_list = model_rdm_spec.get("feature", "feedback_score")
+    if isinstance(feature_list, str):
+        feature_list = [feature_list]
+
+    if metric == "haversine" and (len(feature_list) != 2 or len(set(lag_list)) != 1):
+        raise RuntimeError(
+            f'Haversine model RDM spec "{name}" should have [latitude, longitude] features of a single lag.'
+        )
+
+    return ModelRDMSpecDict(
+        name=name,
+        feature=list(feature_list),
+        lags=sorted(set(lag_list)),
+        metric=metric,
+    )
+
+
+def get_model_rdm_spec_list(config: ConfigDict):
+    """Model RDM specs from [[rsa.model_rdm]] of the config file.
+
+    Each spec compares trials by `feature` (column(s) of the behavior feedback CSV
+    or the exploration info CSV) of the trials `lags` back (0 = current trial) with
+    `metric`. `window = k` is a shorthand for `lags = [0, ..., k - 1]`.
+    """
+    default_model_rdm_spec_list = DEFAULT_MODEL_RDM_SPEC_LIST
+    if config["execution"]["rsa"].get("exploration_info_path") is not None:
+        default_model_rdm_spec_list = (
+            DEFAULT_MODEL_RDM_SPEC_LIST + DEFAULT_EXPLORATION_MODEL_RDM_SPEC_LIST
+        )
+
+    model_rdm_spec_list = [
+        _parse_model_rdm_spec(model_rdm_spec)
+        for model_rdm_spec in config["execution"]["rsa"].get(
+            "model_rdm", default_model_rdm_spec_list
+        )
+    ]
+
+    model_name_list = [spec["name"] for spec in model_rdm_spec_list]
+    duplicated_model_name_list = sorted(
+        {name for name in model_name_list if model_name_list.count(name) > 1}
+    )
+    if duplicated_model_name_list:
+        raise RuntimeError(f"Duplicated model RDM names: {duplicated_model_name_list}")
+
+    return model_rdm_spec_list
+
+
+def get_model_rdm_name_list(config: ConfigDict):
+    return [spec["name"] for spec in get_model_rdm_spec_list(config)]
+
+
+def get_partial_rsa_spec(config: ConfigDict):
+    """Partial RSA spec from [rsa.partial_rsa] of the config file (None if absent).
+
+    Model RDMs other than `covariate` are compared after regressing out the
+    covariate model RDMs from both the neural and model RDMs ("partial") or from
+    the model RDMs only ("semipartial").
+    """
+    partial_rsa_spec = config["execution"]["rsa"].get("partial_rsa")
+    if not partial_rsa_spec:
+        return None
+
+    covariate_name_list = partial_rsa_spec.get("covariate", [])
+    if isinstance(covariate_name_list, str):
+        covariate_name_list = [covariate_name_list]
+
+    model_name_list = get_model_rdm_name_list(config)
+    unknown_covariate_name_list = [
+        name for name in covariate_name_list if name not in model_name_list
+    ]
+    if not covariate_name_list or unknown_covariate_name_list:
+        raise RuntimeError(
+            f"Covariates of the partial RSA should be some of the model RDMs {model_name_list}: {covariate_name_list}"
+        )
+
+    mode = partial_rsa_spec.get("mode", "partial")
+    if mode not in PARTIAL_RSA_MODE_LIST:
+        raise RuntimeError(
+            f"Unsupported partial RSA mode: {mode} (supported: {PARTIAL_RSA_MODE_LIST})"
+        )
+
+    return PartialRSASpecDict(
+        covariate=list(covariate_name_list),
+        model=[name for name in model_name_list if name not in covariate_name_list],
+        mode=mode,
+    )
+
+
+def get_regression_rsa_model_name_list(config: ConfigDict):
+    """Model RDM names jointly fitted by the regression RSA ([rsa.regression_rsa]).
+
+    Returns None if the regression RSA is not requested.
+    """
+    regression_rsa_spec = config["execution"]["rsa"].get("regression_rsa")
+    if not regression_rsa_spec:
+        return None
+
+    regression_model_name_list = regression_rsa_spec.get("model", [])
+    if isinstance(regression_model_name_list, str):
+        regression_model_name_list = [regression_model_name_list]
+    model_name_list = get_model_rdm_name_list(config)
+    if (
+        len(regression_model_name_list) < 1
+        or len(set(regression_model_name_list)) != len(regression_model_name_list)
+        or any(name not in model_name_list for name in regression_model_name_list)
+    ):
+        raise RuntimeError(
+            f"Models of the regression RSA should be distinct model RDMs of {model_name_list}: {regression_model_name_list}"
+        )
+
+    return list(regression_model_name_list)
+
+
+def get_rsa_map_name_list(config: ConfigDict):
+    """Names of all RSA maps written by rsa.run_feedback_rsa."""
+    rsa_map_name_list = get_model_rdm_name_list(config)
+
+    partial_rsa_spec = get_partial_rsa_spec(config)
+    if partial_rsa_spec is not None:
+        rsa_map_name_list += [
+            f"{model_name}_{partial_rsa_spec['mode']}"
+            for model_name in partial_rsa_spec["model"]
+        ]
+
+    regression_model_name_list = get_regression_rsa_model_name_list(config)
+    if regression_model_name_list is not None:
+        rsa_map_name_list += [
+            f"{model_name}_regression_beta" for model_name in regression_model_name_list
+        ]
+
+    return rsa_map_name_list
+
+
+def is_cross_run_rsa(config: ConfigDict):
+    return bool(config["execution"]["rsa"].get("cross_run", False))
+
+
+def get_neural_rdm_distance(config: ConfigDict):
+    neural_rdm_distance = config["execution"]["rsa"].get(
+        "neural_rdm_distance", "correlation"
+    )
+    if neural_rdm_distance == "crossnobis":
+        # Each run is a different city with different trials, so no condition is
+        # repeated across runs (or within a run) to cross-validate over
+        raise RuntimeError(
+            "The crossnobis distance needs repeated estimates of the same conditions, but every trial is measured once. Please use another neural_rdm_distance in the [rsa] section of the config file."
+        )
+
+    if neural_rdm_distance not in NEURAL_RDM_DISTANCE_LIST:
+        raise RuntimeError(
+            f"Unsupported neural RDM distance: {neural_rdm_distance} (supported: {NEURAL_RDM_DISTANCE_LIST})"
+        )
+
+    return neural_rdm_distance
+
+
+def get_rdm_comparator(config: ConfigDict):
+    rdm_comparator = config["execution"]["rsa"].get("rdm_comparator", "rho_a")
+    if rdm_comparator not in RDM_COMPARATOR_LIST:
+        raise RuntimeError(
+            f"Unsupported RDM comparator: {rdm_comparator} (supported: {RDM_COMPARATOR_LIST})"
+        )
+
+    return rdm_comparator
+
+
+def get_rsa_run_id_list(config: ConfigDict):
+    """Run IDs of RSA maps: each run, or CROSS_RUN_ID if `rsa.cross_run` is set."""
+    return [CROSS_RUN_ID] if is_cross_run_rsa(config) else RUN_ID_LIST
+
+
+def get_rsa_map_summary_name(config: ConfigDict):
+    """Name of the subject-level RSA map tested by stat.* tasks: the mean of the
+    run-wise maps, or the cross-run map (CROSS_RUN_ID) as it is."""
+    if get_rsa_run_id_list(config) == [CROSS_RUN_ID]:
+        return "cross_run"
+    return "within_run_mean"
+
+
+def get_searchlight_radius_list(config: ConfigDict):
+    """Searchlight radii (ascending) from `rsa.searchlight_radius` (an int or a list
+    of ints; default: 3). All radii are computed in one pass over the data."""
+    searchlight_radius = config["execution"]["rsa"].get("searchlight_radius")
+    if not searchlight_radius:
+        return [DEFAULT_SEARCHLIGHT_RADIUS]
+
+    radius_list = (
+        searchlight_radius if isinstance(searchlight_radius, list) else [searchlight_radius]
+    )
+    for radius in radius_list:
+        if not isinstance(radius, int) or isinstance(radius, bool) or radius < 1:
+            raise RuntimeError(
+                f"Searchlight radius should be a positive integer (or a list of them): {searchlight_radius}"
+            )
+
+    return sorted(set(radius_list))
@@ -0,0 +1,109 @@
+import os
+from pathlib import Path
+
+import numpy as np
+
+from ..utils.types import ConfigDict
+
+
+def _get_neural_rdm_cache_path(
+    subject_id: str,
+    rsa_run_id: str,
+    neural_rdm_distance: str,
+    searchlight_radius: int,
+    config: ConfigDict,
+):
+    return (
+        Path(config["execution"]["output_dir"])
+        / subject_id
+        / "rsa_neural_rdm"
+        / f"{subject_id}_{rsa_run_id}_task-photographer_{neural_rdm_distance}_neural_rdm_rad{searchlight_radius}.npy"
+    )
+
+
+def _get_center_voxel_index_path(neural_rdm_cache_path: Path):
+    return neural_rdm_cache_path.with_name(
+        f"{neural_rdm_cache_path.stem}_center_index.npy"
+    )
+
+
+def _load_neural_rdm_cache(neural_rdm_cache_path: Path):
+    center_voxel_index_path = _get_center_voxel_index_path(neural_rdm_cache_path)
+    try:
+        center_voxel_index_array = np.load(center_voxel_index_path)
+        neural_rdm_array = np.load(neural_rdm_cache_path, mmap_mode="r")
+    except (IOError, ValueError):
+        raise RuntimeError(f"Cannot load neural RDM cache: <{neural_rdm_cache_path}>")
+
+    if len(center_voxel_index_array) != len(neural_rdm_array):
+        raise RuntimeError(
+            f"Neural RDM cache does not match its center index: <{neural_rdm_cache_path}>"
+        )
+
+    return center_voxel_index_array, neural_rdm_array
+
+
+def save_neural_rdm_cache(
+    center_voxel_index_array: np.ndarray,
+    neural_rdm_array: np.ndarray,
+    subject_id: str,
+    rsa_run_id: str,
+    neural_rdm_distance: str,
+    searchlight_radius: int,
+    config: ConfigDict,
+):
+    """Persist (# of spheres) x (# of pairs) neural RDMs (float32) and center indices.
+
+    Full runs should compare the float32 neural RDMs to the models, so that
+    --models-only runs on the cache give the same maps.
+    """
+    neural_rdm_cache_path = _get_neural_rdm_cache_path(
+        subject_id, rsa_run_id, neural_rdm_distance, searchlight_radius, config
+    )
+
+    try:
+        os.makedirs(neural_rdm_cache_path.parent, exist_ok=True)
+
+        # The RDM file is written last, so its mtime marks a complete cache
+        for path, array in [
+            (
+                _get_center_voxel_index_path(neural_rdm_cache_path),
+                center_voxel_index_array.astype(np.int16),
+            ),
+            (neural_rdm_cache_path, neural_rdm_array.astype(np.float32, copy=False)),
+        ]:
+            tmp_path = path.with_suffix(f".{os.getpid()}.npy")
+            np.save(tmp_path, array)
+            os.replace(tmp_path, path)
+    except OSError:
+        raise RuntimeError(f"Cannot write neural RDM cache: <{neural_rdm_cache_path}>")
+
+
+def load_neural_rdm_cache(
+    subject_id: str,
+    rsa_run_id: str,
+    neural_rdm_distance: str,
+    searchlight_radius: int,
+    input_path_list: list[Path],
+    config: ConfigDict,
+):
+    """Load memory-mapped neural RDMs saved by save_neural_rdm_cache.
+
+    The cache should be newer than all of its inputs (beta arrays and the mask).
+    """
+    neural_rdm_cache_path = _get_neural_rdm_cache_path(
+        subject_id, rsa_run_id, neural_rdm_distance, searchlight_radius, config
+    )
+    if not neural_rdm_cache_path.exists():
+        raise RuntimeError(
+            f'Neural RDM cache not found: <{neural_rdm_cache_path}>. Please run "rsa.run_feedback_rsa" without --models-only first.'
+        )
+
+    cache_mtime_ns = neural_rdm_cache_path.stat().st_mtime_ns
+    for input_path in input_path_list:
+        if input_path.stat().st_mtime_ns > cache_mtime_ns:
+            raise RuntimeError(
+                f'Neural RDM cache is older than <{input_path}>: <{neural_rdm_cache_path}>. Please run "rsa.run_feedback_rsa" without --models-only.'
+            )
+
+    return _load_neural_rdm_cache(neural_rdm_cache_path)
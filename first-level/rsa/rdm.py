@@ -0,0 +1,254 @@
+import numpy as np
+from scipy.stats import rankdata
+
+
+def get_rdm_pair_index(n_runs: int, n_conditions: int):
+    """Condition pairs of RDM vectors over (# of runs) x (# of conditions) conditions.
+
+    Conditions are ordered run by run. With a single run, all pairs are returned
+    in the pair order of scipy.spatial.distance.pdist. With multiple runs, only
+    between-run pairs are kept (within-run pairs share the run-specific noise).
+    """
+    pair_index_1, pair_index_2 = np.triu_indices(n_runs * n_conditions, k=1)
+    if n_runs > 1:
+        between_run_mask = (pair_index_1 // n_conditions) != (
+            pair_index_2 // n_conditions
+        )
+        pair_index_1 = pair_index_1[between_run_mask]
+        pair_index_2 = pair_index_2[between_run_mask]
+    return pair_index_1, pair_index_2
+
+
+def _cosine_distance_from_gram(
+    gram_array: np.ndarray, pair_index: tuple[np.ndarray, np.ndarray]
+):
+    pair_index_1, pair_index_2 = pair_index
+    norm_array = np.sqrt(np.diagonal(gram_array, axis1=-2, axis2=-1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rdm_array = 1.0 - gram_array[..., pair_index_1, pair_index_2] / (
+            norm_array[..., pair_index_1] * norm_array[..., pair_index_2]
+        )
+    # correlation distances can be nan!
+    return np.clip(np.nan_to_num(rdm_array, nan=1.0), 0.0, 2.0)
+
+
+def _sqeuclidean_distance_from_gram(
+    gram_array: np.ndarray, pair_index: tuple[np.ndarray, np.ndarray]
+):
+    pair_index_1, pair_index_2 = pair_index
+    return np.maximum(
+        gram_array[..., pair_index_1, pair_index_1]
+        + gram_array[..., pair_index_2, pair_index_2]
+        - 2 * gram_array[..., pair_index_1, pair_index_2],
+        0.0,
+    )
+
+
+def _euclidean_distance_from_gram(
+    gram_array: np.ndarray, pair_index: tuple[np.ndarray, np.ndarray]
+):
+    return np.sqrt(_sqeuclidean_distance_from_gram(gram_array, pair_index))
+
+
+# Distance -> (whether patterns are centered across voxels, Gram matrix -> RDM kernel)
+# Same as scipy.spatial.distance.pdist(pattern, distance) (NaN -> 1.0)
+RDM_DISTANCE_KERNEL_DICT = {
+    "correlation": (True, _cosine_distance_from_gram),
+    "cosine": (False, _cosine_distance_from_gram),
+    "euclidean": (False, _euclidean_distance_from_gram),
+    "sqeuclidean": (False, _sqeuclidean_distance_from_gram),
+}
+
+
+def compute_rdm(
+    pattern_array: np.ndarray,
+    distance: str = "correlation",
+    pair_index: tuple[np.ndarray, np.ndarray] = None,
+):
+    """RDMs of (...) x (# of conditions) x (# of voxels) patterns.
+
+    All distances of RDM_DISTANCE_KERNEL_DICT are computed from the condition x
+    condition Gram matrices (one batched GEMM). Returns a (...) x (# of
+    condition pairs) array of `pair_index` (default: all pairs).
+    """
+    if pair_index is None:
+        pair_index = np.triu_indices(pattern_array.shape[-2], k=1)
+
+    is_centered, distance_kernel = RDM_DISTANCE_KERNEL_DICT[distance]
+    if is_centered:
+        pattern_array = pattern_array - pattern_array.mean(axis=-1, keepdims=True)
+
+    gram_array = np.matmul(pattern_array, np.swapaxes(pattern_array, -1, -2))
+    return distance_kernel(gram_array, pair_index)
+
+
+def _rank_rdm(rdm_array: np.ndarray):
+    rank_array = rankdata(rdm_array, axis=-1)
+    return rank_array - rank_array.mean(axis=-1, keepdims=True)
+
+
+def _normalize_rdm(rdm_array: np.ndarray):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        normalized_rdm_array = rdm_array / np.linalg.norm(
+            rdm_array, axis=-1, keepdims=True
+        )
+    return np.nan_to_num(normalized_rdm_array, nan=0.0)  # zero-length RDMs -> 0
+
+
+def compare_rho_a(rdm_array: np.ndarray, model_rdm_array: np.ndarray):
+    """Rank-correlation (Spearman rho-a) between all RDMs and model RDMs.
+
+    Same as rsatoolbox.rdm.compare_rho_a, but (...) x (# of RDMs) x (# of pairs)
+    RDMs are compared to (...) x (# of models) x (# of pairs) model RDMs in one
+    (batched) GEMM. Returns a (...) x (# of RDMs) x (# of models) array.
+    """
+    n_pairs = rdm_array.shape[-1]
+    return (
+        np.matmul(
+            _rank_rdm(rdm_array), np.swapaxes(_rank_rdm(model_rdm_array), -1, -2)
+        )
+        / (n_pairs**3 - n_pairs)
+        * 12
+    )
+
+
+def compare_pearson(rdm_array: np.ndarray, model_rdm_array: np.ndarray):
+    """Pearson correlation (rsatoolbox.rdm.compare_correlation), batched like compare_rho_a."""
+    return np.matmul(
+        _normalize_rdm(rdm_array - rdm_array.mean(axis=-1, keepdims=True)),
+        np.swapaxes(
+            _normalize_rdm(
+                model_rdm_array - model_rdm_array.mean(axis=-1, keepdims=True)
+            ),
+            -1,
+            -2,
+        ),
+    )
+
+
+def compare_cosine(rdm_array: np.ndarray, model_rdm_array: np.ndarray):
+    """Cosine similarity (rsatoolbox.rdm.compare_cosine), batched like compare_rho_a."""
+    return np.matmul(
+        _normalize_rdm(rdm_array), np.swapaxes(_normalize_rdm(model_rdm_array), -1, -2)
+    )
+
+
+def compare_tau_a(
+    rdm_array: np.ndarray, model_rdm_array: np.ndarray, chunk_size: int = 1024
+):
+    """Kendall tau-a (rsatoolbox.rdm.compare_kendall_tau_a), batched like compare_rho_a.
+
+    sum(sign(x_a - x_b) * sign(y_a - y_b)) over entry pairs a < b is (# of
+    concordant - # of discordant) pairs. For each entry a, the signs against all
+    later entries of all RDMs are compared to those of the models in one GEMM,
+    so there is no per-RDM Python call. Ranks (exact in float32) replace the
+    values, and RDMs are processed in chunks to bound the memory.
+    """
+    n_pairs = rdm_array.shape[-1]
+    rank_array = rankdata(rdm_array, axis=-1, method="min").astype(np.float32)
+    model_rank_array = rankdata(model_rdm_array, axis=-1, method="min").astype(
+        np.float32
+    )
+
+    tau_a_array = np.empty((*rdm_array.shape[:-1], model_rdm_array.shape[-2]))
+    for start in range(0, rdm_array.shape[-2], chunk_size):
+        chunk_rank_array = rank_array[..., start : start + chunk_size, :]
+
+        # float32 sums of +-1 are exact up to 2 ** 24 entry pairs
+        concordance_array = np.zeros(
+            (*chunk_rank_array.shape[:-1], model_rdm_array.shape[-2]),
+            dtype=np.float32,
+        )
+        for a in range(n_pairs - 1):
+            concordance_array += np.matmul(
+                np.sign(chunk_rank_array[..., a : a + 1] - chunk_rank_array[..., a + 1 :]),
+                np.swapaxes(
+                    np.sign(
+                        model_rank_array[..., a : a + 1] - model_rank_array[..., a + 1 :]
+                    ),
+                    -1,
+                    -2,
+                ),
+            )
+
+        tau_a_array[..., start : start + chunk_size, :] = concordance_array.astype(
+            np.float64
+        ) / (n_pairs * (n_pairs - 1) // 2)
+
+    return tau_a_array
+
+
+# Comparator -> (...) x (# of RDMs) x (# of pairs) RDMs vs (...) x (# of models)
+# x (# of pairs) model RDMs -> (...) x (# of RDMs) x (# of models) kernel
+RDM_COMPARATOR_DICT = {
+    "rho_a": compare_rho_a,
+    "pearson": compare_pearson,
+    "tau_a": compare_tau_a,
+    "cosine": compare_cosine,
+}
+
+
+def compare_rdm(
+    rdm_array: np.ndarray, model_rdm_array: np.ndarray, comparator: str = "rho_a"
+):
+    return RDM_COMPARATOR_DICT[comparator](rdm_array, model_rdm_array)
+
+
+def compute_residual_projection(covariate_rdm_array: np.ndarray):
+    """Projection onto the residual space of covariate RDMs (with an intercept).
+
+    (...) x (# of covariates) x (# of pairs) covariate RDMs -> (...) x (# of pairs)
+    x (# of pairs) matrix I - C pinv(C), where C = [1, covariates]. Multiplying
+    RDMs by it gives the residuals of the least-squares fits (same as
+    sklearn.linear_model.LinearRegression) of all RDMs on the covariates at once.
+    """
+    n_pairs = covariate_rdm_array.shape[-1]
+    design_array = np.concatenate(
+        [
+            np.ones((*covariate_rdm_array.shape[:-2], 1, n_pairs)),
+            covariate_rdm_array,
+        ],
+        axis=-2,
+    )
+    design_array = np.swapaxes(design_array, -1, -2)  # (...) x (# of pairs) x (# of regressors)
+    return np.eye(n_pairs) - np.matmul(design_array, np.linalg.pinv(design_array))
+
+
+def residualize_rdm(rdm_array: np.ndarray, projection_array: np.ndarray):
+    """Residuals of (...) x (# of RDMs) x (# of pairs) RDMs (one GEMM per batch)."""
+    # The projection is symmetric
+    return np.matmul(rdm_array, projection_array)
+
+
+def _standardize_rdm(rdm_array: np.ndarray):
+    centered_rdm_array = rdm_array - rdm_array.mean(axis=-1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        standardized_rdm_array = centered_rdm_array / centered_rdm_array.std(
+            axis=-1, keepdims=True
+        )
+    return np.nan_to_num(standardized_rdm_array, nan=0.0)  # constant RDMs -> 0
+
+
+def fit_rdm_regression(rdm_array: np.ndarray, model_rdm_array: np.ndarray):
+    """Standardized betas of model RDMs jointly fitted to RDMs (with an intercept).
+
+    (...) x (# of RDMs) x (# of pairs) RDMs are regressed on the (...) x (# of
+    models) x (# of pairs) model RDMs (both z-scored over pairs). The design is
+    shared by all RDMs, so the betas of all RDMs are one pinv(X) @ Y product.
+    Returns a (...) x (# of RDMs) x (# of models) array.
+    """
+    n_pairs = rdm_array.shape[-1]
+    design_array = np.concatenate(
+        [
+            np.ones((*model_rdm_array.shape[:-2], 1, n_pairs)),
+            _standardize_rdm(model_rdm_array),
+        ],
+        axis=-2,
+    )
+    # (...) x (# of regressors) x (# of pairs)
+    design_pinv_array = np.linalg.pinv(np.swapaxes(design_array, -1, -2))
+    beta_array = np.matmul(
+        _standardize_rdm(rdm_array), np.swapaxes(design_pinv_array, -1, -2)
+    )
+    return beta_array[..., 1:]  # drop the intercept
+
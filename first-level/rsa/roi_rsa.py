@@ -0,0 +1,290 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from .feedback_model_rdm import load_feedback_model_rdm
+from .model_registry import (
+    CROSS_RUN_ID,
+    RUN_ID_LIST,
+    get_model_rdm_name_list,
+    get_neural_rdm_distance,
+    get_partial_rsa_spec,
+    get_rdm_comparator,
+    get_regression_rsa_model_name_list,
+    get_rsa_map_name_list,
+    get_rsa_run_id_list,
+)
+from .rdm import (
+    compare_rdm,
+    compute_residual_projection,
+    compute_rdm,
+    fit_rdm_regression,
+    get_rdm_pair_index,
+    residualize_rdm,
+)
+from ..utils.layout import get_subject_list
+from ..utils.nifti import load_nifti
+from ..utils.types import ConfigDict
+
+"""
+ROI-based RSA
+- neural data from rsa.prepare_feedback_neural_data (trial 3 - 8 feedback betas)
+- any number of ROI masks from `rsa.roi_mask` (name = mask path)
+- model RDMs from the model registry (rsa.prepare_feedback_model_rdm)
+- rho-a or another comparator (Fisher z-transformed; rsa.rdm_comparator)
+- run-wise or cross-run (rsa.cross_run)
+- correlation (or cosine/Euclidean) distance (rsa.neural_rdm_distance)
+- optional partial/semipartial RSA against covariate model RDMs ([rsa.partial_rsa])
+- optional multiple-regression RSA (standardized betas; [rsa.regression_rsa])
+"""
+
+ROI_RSA_RESULT_FILE_NAME = "roi_rsa.csv"
+
+
+def _get_feedback_neural_data_path(subject_id: str, run_id: str, config: ConfigDict):
+    return (
+        Path(config["execution"]["output_dir"])
+        / subject_id
+        / "rsa_neural_data"
+        / "feedback_beta"
+        / f"{subject_id}_{run_id}_task-photographer_trial_feedback_norm_beta_array.npy"
+    )
+
+
+def _load_stacked_roi_index(spatial_dim: tuple[int, int, int], config: ConfigDict):
+    """Stack voxel indices of all ROI masks into one flat index array.
+
+    Returns ROI names, the stacked (flattened) voxel index array, and offsets such
+    that stacked_voxel_index[roi_offset[i]:roi_offset[i + 1]] are the voxels of
+    the i-th ROI. ROIs may overlap.
+    """
+    roi_mask_path_dict = config["execution"]["rsa"].get("roi_mask", {})
+    if not roi_mask_path_dict:
+        raise RuntimeError(
+            'No ROI mask is specified. Please add "roi_mask" (name = mask path) to the [rsa] section of the config file.'
+        )
+
+    roi_name_list = []
+    roi_voxel_index_list = []
+
+    for roi_name, roi_mask_path in roi_mask_path_dict.items():
+        try:
+            roi_mask_array = load_nifti(Path(roi_mask_path)).data.astype(bool)
+        except Exception as e:
+            print(e)
+            raise RuntimeError(f"Cannot load ROI mask ({roi_name}): <{roi_mask_path}>")
+
+        if roi_mask_array.shape != tuple(spatial_dim):
+            raise RuntimeError(
+                f"ROI mask ({roi_name}) shape {roi_mask_array.shape} does not match the neural data {tuple(spatial_dim)}: <{roi_mask_path}>"
+            )
+
+        roi_voxel_index_array = np.flatnonzero(roi_mask_array)
+        if len(roi_voxel_index_array) == 0:
+            raise RuntimeError(f"ROI mask ({roi_name}) is empty: <{roi_mask_path}>")
+
+        roi_name_list.append(roi_name)
+        roi_voxel_index_list.append(roi_voxel_index_array)
+
+    roi_offset_array = np.zeros(len(roi_voxel_index_list) + 1, dtype=np.int64)
+    np.cumsum([len(index) for index in roi_voxel_index_list], out=roi_offset_array[1:])
+
+    return roi_name_list, np.concatenate(roi_voxel_index_list), roi_offset_array
+
+
+def _gather_run_roi_pattern(
+    subject_id: str, run_id: str, stacked_voxel_index: np.ndarray, config: ConfigDict
+):
+    rsa_feedback_neural_data_path = _get_feedback_neural_data_path(
+        subject_id, run_id, config
+    )
+
+    try:
+        # Memory-mapped, so only ROI voxels are read from the disk
+        beta_array = np.load(rsa_feedback_neural_data_path, mmap_mode="r")
+    except IOError:
+        raise RuntimeError(
+            f'Cannot load feedback neural data numpy array: <{rsa_feedback_neural_data_path}>. Please run "rsa.prepare_feedback_neural_data" task first'
+        )
+
+    # (# of conditions) x (# of stacked ROI voxels)
+    return np.asarray(
+        beta_array.reshape(-1, beta_array.shape[-1])[stacked_voxel_index]
+    ).T
+
+
+def _gather_roi_pattern(
+    subject_id: str, rsa_run_id: str, stacked_voxel_index: np.ndarray, config: ConfigDict
+):
+    # All runs are stacked (conditions ordered run by run) in the cross-run mode
+    run_id_list = RUN_ID_LIST if rsa_run_id == CROSS_RUN_ID else [rsa_run_id]
+    return np.concatenate(
+        [
+            _gather_run_roi_pattern(subject_id, run_id, stacked_voxel_index, config)
+            for run_id in run_id_list
+        ]
+    )
+
+
+def run_roi_rsa(config: ConfigDict):
+    subject_list = get_subject_list(config)
+
+    print(f"Subjects to be processed: {subject_list}")
+
+    output_dir = Path(config["execution"]["output_dir"])
+    assert output_dir.exists(), f"Output directory is not found: <{output_dir}>"
+
+    model_name_list = get_model_rdm_name_list(config)
+    partial_rsa_spec = get_partial_rsa_spec(config)
+    regression_model_name_list = get_regression_rsa_model_name_list(config)
+    rsa_map_name_list = get_rsa_map_name_list(config)
+    neural_rdm_distance = get_neural_rdm_distance(config)
+    rdm_comparator = get_rdm_comparator(config)
+    rsa_run_id_list = get_rsa_run_id_list(config)
+    subject_run_list = [
+        (subject_id, run_id) for subject_id in subject_list for run_id in rsa_run_id_list
+    ]
+
+    first_neural_data_path = _get_feedback_neural_data_path(
+        subject_list[0], RUN_ID_LIST[0], config
+    )
+    try:
+        spatial_dim = np.load(first_neural_data_path, mmap_mode="r").shape[:3]
+    except IOError:
+        raise RuntimeError(
+            f'Cannot load feedback neural data numpy array: <{first_neural_data_path}>. Please run "rsa.prepare_feedback_neural_data" task first'
+        )
+
+    roi_name_list, stacked_voxel_index, roi_offset_array = _load_stacked_roi_index(
+        spatial_dim, config
+    )
+    print(f"ROIs: {roi_name_list}")
+
+    # Read each run once for all ROIs
+    # (# of runs) x (# of conditions) x (# of stacked ROI voxels)
+    roi_pattern_array = np.stack(
+        [
+            _gather_roi_pattern(subject_id, run_id, stacked_voxel_index, config)
+            for subject_id, run_id in subject_run_list
+        ]
+    )
+    n_runs = len(RUN_ID_LIST) if rsa_run_id_list == [CROSS_RUN_ID] else 1
+    pair_index = get_rdm_pair_index(n_runs, roi_pattern_array.shape[1] // n_runs)
+
+    # (# of runs) x (# of ROIs) x (# of condition pairs)
+    neural_rdm_array = np.stack(
+        [
+            compute_rdm(
+                roi_pattern_array[:, :, start:end], neural_rdm_distance, pair_index
+            )
+            for start, end in zip(roi_offset_array[:-1], roi_offset_array[1:])
+        ],
+        axis=1,
+    )
+
+    # (# of runs) x (# of models) x (# of condition pairs)
+    try:
+        model_rdm_array = np.stack(
+            [
+                np.stack(
+                    [
+                        load_feedback_model_rdm(subject_id, run_id, config)[model_name]
+                        for model_name in model_name_list
+                    ]
+                )
+                for subject_id, run_id in subject_run_list
+            ]
+        )
+    except (RuntimeError, KeyError) as e:
+        print(e)
+        raise RuntimeError(
+            'Cannot load model RDMs. Please run "rsa.prepare_feedback_model_rdm" task first.'
+        )
+
+    # (# of runs) x (# of ROIs) x (# of models)
+    zscored_corr_coef_array = np.arctanh(
+        compare_rdm(neural_rdm_array, model_rdm_array, rdm_comparator)
+    )
+
+    if partial_rsa_spec is not None:
+        print(
+            f"Computing {partial_rsa_spec['mode']} RSA: covariates = {partial_rsa_spec['covariate']}"
+        )
+        partial_model_index = [
+            model_name_list.index(name) for name in partial_rsa_spec["model"]
+        ]
+        covariate_index = [
+            model_name_list.index(name) for name in partial_rsa_spec["covariate"]
+        ]
+
+        # (# of runs) x (# of condition pairs) x (# of condition pairs)
+        projection_array = compute_residual_projection(
+            model_rdm_array[:, covariate_index]
+        )
+        partial_neural_rdm_array = (
+            residualize_rdm(neural_rdm_array, projection_array)
+            if partial_rsa_spec["mode"] == "partial"
+            else neural_rdm_array
+        )
+        partial_zscored_corr_coef_array = np.arctanh(
+            compare_rdm(
+                partial_neural_rdm_array,
+                residualize_rdm(model_rdm_array[:, partial_model_index], projection_array),
+                rdm_comparator,
+            )
+        )
+
+        # (# of runs) x (# of ROIs) x (# of RSA maps)
+        zscored_corr_coef_array = np.concatenate(
+            [zscored_corr_coef_array, partial_zscored_corr_coef_array], axis=-1
+        )
+
+    if regression_model_name_list is not None:
+        print(f"Computing regression RSA: models = {regression_model_name_list}")
+        regression_model_index = [
+            model_name_list.index(name) for name in regression_model_name_list
+        ]
+        # (# of runs) x (# of ROIs) x (# of regression models); standardized betas
+        regression_beta_array = fit_rdm_regression(
+            neural_rdm_array, model_rdm_array[:, regression_model_index]
+        )
+    else:
+        regression_beta_array = np.zeros((*zscored_corr_coef_array.shape[:2], 0))
+
+    # (# of runs) x (# of ROIs) x (# of RSA maps), and the statistic of each RSA map
+    rsa_value_array = np.concatenate(
+        [zscored_corr_coef_array, regression_beta_array], axis=-1
+    )
+    rsa_statistic_array = np.array(
+        ["fisher_z"] * zscored_corr_coef_array.shape[-1]
+        + ["beta"] * regression_beta_array.shape[-1]
+    )
+
+    # Tidy table: one row per subject x run x ROI x model
+    run_index, roi_index, model_index = np.indices(rsa_value_array.shape).reshape(3, -1)
+    roi_rsa_df = pd.DataFrame(
+        {
+            "subject_id": [subject_run_list[i][0] for i in run_index],
+            "run_id": [subject_run_list[i][1] for i in run_index],
+            "roi": np.array(roi_name_list)[roi_index],
+            "n_voxels": np.diff(roi_offset_array)[roi_index],
+            "model": np.array(rsa_map_name_list)[model_index],
+            "statistic": rsa_statistic_array[model_index],
+            "rsa_value": rsa_value_array.reshape(-1),
+        }
+    )
+
+    try:
+        roi_rsa_result_dir = output_dir / "rsa_roi"
+        os.makedirs(roi_rsa_result_dir, exist_ok=True)
+        roi_rsa_df.to_csv(roi_rsa_result_dir / ROI_RSA_RESULT_FILE_NAME, index=False)
+    except OSError:
+        raise RuntimeError(
+            f"Cannot save ROI RSA results: <{roi_rsa_result_dir / ROI_RSA_RESULT_FILE_NAME}>"
+        )
+
+    print(
+        f"ROI RSA finished: {len(roi_name_list)} ROIs x {len(subject_run_list)} runs x {len(rsa_map_name_list)} models"
+    )
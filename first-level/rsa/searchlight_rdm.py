@@ -0,0 +1,212 @@
+import numpy as np
+from scipy.ndimage import distance_transform_edt
+
+from .rdm import RDM_DISTANCE_KERNEL_DICT, get_rdm_pair_index
+from ..utils.searchlight import Searchlight
+
+DEFAULT_SPHERE_CHUNK_SIZE = 1024  # Spheres gathered at once (bounds the memory)
+MIN_SPHERE_CHUNK_SIZE = 16  # Smallest chunk of a memory-budgeted searchlight
+
+DEFAULT_TILE_DEPTH = 8  # z slices of centers per searchlight tile
+
+
+def get_searchlight_tile_list(center_mask_array: np.ndarray, halo: int, tile_depth: int):
+    """Split the volume into z-slab tiles of `tile_depth` center slices.
+
+    Each tile is (z start, z end) of its centers and (z start, z end) of its
+    slab, i.e., the centers with a halo of `halo` (= the largest radius) voxels
+    on both sides (clipped to the volume), so every sphere of the tile lies in
+    the slab. Tiles without any center are skipped.
+    """
+    n_slices = center_mask_array.shape[2]
+    tile_list = []
+    for z_start in range(0, n_slices, tile_depth):
+        z_end = min(z_start + tile_depth, n_slices)
+        if not center_mask_array[:, :, z_start:z_end].any():
+            continue
+        tile_list.append(
+            ((z_start, z_end), (max(z_start - halo, 0), min(z_end + halo, n_slices)))
+        )
+    return tile_list
+
+
+def build_searchlight_index(
+    mask_array: np.ndarray, valid_voxel_array: np.ndarray, radius_list: list[int]
+):
+    """Index of all searchlight spheres of all radii, built at once.
+
+    For each radius, same spheres as utils.searchlight.Searchlight.analysis:
+    centers are mask voxels at least `radius` voxels away from the volume border,
+    and sphere voxels are available if `valid_voxel_array` is True (non-zero data
+    in all conditions). Spheres of all radii share the centers, and their voxels
+    are ordered shell by shell (radius_list[i - 1] < distance <= radius_list[i]),
+    so the sphere of radius_list[i] is the first shell_offset_array[i + 1] voxels.
+
+    Returns center voxel indices ((# of centers) x 3), flat voxel indices and
+    the availability mask of them ((# of centers) x (# of voxels of the largest
+    sphere)), shell offsets ((# of radii) + 1), and the (# of centers) x (# of
+    radii) mask of centers having a sphere of each radius. Centers without any
+    sphere are dropped.
+    """
+    radius_list = sorted(radius_list)
+    max_radius = radius_list[-1]
+
+    # (# of sphere voxels) x 3 offsets from the center, ordered shell by shell
+    sphere_offset_array = np.argwhere(Searchlight(max_radius).makeSphere()) - max_radius
+    shell_index_array = np.searchsorted(
+        np.square(radius_list), np.square(sphere_offset_array).sum(axis=1)
+    )
+    shell_order = np.argsort(shell_index_array, kind="stable")
+    sphere_offset_array = sphere_offset_array[shell_order]
+    shell_offset_array = np.searchsorted(
+        shell_index_array[shell_order], np.arange(len(radius_list) + 1)
+    )
+
+    min_radius = radius_list[0]
+    inner_slice = tuple(slice(min_radius, size - min_radius) for size in mask_array.shape)
+    search_area_array = np.zeros(mask_array.shape, dtype=bool)
+    search_area_array[inner_slice] = mask_array[inner_slice].astype(bool)
+    center_voxel_index_array = np.argwhere(search_area_array)
+
+    # Voxels outside the volume (spheres crossing the border) are not available
+    sphere_voxel_coord_array = (
+        center_voxel_index_array[:, np.newaxis, :] + sphere_offset_array[np.newaxis, :, :]
+    )
+    inside_volume_mask = np.all(
+        (sphere_voxel_coord_array >= 0)
+        & (sphere_voxel_coord_array < np.array(mask_array.shape)),
+        axis=2,
+    )
+    sphere_voxel_index_array = np.ravel_multi_index(
+        tuple(np.moveaxis(sphere_voxel_coord_array, -1, 0)),
+        mask_array.shape,
+        mode="clip",
+    )
+    sphere_voxel_mask_array = (
+        valid_voxel_array.reshape(-1)[sphere_voxel_index_array] & inside_volume_mask
+    )
+
+    # Center mask of each radius: away from the border, with any available voxel
+    n_available_voxel_array = np.cumsum(sphere_voxel_mask_array, axis=1)
+    center_radius_mask_array = np.stack(
+        [
+            np.all(
+                (center_voxel_index_array >= radius)
+                & (center_voxel_index_array < np.array(mask_array.shape) - radius),
+                axis=1,
+            )
+            & (n_available_voxel_array[:, shell_end - 1] > 0)
+            for radius, shell_end in zip(radius_list, shell_offset_array[1:])
+        ],
+        axis=1,
+    )
+
+    nonempty_center_mask = center_radius_mask_array.any(axis=1)
+    return (
+        center_voxel_index_array[nonempty_center_mask],
+        sphere_voxel_index_array[nonempty_center_mask],
+        sphere_voxel_mask_array[nonempty_center_mask],
+        shell_offset_array,
+        center_radius_mask_array[nonempty_center_mask],
+    )
+
+
+def get_strided_center_mask(mask_array: np.ndarray, stride: int):
+    """Mask voxels on a lattice of every `stride` voxels along each axis (stride^3 fewer centers)."""
+    lattice_mask_array = np.zeros(mask_array.shape, dtype=bool)
+    lattice_mask_array[::stride, ::stride, ::stride] = True
+    return mask_array.astype(bool) & lattice_mask_array
+
+
+def fill_from_nearest_center(
+    brain_map_array: np.ndarray,
+    center_voxel_index_array: np.ndarray,
+    mask_array: np.ndarray,
+):
+    """Fill (# of maps) x (brain map dim) maps of strided centers.
+
+    Every mask voxel takes the values of its nearest center (Euclidean distance
+    transform), so the coarse maps cover the mask like full-resolution maps.
+    """
+    if len(center_voxel_index_array) == 0:
+        return brain_map_array
+
+    center_mask_array = np.zeros(mask_array.shape, dtype=bool)
+    center_mask_array[tuple(center_voxel_index_array.T)] = True
+    nearest_center_index_array = distance_transform_edt(
+        ~center_mask_array, return_distances=False, return_indices=True
+    )
+    return brain_map_array[(slice(None), *nearest_center_index_array)] * mask_array.astype(
+        bool
+    )
+
+
+def compute_searchlight_rdm(
+    pattern_array: np.ndarray,
+    sphere_voxel_index_array: np.ndarray,
+    sphere_voxel_mask_array: np.ndarray,
+    shell_offset_array: np.ndarray,
+    n_runs: int = 1,
+    distance: str = "correlation",
+    chunk_size: int = DEFAULT_SPHERE_CHUNK_SIZE,
+):
+    """RDMs of all spheres of all radii in one pass over the data.
+
+    `pattern_array` is (# of voxels) x (# of runs x # of conditions) (flattened
+    volume; conditions ordered run by run). The sufficient statistics of a
+    sphere (# of available voxels, pattern sums, and the condition x condition
+    Gram matrix) are sums over its voxels, so they are accumulated shell by
+    shell and every larger radius reuses the smaller one. Shell patterns of a chunk of spheres
+    are zero-padded (# of spheres) x (# of shell voxels) x (# of conditions)
+    blocks, so each shell is one batched GEMM. Same as
+    scipy.spatial.distance.pdist(sphere_pattern.T, distance) on the available
+    voxels (see rsa.rdm.RDM_DISTANCE_KERNEL_DICT).
+
+    Returns one (# of spheres) x (# of condition pairs) array per radius
+    (undefined for centers without the sphere of the radius).
+    """
+    is_centered, distance_kernel = RDM_DISTANCE_KERNEL_DICT[distance]
+    pair_index = get_rdm_pair_index(n_runs, pattern_array.shape[1] // n_runs)
+
+    shell_slice_list = [
+        slice(shell_start, shell_end)
+        for shell_start, shell_end in zip(shell_offset_array[:-1], shell_offset_array[1:])
+    ]
+    rdm_array_list = [
+        np.empty((len(sphere_voxel_index_array), len(pair_index[0])))
+        for _ in shell_slice_list
+    ]
+
+    for start in range(0, len(sphere_voxel_index_array), chunk_size):
+        chunk_slice = slice(start, start + chunk_size)
+        n_spheres = len(sphere_voxel_index_array[chunk_slice])
+
+        n_voxel_array = np.zeros(n_spheres)
+        pattern_sum_array = np.zeros((n_spheres, pattern_array.shape[1]))
+        gram_array = np.zeros((n_spheres, pattern_array.shape[1], pattern_array.shape[1]))
+
+        for shell_slice, rdm_array in zip(shell_slice_list, rdm_array_list):
+            voxel_mask_array = sphere_voxel_mask_array[chunk_slice, shell_slice, np.newaxis]
+            shell_pattern_array = (
+                pattern_array[sphere_voxel_index_array[chunk_slice, shell_slice]]
+                * voxel_mask_array
+            )
+            n_voxel_array += voxel_mask_array.sum(axis=(1, 2))
+
+            gram_array += np.matmul(
+                np.swapaxes(shell_pattern_array, 1, 2), shell_pattern_array
+            )
+            pattern_sum_array += shell_pattern_array.sum(axis=1)
+
+            sphere_gram_array = gram_array
+            if is_centered:
+                # Center over the available voxels of the sphere
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    sphere_gram_array = gram_array - (
+                        pattern_sum_array[:, :, np.newaxis]
+                        * pattern_sum_array[:, np.newaxis, :]
+                        / n_voxel_array[:, np.newaxis, np.newaxis]
+                    )
+            rdm_array[chunk_slice] = distance_kernel(sphere_gram_array, pair_index)
+
+    return rdm_array_list
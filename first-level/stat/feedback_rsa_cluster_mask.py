@@ -2,30 +2,35 @@ import gc
 import os
 import subprocess
 import time
+from itertools import product
 from pathlib import Path
 
+from ..rsa.model_registry import (
+    get_rsa_map_name_list,
+    get_rsa_map_summary_name,
+    get_searchlight_radius_list,
+)
+from ..utils.types import ConfigDict
+
 VOXELWISE_P_THRESHOLD = 0.005
 VOXELWISE_Z_THRESHOLD = 2.5758
 CLUSTER_LEVEL_ALPHA = 0.05
 
 
-def extract_feedback_rsa_cluster_mask(config):
+def extract_feedback_rsa_cluster_mask(config: ConfigDict):
     output_dir = Path(config["execution"]["output_dir"])
     assert output_dir.exists(), f"Output directory is not found: <{output_dir}>"
 
-    rsa_feedback_model_name_list = [
-        "current_trial",
-        "one_back_trial",
-        "two_back_trial",
-        "recent_2_trial",
-        "recent_3_trial",
-        "previous_2_trial",
-    ]
+    rsa_feedback_model_name_list = get_rsa_map_name_list(config)
 
-    searchlight_radius = config["execution"]["rsa"]["searchlight_radius"]
+    searchlight_radius_list = get_searchlight_radius_list(config)
     blur_kernel_width = config["execution"]["rsa"]["rsa_blur_kernel_width"]
+    rsa_map_summary_name = get_rsa_map_summary_name(config)
 
-    for rsa_feedback_model_name in rsa_feedback_model_name_list:
+    # Maps of all radii (rsa.searchlight_radius) are tested separately
+    for searchlight_radius, rsa_feedback_model_name in product(
+        searchlight_radius_list, rsa_feedback_model_name_list
+    ):
         gc.collect()
 
         rsa_model_ttest_dir = (
@@ -44,7 +49,7 @@ def extract_feedback_rsa_cluster_mask(config):
 
         os.chdir(rsa_model_ttest_dir)
 
-        rsa_stat_map_name = f"feedback_rsa_ttest_{rsa_feedback_model_name}_within_run_mean_rad{searchlight_radius}_blur{blur_kernel_width}.nii"
+        rsa_stat_map_name = f"feedback_rsa_ttest_{rsa_feedback_model_name}_{rsa_map_summary_name}_rad{searchlight_radius}_blur{blur_kernel_width}.nii"
 
         print(f"Extract cluster mask from the {rsa_feedback_model_name} stat map file:")
 
@@ -53,7 +58,7 @@ def extract_feedback_rsa_cluster_mask(config):
         assert rsa_stat_map_path.exists()
 
         # Read the 3dClustsim table and get the minimal cluster extent
-        rsa_clustersim_table_file_name = f"feedback_rsa_ttest_{rsa_feedback_model_name}_within_run_mean_rad{searchlight_radius}_blur{blur_kernel_width}.CSimA.NN2_1sided.1D"
+        rsa_clustersim_table_file_name = f"feedback_rsa_ttest_{rsa_feedback_model_name}_{rsa_map_summary_name}_rad{searchlight_radius}_blur{blur_kernel_width}.CSimA.NN2_1sided.1D"
         try:
             minimum_cluster_extent = int(
                 subprocess.check_output(
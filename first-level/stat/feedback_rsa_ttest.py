@@ -3,66 +3,53 @@ import os
 import shutil
 import subprocess
 import time
+from itertools import product
 from pathlib import Path
 
 import numpy as np
 
+from ..rsa.model_registry import (
+    get_rsa_map_name_list,
+    get_rsa_map_summary_name,
+    get_rsa_run_id_list,
+    get_searchlight_radius_list,
+)
+from ..utils.layout import get_subject_list
+from ..utils.memory import get_clustsim_option
 from ..utils.nifti import load_nifti
-from ..utils.path import get_fmriprep_output_dir
-from ..utils.subject_exclusion import read_subject_exclusion
+from ..utils.shard import check_shards_merged
 from ..utils.types import ConfigDict
 
 
 def run_feedback_rsa_ttest(config: ConfigDict):
-    fmriprep_output_dir = get_fmriprep_output_dir(config)
-
-    # Check subject_exclusion.json present
-    try:
-        subject_exclusion_dict = read_subject_exclusion(config)
-    except RuntimeError as e:
-        print(e)
-        raise RuntimeError(
-            'subject_exclusion.json should be present. Please run both "glm.prepare_task_stim" and "glm.prepare_confound" tasks first.'
-        )
-
-    subject_list = [
-        child.stem
-        for child in fmriprep_output_dir.iterdir()
-        if child.is_dir()
-        and "sub-" in child.stem
-        and child.stem not in subject_exclusion_dict.keys()
-    ]
-
-    if config["execution"]["participant_label"] is not None:
-        subject_list = [
-            child
-            for child in subject_list
-            if child[4:] in config["execution"]["participant_label"]
-        ]
+    subject_list = get_subject_list(config)
 
     print(f"Subjects to be processed: {subject_list}")
 
+    # All shards of the subject-level task should be finished before group stats
+    check_shards_merged(["rsa.run_feedback_rsa"], config)
+
     output_dir = Path(config["execution"]["output_dir"])
     assert output_dir.exists(), f"Output directory is not found: <{output_dir}>"
 
-    rsa_feedback_model_name_list = [
-        "current_trial",
-        "one_back_trial",
-        "two_back_trial",
-        "recent_2_trial",
-        "recent_3_trial",
-        "previous_2_trial",
-    ]
+    rsa_feedback_model_name_list = get_rsa_map_name_list(config)
 
-    searchlight_radius = config["execution"]["rsa"]["searchlight_radius"]
+    searchlight_radius_list = get_searchlight_radius_list(config)
     blur_kernel_width = config["execution"]["rsa"]["rsa_blur_kernel_width"]
 
-    run_id_list = ["run-01", "run-02", "run-03", "run-04", "run-05"]
+    # One cross-run map per subject in the cross-run mode, tested as it is
+    run_id_list = get_rsa_run_id_list(config)
+    rsa_map_summary_name = get_rsa_map_summary_name(config)
 
-    for rsa_feedback_model_name in rsa_feedback_model_name_list:
+    # Maps of all radii (rsa.searchlight_radius) are tested separately
+    for searchlight_radius, rsa_feedback_model_name in product(
+        searchlight_radius_list, rsa_feedback_model_name_list
+    ):
         gc.collect()
 
-        print(f"T-test on {rsa_feedback_model_name} RSA maps (average across all runs)")
+        print(
+            f"T-test on {rsa_feedback_model_name} RSA maps ({rsa_map_summary_name}, radius = {searchlight_radius})"
+        )
 
         rsa_map_name = f"{rsa_feedback_model_name}"
 
@@ -104,8 +91,8 @@ def run_feedback_rsa_ttest(config: ConfigDict):
                 f"Cannot copy AFNI template (from <{afni_template_path}>) to t-test output directory (<{stat_ttest_dir}>)."
             )
 
-        # Compute and copy run-averaged RSA maps
-        ttest_subject_rsa_runmean_map_name_list = []
+        # Compute (run average) and copy subject-level RSA maps
+        ttest_subject_rsa_summary_map_name_list = []
 
         for subject_id in subject_list:
             subject_rsa_run_dir_path = (
@@ -115,37 +102,43 @@ def run_feedback_rsa_ttest(config: ConfigDict):
                 f"{subject_id}_{run_id}_task-photographer_{rsa_map_name}_rsa_correlation_map_rad{searchlight_radius}_blur{blur_kernel_width}.nii"
                 for run_id in run_id_list
             ]
-            subject_rsa_runmean_map_name = f"{subject_id}_task-photographer_{rsa_map_name}_within_run_mean_rsa_correlation_map_rad{searchlight_radius}_blur{blur_kernel_width}.nii"
+            subject_rsa_summary_map_name = f"{subject_id}_task-photographer_{rsa_map_name}_{rsa_map_summary_name}_rsa_correlation_map_rad{searchlight_radius}_blur{blur_kernel_width}.nii"
 
             os.chdir(subject_rsa_run_dir_path)
 
-            try:
-                subprocess.run(
-                    f"3dMean -overwrite -prefix {subject_rsa_runmean_map_name} {' '.join(subject_rsa_run_map_name_list)}",
-                    shell=True,
+            if len(subject_rsa_run_map_name_list) > 1:
+                try:
+                    subprocess.run(
+                        f"3dMean -overwrite -prefix {subject_rsa_summary_map_name} {' '.join(subject_rsa_run_map_name_list)}",
+                        shell=True,
+                    )
+                except Exception as e:
+                    print(e)
+                    raise RuntimeError("Computation of within-run mean RSA map failed.")
+                subject_rsa_summary_map_path = (
+                    subject_rsa_run_dir_path / subject_rsa_summary_map_name
+                )
+            else:
+                subject_rsa_summary_map_path = (
+                    subject_rsa_run_dir_path / subject_rsa_run_map_name_list[0]
                 )
-            except Exception as e:
-                print(e)
-                raise RuntimeError("Computation of within-run mean RSA map failed.")
 
-            ttest_subject_rsa_runmean_map_name_list.append(subject_rsa_runmean_map_name)
+            ttest_subject_rsa_summary_map_name_list.append(subject_rsa_summary_map_name)
 
             try:
                 shutil.copy(
-                    subject_rsa_run_dir_path / subject_rsa_runmean_map_name,
-                    stat_ttest_dir,
+                    subject_rsa_summary_map_path,
+                    stat_ttest_dir / subject_rsa_summary_map_name,
                 )
             except OSError:
                 raise RuntimeError(
-                    f"Cannot copy within-run mean RSA map ({rsa_map_name}) for {subject_id} ({subject_rsa_runmean_map_name}) in <{stat_ttest_dir}>"
+                    f"Cannot copy {rsa_map_summary_name} RSA map ({rsa_map_name}) for {subject_id} ({subject_rsa_summary_map_name}) in <{stat_ttest_dir}>"
                 )
 
             # Sanity check
-            original_rsa_map_array = load_nifti(
-                subject_rsa_run_dir_path / subject_rsa_runmean_map_name
-            ).data
+            original_rsa_map_array = load_nifti(subject_rsa_summary_map_path).data
             copied_rsa_map_array = load_nifti(
-                stat_ttest_dir / subject_rsa_runmean_map_name
+                stat_ttest_dir / subject_rsa_summary_map_name
             ).data
             assert np.array_equal(original_rsa_map_array, copied_rsa_map_array) is True
             del original_rsa_map_array
@@ -153,10 +146,16 @@ def run_feedback_rsa_ttest(config: ConfigDict):
 
         os.chdir(stat_ttest_dir)
 
+        # 3dClustSim jobs fitted to the memory budget (--memory-budget)
+        clustsim_option = get_clustsim_option(
+            [stat_ttest_dir / name for name in ttest_subject_rsa_summary_map_name_list],
+            config,
+        )
+
         # Run 3dttest++
         try:
             subprocess.run(
-                f"3dttest++ -setA {' '.join(ttest_subject_rsa_runmean_map_name_list)} -mask {mni_gm_mask_path.name} -prefix feedback_rsa_ttest_{rsa_map_name}_within_run_mean_rad{searchlight_radius}_blur{blur_kernel_width}.nii -Clustsim",
+                f"3dttest++ -setA {' '.join(ttest_subject_rsa_summary_map_name_list)} -mask {mni_gm_mask_path.name} -prefix feedback_rsa_ttest_{rsa_map_name}_{rsa_map_summary_name}_rad{searchlight_radius}_blur{blur_kernel_width}.nii {clustsim_option}",
                 shell=True,
             )
         except Exception as e:
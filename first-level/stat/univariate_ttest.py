@@ -7,40 +7,20 @@ from pathlib import Path
 
 from nipype.interfaces import afni
 
-from ..utils.path import get_fmriprep_output_dir
-from ..utils.subject_exclusion import read_subject_exclusion
+from ..utils.layout import get_subject_list
+from ..utils.memory import get_clustsim_option
+from ..utils.shard import check_shards_merged
 from ..utils.types import ConfigDict
 
 
 def run_univariate_ttest(config: ConfigDict):
-    fmriprep_output_dir = get_fmriprep_output_dir(config)
-
-    # Check subject_exclusion.json present
-    try:
-        subject_exclusion_dict = read_subject_exclusion(config)
-    except RuntimeError as e:
-        print(e)
-        raise RuntimeError(
-            'subject_exclusion.json should be present. Please run both "glm.prepare_task_stim" and "glm.prepare_confound" tasks first.'
-        )
-
-    subject_list = [
-        child.stem
-        for child in fmriprep_output_dir.iterdir()
-        if child.is_dir()
-        and "sub-" in child.stem
-        and child.stem not in subject_exclusion_dict.keys()
-    ]
-
-    if config["execution"]["participant_label"] is not None:
-        subject_list = [
-            child
-            for child in subject_list
-            if child[4:] in config["execution"]["participant_label"]
-        ]
+    subject_list = get_subject_list(config)
 
     print(f"Subjects to be processed: {subject_list}")
 
+    # All shards of the subject-level task should be finished before group stats
+    check_shards_merged(["glm.run_block_wise_glm"], config)
+
     output_dir = Path(config["execution"]["output_dir"])
     assert output_dir.exists(), f"Output directory is not found: <{output_dir}>"
 
@@ -149,10 +129,15 @@ def run_univariate_ttest(config: ConfigDict):
                 f"Cannot copy AFNI template (from <{afni_template_path}>) to ttest block directory (<{ttest_block_dir}>)."
             )
 
+        # 3dClustSim jobs fitted to the memory budget (--memory-budget)
+        clustsim_option = get_clustsim_option(
+            list(ttest_block_dir.glob(f"*mean_block_{block_regressor}_beta.nii")), config
+        )
+
         # Run 3dttest++
         try:
             subprocess.run(
-                f"3dttest++ -setA '*mean_block_{block_regressor}_beta.nii' -mask {mni_gm_mask_path.name} -prefix univariate_ttest_block_{block_regressor}.nii -Clustsim",
+                f"3dttest++ -setA '*mean_block_{block_regressor}_beta.nii' -mask {mni_gm_mask_path.name} -prefix univariate_ttest_block_{block_regressor}.nii {clustsim_option}",
                 shell=True,
             )
         except Exception as e:
@@ -233,10 +218,18 @@ def run_univariate_ttest(config: ConfigDict):
                 f"Cannot copy AFNI template (from <{afni_template_path}>) to ttest parametric directory (<{ttest_parametric_dir}>)."
             )
 
+        # 3dClustSim jobs fitted to the memory budget (--memory-budget)
+        clustsim_option = get_clustsim_option(
+            list(
+                ttest_parametric_dir.glob(f"*mean_parametric_{parametric_regressor}_beta.nii")
+            ),
+            config,
+        )
+
         # Run 3dttest++
         try:
             subprocess.run(
-                f"3dttest++ -setA '*mean_parametric_{parametric_regressor}_beta.nii' -mask {mni_gm_mask_path.name} -prefix univariate_ttest_parametric_{parametric_regressor}.nii -Clustsim",
+                f"3dttest++ -setA '*mean_parametric_{parametric_regressor}_beta.nii' -mask {mni_gm_mask_path.name} -prefix univariate_ttest_parametric_{parametric_regressor}.nii {clustsim_option}",
                 shell=True,
             )
         except Exception as e:
@@ -0,0 +1,288 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .path import get_fmriprep_output_dir
+from .subject_exclusion import read_subject_exclusion
+from .types import ConfigDict, LayoutIndexDict
+
+LAYOUT_INDEX_FILE_NAME = "layout_index.json"
+LAYOUT_INDEX_VERSION = 1
+LAYOUT_SCAN_WORKERS = 16
+
+RSA_CITY_LIST = ["New_York", "Boston", "Los_Angeles", "London", "Paris"]
+
+FMRIPREP_BOLD_SUFFIX = "_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz"
+FMRIPREP_BRAINMASK_SUFFIX = "_space-MNI152NLin2009cAsym_desc-brain_mask.nii.gz"
+FMRIPREP_CONFOUNDS_SUFFIX = "confounds_timeseries.tsv"
+
+# Layout indices already loaded and validated in this process (keyed by output_dir)
+_layout_index_cache: dict[str, LayoutIndexDict] = {}
+
+
+def _scandir(path: Path):
+    try:
+        with os.scandir(path) as it:
+            return sorted(it, key=lambda entry: entry.name)
+    except FileNotFoundError:
+        return []
+
+
+def _scan_subject_fmriprep(subject_id: str, fmriprep_output_dir: Path):
+    subject_fmriprep_func_dir = fmriprep_output_dir / subject_id / "func"
+    dir_mtime_dict = {}
+    run_dict = {}
+
+    for entry in _scandir(subject_fmriprep_func_dir):
+        name = entry.name
+        if not name.startswith(f"{subject_id}_task-photographer_run-"):
+            continue
+
+        run_id = name.split("_")[2]
+        run_file_dict = run_dict.setdefault(run_id, {})
+
+        if name.endswith(FMRIPREP_BOLD_SUFFIX):
+            run_file_dict["bold"] = entry.path
+        elif name.endswith(FMRIPREP_BRAINMASK_SUFFIX):
+            run_file_dict["brainmask"] = entry.path
+        elif name.endswith(FMRIPREP_CONFOUNDS_SUFFIX):
+            run_file_dict["confounds"] = entry.path
+
+    if subject_fmriprep_func_dir.exists():
+        dir_mtime_dict[str(subject_fmriprep_func_dir)] = (
+            subject_fmriprep_func_dir.stat().st_mtime_ns
+        )
+
+    return run_dict, dir_mtime_dict
+
+
+def _scan_subject_behavior(subject_behavior_dir: str | None):
+    dir_mtime_dict = {}
+    run_dict = {}
+
+    if subject_behavior_dir is None:
+        return run_dict, dir_mtime_dict
+
+    subject_behavior_dir = Path(subject_behavior_dir)
+    dir_mtime_dict[str(subject_behavior_dir)] = subject_behavior_dir.stat().st_mtime_ns
+
+    for run_entry in _scandir(subject_behavior_dir):
+        if not run_entry.is_dir() or "backup" in run_entry.name:
+            continue
+
+        run_dir = Path(run_entry.path)
+        run_id = f'run-0{run_dir.stem.split("_")[0]}'
+        dir_mtime_dict[str(run_dir)] = run_entry.stat().st_mtime_ns
+
+        city_name_list = [city for city in RSA_CITY_LIST if city in run_dir.stem]
+
+        capture_dir = run_dir / "capture"
+        capture_image_list = []
+        if capture_dir.exists():
+            dir_mtime_dict[str(capture_dir)] = capture_dir.stat().st_mtime_ns
+            capture_image_list = [
+                entry.path
+                for entry in _scandir(capture_dir)
+                if entry.name.startswith("trial_") and entry.name.endswith(".png")
+            ]
+
+        run_dict[run_id] = {
+            "run_dir": str(run_dir),
+            "city": city_name_list[0] if city_name_list else None,
+            "etime": str(run_dir / "log_etime.txt"),
+            "capture_image_list": capture_image_list,
+        }
+
+    return run_dict, dir_mtime_dict
+
+
+def _scan_subject(
+    subject_id: str,
+    fmriprep_output_dir: Path,
+    behavioral_data_entry_list: list[os.DirEntry],
+):
+    fmriprep_run_dict, fmriprep_dir_mtime_dict = _scan_subject_fmriprep(
+        subject_id, fmriprep_output_dir
+    )
+
+    # The behavioral data directory name contains the subject number
+    subject_behavior_dir_list = [
+        entry.path
+        for entry in behavioral_data_entry_list
+        if entry.is_dir() and subject_id.split("-")[1] in entry.name
+    ]
+    subject_behavior_dir = (
+        subject_behavior_dir_list[0] if subject_behavior_dir_list else None
+    )
+    behavior_run_dict, behavior_dir_mtime_dict = _scan_subject_behavior(
+        subject_behavior_dir
+    )
+
+    subject_layout_dict = {
+        "fmriprep_runs": fmriprep_run_dict,
+        "behavior_dir": subject_behavior_dir,
+        "behavior_runs": behavior_run_dict,
+    }
+
+    return subject_layout_dict, fmriprep_dir_mtime_dict | behavior_dir_mtime_dict
+
+
+def build_layout_index(config: ConfigDict):
+    fmriprep_output_dir = get_fmriprep_output_dir(config)
+    behavioral_data_dir = Path(config["execution"]["glm"]["behavioral_data_dir"])
+
+    subject_id_list = [
+        entry.name
+        for entry in _scandir(fmriprep_output_dir)
+        if entry.is_dir() and "sub-" in entry.name
+    ]
+    behavioral_data_entry_list = _scandir(behavioral_data_dir)
+
+    dir_mtime_dict = {str(fmriprep_output_dir): fmriprep_output_dir.stat().st_mtime_ns}
+    if behavioral_data_dir.exists():
+        dir_mtime_dict[str(behavioral_data_dir)] = (
+            behavioral_data_dir.stat().st_mtime_ns
+        )
+
+    # Directory listings are I/O-bound; scan subjects concurrently
+    with ThreadPoolExecutor(max_workers=LAYOUT_SCAN_WORKERS) as executor:
+        scan_result_list = list(
+            executor.map(
+                lambda subject_id: _scan_subject(
+                    subject_id, fmriprep_output_dir, behavioral_data_entry_list
+                ),
+                subject_id_list,
+            )
+        )
+
+    subject_layout_dict = {}
+    for subject_id, (subject_layout, subject_dir_mtime_dict) in zip(
+        subject_id_list, scan_result_list
+    ):
+        subject_layout_dict[subject_id] = subject_layout
+        dir_mtime_dict |= subject_dir_mtime_dict
+
+    return LayoutIndexDict(
+        version=LAYOUT_INDEX_VERSION,
+        fmriprep_output_dir=str(fmriprep_output_dir),
+        behavioral_data_dir=str(behavioral_data_dir),
+        dir_mtime=dir_mtime_dict,
+        subjects=subject_layout_dict,
+    )
+
+
+def _is_layout_index_valid(layout_index: LayoutIndexDict, config: ConfigDict):
+    if layout_index.get("version") != LAYOUT_INDEX_VERSION:
+        return False
+
+    if layout_index["fmriprep_output_dir"] != str(get_fmriprep_output_dir(config)):
+        return False
+
+    if layout_index["behavioral_data_dir"] != str(
+        Path(config["execution"]["glm"]["behavioral_data_dir"])
+    ):
+        return False
+
+    # Any added/removed file changes the mtime of its parent directory
+    for dir_path, dir_mtime in layout_index["dir_mtime"].items():
+        try:
+            if os.stat(dir_path).st_mtime_ns != dir_mtime:
+                return False
+        except FileNotFoundError:
+            return False
+
+    return True
+
+
+def get_layout_index(config: ConfigDict):
+    output_dir = Path(config["execution"]["output_dir"])
+    layout_index_path = output_dir / LAYOUT_INDEX_FILE_NAME
+
+    # Validated once per process (stat of every indexed directory), then reused
+    layout_index = _layout_index_cache.get(str(output_dir))
+    if layout_index is not None:
+        return layout_index
+
+    if layout_index_path.exists():
+        try:
+            with open(layout_index_path, "r") as f:
+                layout_index = LayoutIndexDict(json.load(f))
+        except (IOError, json.JSONDecodeError):
+            layout_index = None  # Rebuild a corrupted index
+
+    if layout_index is not None and _is_layout_index_valid(layout_index, config):
+        _layout_index_cache[str(output_dir)] = layout_index
+        return layout_index
+
+    print("Building BIDS/fMRIPrep layout index...")
+    layout_index = build_layout_index(config)
+
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        tmp_layout_index_path = layout_index_path.with_suffix(f".json.{os.getpid()}")
+        with open(tmp_layout_index_path, "w") as f:
+            json.dump(layout_index, f)
+        os.replace(tmp_layout_index_path, layout_index_path)
+    except OSError:
+        raise RuntimeError(f"Cannot write layout index: <{layout_index_path}>")
+
+    _layout_index_cache[str(output_dir)] = layout_index
+    return layout_index
+
+
+def get_subject_list(config: ConfigDict, use_subject_exclusion: bool = True):
+    """List subjects from the layout index.
+
+    With `use_subject_exclusion`, subjects in subject_exclusion.json are dropped
+    (the file must exist). Otherwise only the fMRIPrep faulty subjects from the
+    config are dropped, which is what the data preparation tasks need.
+    """
+    layout_index = get_layout_index(config)
+
+    if use_subject_exclusion:
+        # Check subject_exclusion.json present
+        try:
+            excluded_subject_list = list(read_subject_exclusion(config).keys())
+        except RuntimeError as e:
+            print(e)
+            raise RuntimeError(
+                'subject_exclusion.json should be present. Please run both "glm.prepare_task_stim" and "glm.prepare_confound" tasks first.'
+            )
+    else:
+        excluded_subject_list = config["execution"]["glm"][
+            "fmriprep_faulty_subject_list"
+        ]
+
+    subject_list = [
+        subject_id
+        for subject_id in layout_index["subjects"].keys()
+        if subject_id not in excluded_subject_list
+    ]
+
+    if config["execution"]["participant_label"] is not None:
+        subject_list = [
+            child
+            for child in subject_list
+            if child[4:] in config["execution"]["participant_label"]
+        ]
+
+    return subject_list
+
+
+def get_subject_layout(subject_id: str, config: ConfigDict):
+    try:
+        return get_layout_index(config)["subjects"][subject_id]
+    except KeyError:
+        raise RuntimeError(f"{subject_id} is not found in the layout index.")
+
+
+def get_fmriprep_run_file(
+    subject_id: str, run_id: str, file_type: str, config: ConfigDict
+):
+    run_file_path = (
+        get_subject_layout(subject_id, config)["fmriprep_runs"]
+        .get(run_id, {})
+        .get(file_type)
+    )
+    return None if run_file_path is None else Path(run_file_path)
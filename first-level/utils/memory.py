@@ -0,0 +1,113 @@
+import os
+import re
+import resource
+import tracemalloc
+from pathlib import Path
+from typing import Optional
+
+import nibabel as nib
+import numpy as np
+
+from .parallel import get_available_cpu_count
+from .types import ConfigDict
+
+MEMORY_SIZE_UNIT_DICT = {
+    "": 1,
+    "B": 1,
+    "K": 1024,
+    "KB": 1024,
+    "M": 1024**2,
+    "MB": 1024**2,
+    "G": 1024**3,
+    "GB": 1024**3,
+    "T": 1024**4,
+    "TB": 1024**4,
+}
+
+# Interpreter, imported modules, and copy-on-write pages of a forked worker
+WORKER_OVERHEAD_BYTES = 256 * 1024**2
+
+
+def parse_memory_size(memory_size: str):
+    """Bytes of a memory size such as 16GB, 512M, or 1.5 TB (binary units)."""
+    match = re.fullmatch(r"\s*([0-9]*\.?[0-9]+)\s*([KMGT]?B?)\s*", memory_size.upper())
+    if match is None:
+        raise ValueError(f"Invalid memory size: <{memory_size}>")
+    return int(float(match.group(1)) * MEMORY_SIZE_UNIT_DICT[match.group(2)])
+
+
+def format_memory_size(n_bytes: int):
+    if n_bytes < 1024**3:
+        return f"{n_bytes / 1024**2:.1f} MB"
+    return f"{n_bytes / 1024**3:.2f} GB"
+
+
+def get_memory_budget(config: ConfigDict) -> Optional[int]:
+    """Memory budget (bytes) from --memory-budget, or None (no limit)."""
+    return config["execution"].get("memory_budget")
+
+
+def measure_peak_memory(function, *args, **kwargs):
+    """Run `function` and return its result and the peak of its (numpy) allocations in bytes."""
+    tracemalloc.start()
+    try:
+        result = function(*args, **kwargs)
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak_bytes
+
+
+def get_resident_memory():
+    """Resident memory (bytes) of this process, or its peak where the current one is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def plan_worker_count(
+    worker_footprint: int, memory_budget: Optional[int], max_workers: int
+):
+    """Workers of `worker_footprint` bytes each (plus the worker overhead) that fit in the budget.
+
+    At least one worker is planned, so stages degrade to a serial run instead of
+    failing when a single worker does not fit.
+    """
+    if memory_budget is None:
+        return max_workers
+    return int(
+        max(
+            1,
+            min(max_workers, memory_budget // (worker_footprint + WORKER_OVERHEAD_BYTES)),
+        )
+    )
+
+
+def get_nifti_data_size(nifti_path_list: list[Path]):
+    """Bytes of the float32 data of nifti files in memory (from their headers)."""
+    return sum(
+        int(np.prod(nib.load(nifti_path).shape)) * np.dtype(np.float32).itemsize
+        for nifti_path in nifti_path_list
+    )
+
+
+def get_clustsim_option(input_path_list: list[Path], config: ConfigDict):
+    """3dttest++ -Clustsim option with the # of CPUs fitted to the memory budget.
+
+    Each 3dClustSim job holds all input maps of the t-test, so the maps set the
+    footprint of a job. Without a budget, AFNI picks the # of CPUs.
+    """
+    memory_budget = get_memory_budget(config)
+    if memory_budget is None:
+        return "-Clustsim"
+
+    n_jobs = plan_worker_count(
+        get_nifti_data_size(input_path_list), memory_budget, get_available_cpu_count()
+    )
+    print(
+        f"3dClustSim jobs: {n_jobs} (memory budget = {format_memory_size(memory_budget)})"
+    )
+    return f"-Clustsim {n_jobs}"
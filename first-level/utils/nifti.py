@@ -47,8 +47,12 @@ def save_nifti(data: np.ndarray, base: NiftiImage, path: Path, file_name: str):
     except OSError:
         raise RuntimeError(f"Cannot create a new directory at <{path}>.")
 
+    # Written to a temporary file first, so a failed write never leaves a partial image
+    tmp_nifti_path = path / f"{file_name}.{os.getpid()}.nii"
     try:
-        nib.save(new_nifti_image, path / f"{file_name}.nii")
+        nib.save(new_nifti_image, tmp_nifti_path)
+        os.replace(tmp_nifti_path, path / f"{file_name}.nii")
     except Exception as e:
         print(e)
+        tmp_nifti_path.unlink(missing_ok=True)
         raise RuntimeError(f"Cannot save a NIFTI image ({file_name}) at <{path}>.")
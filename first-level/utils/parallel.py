@@ -1,11 +1,149 @@
+import math
 import multiprocessing
+import os
+import time
+from pathlib import Path
 
 import parmap
+from threadpoolctl import threadpool_limits
 
-def pmap(function, iterable, *args, **kwargs):
+# Thread count variables of OpenMP/BLAS, read by AFNI programs run by workers
+THREAD_ENV_VAR_LIST = [
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "BLIS_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+]
+
+TARGET_CHUNK_SECONDS = 2.0  # Calibrated chunks take about this long
+CHUNKS_PER_WORKER = 4  # At least this many chunks per worker (load balancing)
+
+
+def _get_cgroup_cpu_limit():
+    # cgroup v2 (cpu.max = "quota period") or v1 (cfs_quota_us / cfs_period_us)
     try:
-        pool = multiprocessing.Pool()
-        return parmap.map(function, iterable, *args, **kwargs, pm_pool=pool)
-    finally:
-        pool.terminate()
-        pool.join()
\ No newline at end of file
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()
+        if quota != "max":
+            return float(quota) / float(period)
+    except (OSError, ValueError):
+        pass
+
+    try:
+        quota = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_quota_us").read_text())
+        period = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_period_us").read_text())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+
+    return None
+
+
+def get_available_cpu_count():
+    """CPUs this process may use: CPU affinity, capped by the cgroup CPU quota (containers)."""
+    try:
+        cpu_count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpu_count = os.cpu_count() or 1
+
+    cgroup_cpu_limit = _get_cgroup_cpu_limit()
+    if cgroup_cpu_limit is not None:
+        cpu_count = min(cpu_count, max(1, math.ceil(cgroup_cpu_limit)))
+
+    return cpu_count
+
+
+def _limit_worker_threads(n_threads: int):
+    # Pool initializer: workers share the CPUs, so each gets a slice of BLAS/OpenMP threads
+    threadpool_limits(n_threads)
+    # BLAS of this process is already initialized and ignores these; they only
+    # cap AFNI subprocesses started by the worker
+    for thread_env_var in THREAD_ENV_VAR_LIST:
+        os.environ[thread_env_var] = str(n_threads)
+
+
+def _calibrate_chunk_size(elapsed_time: float, n_items: int, n_workers: int):
+    # Items per chunk taking about TARGET_CHUNK_SECONDS, with enough chunks to balance workers
+    chunk_size = int(TARGET_CHUNK_SECONDS / max(elapsed_time, 1e-6))
+    return max(1, min(chunk_size, math.ceil(n_items / (n_workers * CHUNKS_PER_WORKER))))
+
+
+def pmap(function, iterable, *args, n_workers=None, start_method=None, **kwargs):
+    """parmap.map over a pool sized to the available CPUs (and cgroup quota).
+
+    Each worker's BLAS/OpenMP threads are capped to its share of the CPUs (no
+    oversubscription). Unless `pm_chunksize` is given, the first item is run in
+    this process as a timed warm-up (its result is kept) to calibrate the chunk
+    size, if there are more than CHUNKS_PER_WORKER items per worker (otherwise,
+    items are sent one by one). With a single worker, all items are run in this process without a
+    pool. `start_method` (e.g., "forkserver") starts the workers with another
+    multiprocessing start method than the default fork, for callers running
+    threads. Throughput of the call is logged.
+    """
+    item_list = list(iterable)
+    cpu_count = get_available_cpu_count()
+    n_workers = max(1, min(n_workers or cpu_count, len(item_list) or 1))
+    n_threads = max(1, cpu_count // n_workers)
+
+    function_kwargs = {
+        key: value for key, value in kwargs.items() if not key.startswith("pm_")
+    }
+
+    start_time = time.perf_counter()
+    result_list = []
+    if n_workers == 1:
+        # Serial run (e.g., a memory budget fitting one worker): no pool to fork
+        cwd = os.getcwd()
+        try:
+            for item in item_list:
+                result_list.append(function(item, *args, **function_kwargs))
+        finally:
+            os.chdir(cwd)
+
+    elif (
+        "pm_chunksize" not in kwargs
+        and len(item_list) <= CHUNKS_PER_WORKER * n_workers
+    ):
+        # Few items (e.g., one per subject): one item per chunk balances best, and a
+        # warm-up would add a whole item to the critical path
+        kwargs["pm_chunksize"] = 1
+
+    elif "pm_chunksize" not in kwargs:
+        # Warm-up under the same thread cap as the workers
+        cwd = os.getcwd()
+        try:
+            with threadpool_limits(n_threads):
+                result_list.append(function(item_list[0], *args, **function_kwargs))
+        finally:
+            os.chdir(cwd)
+
+        kwargs["pm_chunksize"] = _calibrate_chunk_size(
+            time.perf_counter() - start_time, len(item_list) - 1, n_workers
+        )
+        item_list = item_list[1:]
+
+    if n_workers > 1:
+        context = multiprocessing.get_context(start_method)
+        if start_method == "forkserver":
+            # Workers fork from a server that has imported the function's module
+            context.set_forkserver_preload([function.__module__])
+        pool = context.Pool(
+            n_workers, initializer=_limit_worker_threads, initargs=(n_threads,)
+        )
+        try:
+            result_list.extend(
+                parmap.map(function, item_list, *args, **kwargs, pm_pool=pool)
+            )
+        finally:
+            pool.terminate()
+            pool.join()
+
+    elapsed_time = time.perf_counter() - start_time
+    n_items = len(result_list)
+    print(
+        f"{function.__name__}: {n_items} items in {elapsed_time:.1f} s ({n_items / max(elapsed_time, 1e-6):.2f} items/s; {n_workers} workers x {n_threads} threads, chunk size = {kwargs.get('pm_chunksize', 'auto')})"
+    )
+
+    return result_list
@@ -0,0 +1,60 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+PAGE_CACHE_READ_BLOCK_SIZE = 16 * 1024**2  # Bytes read at once into the page cache
+DEFAULT_PREFETCH_DEPTH = 1  # Items loaded ahead of the one being computed
+
+
+def read_into_page_cache(path: Path):
+    """Read a file through, so that later reads (e.g., memory maps of worker processes) hit the OS page cache."""
+    buffer = bytearray(PAGE_CACHE_READ_BLOCK_SIZE)
+    with open(path, "rb", buffering=0) as f:
+        while f.readinto(buffer):
+            pass
+
+
+def prefetch(load_function, key_list: list, depth: int = DEFAULT_PREFETCH_DEPTH):
+    """Yield (key, load_function(key)) of `key_list` in order, loaded ahead on a background I/O thread.
+
+    While the caller computes an item, at most `depth` next items are loaded (a
+    bounded queue, so memory holds at most depth + 1 items). An error of the
+    loader is raised to the caller when its key is reached. I/O wait (blocked on
+    a load) versus compute time (between items) is logged when the iteration
+    ends or is closed.
+    """
+    key_list = list(key_list)
+    io_wait_time = 0.0
+    compute_time = 0.0
+    compute_start_time = None
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    future_deque = deque(
+        (key, executor.submit(load_function, key)) for key in key_list[:depth]
+    )
+    try:
+        for i in range(len(key_list)):
+            # Keep `depth` loads in flight behind the current one
+            if i + depth < len(key_list):
+                next_key = key_list[i + depth]
+                future_deque.append((next_key, executor.submit(load_function, next_key)))
+
+            key, future = future_deque.popleft()
+            start_time = time.perf_counter()
+            data = future.result()
+            io_wait_time += time.perf_counter() - start_time
+
+            compute_start_time = time.perf_counter()
+            yield key, data
+            compute_time += time.perf_counter() - compute_start_time
+            compute_start_time = None
+    finally:
+        # The caller may close the iteration while computing an item
+        if compute_start_time is not None:
+            compute_time += time.perf_counter() - compute_start_time
+        executor.shutdown(wait=True, cancel_futures=True)
+        total_time = max(io_wait_time + compute_time, 1e-6)
+        print(
+            f"Prefetch: I/O wait {io_wait_time:.1f} s, compute {compute_time:.1f} s ({100 * io_wait_time / total_time:.0f}% waiting on I/O)"
+        )
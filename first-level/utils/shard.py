@@ -0,0 +1,225 @@
+import json
+from pathlib import Path
+
+import nibabel as nib
+
+from .layout import get_fmriprep_run_file, get_subject_layout, get_subject_list
+from .types import ConfigDict
+
+# Subject-level tasks which can be split with --shard i/N
+SHARDABLE_TASK_LIST = [
+    "glm.run_block_wise_glm",
+    "glm.run_trial_wise_glm",
+    "rsa.prepare_feedback_neural_data",
+    "rsa.run_feedback_rsa",
+]
+
+MERGED_SHARD_RECORD_NAME = "merged.json"
+
+
+def _get_shard_record_dir(task: str, config: ConfigDict):
+    return Path(config["execution"]["output_dir"]) / "shard" / task
+
+
+def _estimate_subject_cost(subject_id: str, config: ConfigDict):
+    # Cost = (# of runs) x (# of voxels x # of volumes) read from NIFTI headers only
+    subject_cost = 0
+
+    for run_id in get_subject_layout(subject_id, config)["fmriprep_runs"].keys():
+        bold_path = get_fmriprep_run_file(subject_id, run_id, "bold", config)
+        if bold_path is None:
+            continue
+
+        try:
+            bold_shape = nib.load(bold_path).shape
+            run_cost = 1
+            for dim_size in bold_shape:
+                run_cost *= dim_size
+        except Exception:
+            run_cost = bold_path.stat().st_size
+
+        subject_cost += run_cost
+
+    return max(subject_cost, 1)
+
+
+def partition_subject_list(
+    subject_list: list[str], shard_count: int, config: ConfigDict
+):
+    """Deterministically split subjects into `shard_count` cost-balanced shards.
+
+    Subjects are assigned greedily (largest estimated cost first) to the shard with
+    the smallest accumulated cost. Ties are broken by subject ID and shard index,
+    so every node computes the same partition without coordination.
+    """
+    subject_cost_list = [
+        (_estimate_subject_cost(subject_id, config), subject_id)
+        for subject_id in subject_list
+    ]
+    subject_cost_list.sort(key=lambda pair: (-pair[0], pair[1]))
+
+    shard_load_list = [0] * shard_count
+    shard_subject_list = [[] for _ in range(shard_count)]
+
+    for subject_cost, subject_id in subject_cost_list:
+        target_shard = min(range(shard_count), key=lambda i: (shard_load_list[i], i))
+        shard_load_list[target_shard] += subject_cost
+        shard_subject_list[target_shard].append(subject_id)
+
+    return [sorted(shard) for shard in shard_subject_list]
+
+
+def select_shard_subjects(subject_list: list[str], config: ConfigDict):
+    shard = config["execution"].get("shard")
+    if shard is None:
+        return subject_list
+
+    shard_index, shard_count = shard
+    selected_subject_list = partition_subject_list(subject_list, shard_count, config)[
+        shard_index - 1
+    ]
+
+    print(f"Shard {shard_index}/{shard_count}: {selected_subject_list}")
+    return selected_subject_list
+
+
+def mark_shard_complete(subject_list: list[str], config: ConfigDict):
+    shard = config["execution"].get("shard")
+    if shard is None:
+        return
+
+    shard_index, shard_count = shard
+    task = config["execution"]["task"]
+
+    try:
+        shard_record_dir = _get_shard_record_dir(task, config)
+        shard_record_dir.mkdir(parents=True, exist_ok=True)
+    except OSError:
+        raise RuntimeError(f"Cannot create shard record directory: <{shard_record_dir}>")
+
+    shard_record_path = shard_record_dir / f"shard-{shard_index}-of-{shard_count}.json"
+    try:
+        with open(shard_record_path, "w") as f:
+            json.dump(
+                {
+                    "task": task,
+                    "shard_index": shard_index,
+                    "shard_count": shard_count,
+                    "subject_list": subject_list,
+                },
+                f,
+                indent=2,
+            )
+    except IOError:
+        raise RuntimeError(f"Cannot write shard record: <{shard_record_path}>")
+
+    # Records of an earlier run of this task with another shard count are stale
+    for stale_shard_record_path in shard_record_dir.glob("shard-*-of-*.json"):
+        if not stale_shard_record_path.name.endswith(f"-of-{shard_count}.json"):
+            stale_shard_record_path.unlink(missing_ok=True)
+
+
+def _read_shard_record_list(shard_record_dir: Path):
+    """Shard records of the latest run of a task (the shard count of the newest record)."""
+    shard_record_path_list = list(shard_record_dir.glob("shard-*-of-*.json"))
+    if not shard_record_path_list:
+        return []
+
+    newest_shard_record_path = max(
+        shard_record_path_list, key=lambda path: path.stat().st_mtime
+    )
+    shard_count_suffix = "-of-" + newest_shard_record_path.name.split("-of-")[-1]
+
+    shard_record_list = []
+    for shard_record_path in sorted(shard_record_path_list):
+        if not shard_record_path.name.endswith(shard_count_suffix):
+            print(f"Ignoring a shard record of an earlier run: <{shard_record_path}>")
+            continue
+
+        try:
+            with open(shard_record_path, "r") as f:
+                shard_record_list.append(json.load(f))
+        except (IOError, json.JSONDecodeError):
+            raise RuntimeError(f"Cannot read shard record: <{shard_record_path}>")
+
+    return shard_record_list
+
+
+def merge_shards(config: ConfigDict):
+    if config["execution"].get("shard") is not None:
+        raise RuntimeError('"shard.merge_shards" should be run without --shard.')
+
+    subject_list = get_subject_list(config)
+
+    shard_root_dir = Path(config["execution"]["output_dir"]) / "shard"
+    if not shard_root_dir.exists():
+        raise RuntimeError(f"No shard records are found: <{shard_root_dir}>")
+
+    for task in SHARDABLE_TASK_LIST:
+        shard_record_dir = _get_shard_record_dir(task, config)
+        if not shard_record_dir.exists():
+            continue
+
+        shard_record_list = _read_shard_record_list(shard_record_dir)
+        if not shard_record_list:
+            raise RuntimeError(f"No shard records for {task}: <{shard_record_dir}>")
+
+        shard_count = shard_record_list[0]["shard_count"]
+
+        shard_index_set = {record["shard_index"] for record in shard_record_list}
+        missing_shard_list = sorted(set(range(1, shard_count + 1)) - shard_index_set)
+        if missing_shard_list:
+            raise RuntimeError(
+                f"Incomplete shards for {task}: missing {missing_shard_list} of {shard_count}"
+            )
+
+        merged_subject_list = []
+        for record in shard_record_list:
+            merged_subject_list.extend(record["subject_list"])
+
+        if len(merged_subject_list) != len(set(merged_subject_list)):
+            raise RuntimeError(f"Overlapping subjects across shards for {task}.")
+
+        missing_subject_list = sorted(set(subject_list) - set(merged_subject_list))
+        if missing_subject_list:
+            raise RuntimeError(
+                f"Subjects not processed by any shard for {task}: {missing_subject_list}"
+            )
+
+        try:
+            with open(shard_record_dir / MERGED_SHARD_RECORD_NAME, "w") as f:
+                json.dump(
+                    {
+                        "task": task,
+                        "shard_count": shard_count,
+                        "subject_list": sorted(merged_subject_list),
+                    },
+                    f,
+                    indent=2,
+                )
+        except IOError:
+            raise RuntimeError(
+                f"Cannot write merged shard record: <{shard_record_dir / MERGED_SHARD_RECORD_NAME}>"
+            )
+
+        print(f"All {shard_count} shards completed: {task}")
+
+
+def check_shards_merged(task_list: list[str], config: ConfigDict):
+    for task in task_list:
+        shard_record_dir = _get_shard_record_dir(task, config)
+        if not shard_record_dir.exists():
+            continue  # This task was not sharded
+
+        merged_record_path = shard_record_dir / MERGED_SHARD_RECORD_NAME
+        if not merged_record_path.exists():
+            raise RuntimeError(
+                f'{task} was run in shards but not merged. Please run "shard.merge_shards" task first.'
+            )
+
+        merged_mtime = merged_record_path.stat().st_mtime
+        for shard_record_path in shard_record_dir.glob("shard-*-of-*.json"):
+            if shard_record_path.stat().st_mtime > merged_mtime:
+                raise RuntimeError(
+                    f'Shard record is newer than the merged record: <{shard_record_path}>. Please run "shard.merge_shards" task again.'
+                )
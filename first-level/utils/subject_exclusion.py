@@ -1,5 +1,8 @@
+import fcntl
 import json
+import os
 import shutil
+from contextlib import contextmanager
 from pathlib import Path
 
 from .types import ConfigDict, ExclusionDict
@@ -34,27 +37,92 @@ def _read_or_create_subject_exclusion(config: ConfigDict):
 
 def _write_subject_exclusion(exclusion_dict: ExclusionDict, config: ConfigDict):
     subject_exclusion_file_path = _check_subject_exclusion_config(config)
+    tmp_subject_exclusion_file_path = subject_exclusion_file_path.with_suffix(
+        f".json.{os.getpid()}.tmp"
+    )
 
+    # Write to a temporary file and rename it, so readers never see a partial file
     try:
-        with open(subject_exclusion_file_path, "w") as f:
-            return json.dump(exclusion_dict, f, indent=2)
+        with open(tmp_subject_exclusion_file_path, "w") as f:
+            json.dump(exclusion_dict, f, indent=2)
+        os.replace(tmp_subject_exclusion_file_path, subject_exclusion_file_path)
     except IOError:
+        tmp_subject_exclusion_file_path.unlink(missing_ok=True)
         raise RuntimeError(
             f'Cannot write to "subject_exclusion.json": <{subject_exclusion_file_path}>'
         )
 
 
-def mark_subject_exclusion(subject_id: str, reason: str, config: ConfigDict):
-    exclusion_dict = _read_or_create_subject_exclusion(config)
+@contextmanager
+def _lock_subject_exclusion(config: ConfigDict):
+    subject_exclusion_file_path = _check_subject_exclusion_config(config)
+    lock_file_path = subject_exclusion_file_path.with_suffix(".json.lock")
+
+    try:
+        lock_file = open(lock_file_path, "a")
+    except IOError:
+        raise RuntimeError(
+            f'Cannot open the lock file of "subject_exclusion.json": <{lock_file_path}>'
+        )
+
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
 
-    if subject_id in exclusion_dict:
-        if reason not in exclusion_dict[subject_id]:
-            exclusion_dict[subject_id].append(reason)
 
-    else:
-        exclusion_dict[subject_id] = [reason]
+class SubjectExclusionLedger:
+    """Accumulate subject exclusion marks in memory and flush them at once.
+
+    `flush` re-reads subject_exclusion.json under an exclusive file lock and merges
+    the pending marks into it, so marks from parallel workers or shards are kept.
+    """
 
-    _write_subject_exclusion(exclusion_dict, config)
+    def __init__(self, config: ConfigDict):
+        self.config = config
+        self.pending_exclusion_dict = ExclusionDict({})
+
+    def mark(self, subject_id: str, reason: str):
+        reason_list = self.pending_exclusion_dict.setdefault(subject_id, [])
+        if reason not in reason_list:
+            reason_list.append(reason)
+
+    def extend(self, exclusion_list: list[tuple[str, str]]):
+        for subject_id, reason in exclusion_list:
+            self.mark(subject_id, reason)
+
+    def flush(self):
+        if not self.pending_exclusion_dict:
+            return
+
+        with _lock_subject_exclusion(self.config):
+            exclusion_dict = _read_or_create_subject_exclusion(self.config)
+
+            for subject_id, reason_list in self.pending_exclusion_dict.items():
+                for reason in reason_list:
+                    if subject_id in exclusion_dict:
+                        if reason not in exclusion_dict[subject_id]:
+                            exclusion_dict[subject_id].append(reason)
+                    else:
+                        exclusion_dict[subject_id] = [reason]
+
+            _write_subject_exclusion(exclusion_dict, self.config)
+
+        self.pending_exclusion_dict = ExclusionDict({})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+
+def mark_subject_exclusion(subject_id: str, reason: str, config: ConfigDict):
+    ledger = SubjectExclusionLedger(config)
+    ledger.mark(subject_id, reason)
+    ledger.flush()
 
 
 def delete_marked_subjects(config: ConfigDict):
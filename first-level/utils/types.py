@@ -1,6 +1,8 @@
 from pathlib import Path
 from typing import Optional, TypedDict
 
+import numpy as np
+
 
 # Type annotations for the config toml file
 class GLMConfigDict(TypedDict):
@@ -31,21 +33,77 @@ class MaskConfigDict(TypedDict):
     gm_probability_threshold: float  # Gray matter probability threshold for the GM mask
 
 
+class ModelRDMSpecDict(TypedDict):
+    name: str  # Model name used in output file names
+    feature: list[str]  # Column(s) of the behavior feedback or exploration info CSV (default: feedback_score)
+    lags: list[int]  # Trials back to compare (0 = current trial, up to 2); or `window = k` for lags 0 - (k - 1)
+    metric: str  # euclidean (default), sqeuclidean, cityblock, chebyshev, or haversine ([latitude, longitude] features)
+
+
+class PartialRSAConfigDict(TypedDict):
+    covariate: list[str]  # Model RDM names to be regressed out
+    mode: str  # partial (default; neural and model RDMs) or semipartial (model RDMs only)
+
+
+class RegressionRSAConfigDict(TypedDict):
+    model: list[str]  # Model RDM names fitted jointly (standardized betas)
+
+
+class PartialRSASpecDict(TypedDict):
+    covariate: list[str]  # Covariate model RDM names
+    model: list[str]  # Model RDM names compared after the residualization
+    mode: str  # partial or semipartial
+
+
 class RSAConfigDict(TypedDict):
     univariate_noise_normalization: bool  # Whether or not to apply the univariate noise normalization to beta values
-    searchlight_radius: int  # Searchlight kernel radius in voxels
+    searchlight_radius: int | list[
+        int
+    ]  # Searchlight kernel radius in voxels; a list of radii is computed in one pass
+    searchlight_tile_depth: int  # Optional; z slices of searchlight centers per parallel tile (default: 8)
     rsa_blur_kernel_width: int  # Smoothing Gaussian kernel FWHM on the raw RSA maps
+    model_rdm: list[
+        ModelRDMSpecDict
+    ]  # Optional [[rsa.model_rdm]] specs (default: the six feedback history models)
+    exploration_info_path: (
+        Path | str
+    )  # Optional photographer_exploration_info.csv for exploration model RDMs
+    roi_mask: dict[
+        str, Path | str
+    ]  # Optional ROI name -> mask nii path (same grid as the neural data) for rsa.run_roi_rsa
+    partial_rsa: PartialRSAConfigDict  # Optional partial RSA against covariate model RDMs
+    regression_rsa: RegressionRSAConfigDict  # Optional multiple-regression RSA
+    cross_run: bool  # Optional; RDMs of all 30 trials (between-run pairs only) instead of run-wise RDMs
+    neural_rdm_distance: str  # Optional; correlation (default), cosine, euclidean, or sqeuclidean
+    rdm_comparator: str  # Optional; rho_a (default), pearson, tau_a, or cosine
+
+
+class BehaviorConfigDict(TypedDict, total=False):
+    yolo_batch_size: int  # Number of capture images per YOLOv5 inference batch (default: 32)
+    image_decode_workers: int  # Threads decoding capture images ahead of inference (default: 8)
+    torch_num_threads: int  # Torch intra-op threads (default: # of available CPUs, within the cgroup CPU quota)
+    yolo_repo_dir: Path | str  # Local clone of the YOLOv5 code (ultralytics/yolov5) containing hubconf.py
+    yolo_weights_path: Path | str  # Pinned YOLOv5 weights (e.g., yolov5s.pt)
+    yolo_weights_sha256: str  # Expected sha256 of the weights for the integrity check
 
 
 class ExecutionConfigDict(TypedDict):
     glm: GLMConfigDict
     mask: MaskConfigDict
     rsa: RSAConfigDict
+    behavior: BehaviorConfigDict  # Optional
 
     bids_dir: Path
     output_dir: Path
     analysis_level: str
     participant_label: Optional[list[str]]
+    shard: Optional[tuple[int, int]]  # (shard index, shard count) from --shard i/N
+    memory_budget: Optional[int]  # --memory-budget in bytes (None: no limit)
+    models_only: bool  # --models-only (rsa.run_feedback_rsa with cached neural RDMs)
+    searchlight_stride: Optional[int]  # --searchlight-stride (exploratory strided searchlight)
+    searchlight_refine_threshold: Optional[
+        float
+    ]  # --searchlight-refine-threshold (full-resolution spheres above the threshold)
     task: str
     config_file: Path
 
@@ -58,3 +116,49 @@ class ConfigDict(TypedDict):
 
 # Type annotations for the subject_exclusion.json file
 ExclusionDict = dict[str, list[str]]
+
+
+# Type annotations for the layout_index.json file
+class FMRIPrepRunLayoutDict(TypedDict, total=False):
+    bold: str  # Preprocessed BOLD data (MNI152NLin2009cAsym)
+    brainmask: str  # Brain mask (MNI152NLin2009cAsym)
+    confounds: str  # confounds_timeseries.tsv
+
+
+class BehaviorRunLayoutDict(TypedDict):
+    run_dir: str  # Run directory from the Photographer paradigm
+    city: Optional[str]  # City name of the run
+    etime: str  # log_etime.txt
+    capture_image_list: list[str]  # capture/trial_N.png images
+
+
+class SubjectLayoutDict(TypedDict):
+    fmriprep_runs: dict[str, FMRIPrepRunLayoutDict]  # run_id -> fMRIPrep files
+    behavior_dir: Optional[str]  # Behavioral data directory of the subject
+    behavior_runs: dict[str, BehaviorRunLayoutDict]  # run_id -> behavioral files
+
+
+class LayoutIndexDict(TypedDict):
+    version: int
+    fmriprep_output_dir: str
+    behavioral_data_dir: str
+    dir_mtime: dict[str, int]  # Scanned directory -> st_mtime_ns (for invalidation)
+    subjects: dict[str, SubjectLayoutDict]
+
+
+# Type annotations for the etime event table (one row per task event)
+class EventTableDict(TypedDict):
+    onset: np.ndarray  # Event onset (s) from the run start
+    duration: np.ndarray  # Event duration (s)
+    event_type: np.ndarray  # exploration, capture, capture_failed, preview, voice, caption, or feedback
+    trial: np.ndarray  # Trial index (1-8)
+    score: np.ndarray  # Feedback score (percent); NaN for non-feedback events
+    similarity: np.ndarray  # Cosine similarity of the feedback; NaN for non-feedback events
+
+
+# Type annotations for the YOLOv5 detection cache
+class DetectionCacheDict(TypedDict):
+    class_name_list: Optional[list[str]]  # Class names of the model (index = class ID)
+    detections: dict[
+        str, np.ndarray
+    ]  # Image sha256 -> (# of detections) x 6 (x1, y1, x2, y2, confidence, class)
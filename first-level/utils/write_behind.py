@@ -0,0 +1,59 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+DEFAULT_WRITE_WORKERS = 2  # Threads running queued writes
+DEFAULT_MAX_PENDING_WRITES = 8  # Writes queued or running at once (holding their data)
+
+
+@contextmanager
+def write_behind(
+    n_workers: int = DEFAULT_WRITE_WORKERS,
+    max_pending: int = DEFAULT_MAX_PENDING_WRITES,
+):
+    """Run output writes on background threads, so that computation goes on meanwhile.
+
+    Yields submit_write(function, *args, **kwargs), which queues a call of a
+    write function and returns at once, unless `max_pending` writes are already
+    queued or running (a bounded queue; then it blocks until one finishes).
+    Submitted data should not be modified afterwards. An error of a write is
+    raised to the caller at the next submit_write or on exit. All writes are
+    flushed on exit, also when the task fails.
+    """
+    executor = ThreadPoolExecutor(max_workers=n_workers)
+    pending_semaphore = threading.BoundedSemaphore(max_pending)
+    pending_future_list = []
+    n_writes = 0
+    blocked_time = 0.0
+
+    def _raise_write_error():
+        for future in pending_future_list:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+        pending_future_list[:] = [
+            future for future in pending_future_list if not future.done()
+        ]
+
+    def submit_write(function, *args, **kwargs):
+        nonlocal n_writes, blocked_time
+        _raise_write_error()
+
+        start_time = time.perf_counter()
+        pending_semaphore.acquire()
+        blocked_time += time.perf_counter() - start_time
+
+        future = executor.submit(function, *args, **kwargs)
+        future.add_done_callback(lambda _: pending_semaphore.release())
+        pending_future_list.append(future)
+        n_writes += 1
+
+    try:
+        yield submit_write
+    finally:
+        executor.shutdown(wait=True)
+        print(
+            f"Write-behind: {n_writes} writes, blocked {blocked_time:.1f} s on a full queue"
+        )
+
+    _raise_write_error()